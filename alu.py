@@ -1,22 +1,224 @@
 # -*- coding: utf-8 -*-
 # (c) 2009 Ruslan Popov <ruslan.popov@gmail.com>
 
+# SREG flags changed by the groups of instructions
+ARITHMETIC = 0x3f # h s v n z c
+SHIFT = 0x1f # s v n z c
+LOGIC = 0x1e # s v n z
+
+def add_flags(a, b, r):
+    h = (a ^ b ^ r) >> 4 & 1
+    v = ((a ^ r) & (b ^ r)) >> 7 & 1
+    n = r >> 7 & 1
+    return h << 5 | (n ^ v) << 4 | v << 3 | n << 2 | (r & 255 == 0) << 1 | r >> 8 & 1
+
+def sub_flags(a, b, r):
+    h = (~a & b | b & r | r & ~a) >> 3 & 1
+    v = (a & ~b & ~r | ~a & b & r) >> 7 & 1
+    n = r >> 7 & 1
+    return h << 5 | (n ^ v) << 4 | v << 3 | n << 2 | (r & 255 == 0) << 1 | (r < 0)
+
+def result_flags(r, v, c):
+    n = r >> 7
+    return (n ^ v) << 4 | v << 3 | n << 2 | (r == 0) << 1 | c
+
+# the flags are looked up: the ones of the additions and subtractions
+# by carry << 16 | a << 8 | b, the ones of the other operations by the
+# result, the shifts to the right by carry << 8 | result
+ADD_FLAGS = bytearray([add_flags(a, b, a + b + c)
+                       for c in (0, 1) for a in xrange(256) for b in xrange(256)])
+SUB_FLAGS = bytearray([sub_flags(a, b, a - b - c)
+                       for c in (0, 1) for a in xrange(256) for b in xrange(256)])
+LOGIC_FLAGS = bytearray([result_flags(r, 0, 0) for r in xrange(256)])
+DEC_FLAGS = bytearray([result_flags(r, r == 127, 0) for r in xrange(256)])
+INC_FLAGS = bytearray([result_flags(r, r == 128, 0) for r in xrange(256)])
+SHIFT_FLAGS = bytearray([result_flags(r, r >> 7 ^ c, c) for c in (0, 1) for r in xrange(256)])
+
+def flags_add(a, b, r):
+    """ Flags of r = a + b (+ carry), r is not truncated to 8 bits. """
+    return ADD_FLAGS[(r - a - b) << 16 | a << 8 | b]
+
+def flags_sub(a, b, r):
+    """ Flags of r = a - b (- carry), r is not truncated to 8 bits. """
+    return SUB_FLAGS[(a - b - r) << 16 | a << 8 | b]
+
+def flags_dec(a, b, r):
+    """ Flags of r = a - 1. """
+    return DEC_FLAGS[r]
+
+def flags_inc(a, b, r):
+    """ Flags of r = a + 1. """
+    return INC_FLAGS[r]
+
+def flags_logic(a, b, r):
+    """ Flags of the logical operation, V is always cleared. """
+    return LOGIC_FLAGS[r]
+
+def flags_com(a, b, r):
+    """ Flags of r = 255 - a, C is always set. """
+    return LOGIC_FLAGS[r] | 1
+
+def flags_ror(a, b, r):
+    """ Flags of r = a >> 1 with the carry, the sign or zero shifted
+    into bit 7. """
+    return SHIFT_FLAGS[(a & 1) << 8 | r]
+
+def flags_adiw(a, b, r):
+    """ Flags of the word r = a + b, r is not truncated to 16 bits. """
+    v = ~a >> 15 & r >> 15 & 1
+    n = r >> 15 & 1
+    return (n ^ v) << 4 | v << 3 | n << 2 | (r & 0xffff == 0) << 1 | r >> 16 & 1
+
+def flags_sbiw(a, b, r):
+    """ Flags of the word r = a - b, r is not truncated to 16 bits. """
+    v = a >> 15 & ~r >> 15 & 1
+    n = r >> 15 & 1
+    return (n ^ v) << 4 | v << 3 | n << 2 | (r & 0xffff == 0) << 1 | (r < 0)
+
+class DataView(object):
+    """ Window over a part of the data space, indexed from zero. """
+
+    def __init__(self, data, base, size):
+        self.data = data
+        self.base = base
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.size:
+            raise IndexError(index)
+        return self.data[self.base + index]
+
+    def __setitem__(self, index, value):
+        if not 0 <= index < self.size:
+            raise IndexError(index)
+        self.data[self.base + index] = value
+
+    def __iter__(self):
+        for index in xrange(self.base, self.base + self.size):
+            yield self.data[index]
+
 class ALU(object):
 
+    sram_size = 0
+
     def __init__(self, *args, **kwargs):
         self.pointer = 0
-        self.reg_vals = {}
-        self.port_vals = {}
-        self.stack = []
+        self.cycles = 0
+
+        # data space: 32 registers, 64 I/O ports, then SRAM
+        self.io = 0x20
+        self.sreg = self.io + 0x3f
+        self.data = bytearray(self.io + 64 + self.sram_size)
+
+        # the stack grows down from the end of SRAM, SP points to the
+        # first free byte; one bound check per push or pop keeps it
+        # within SRAM
+        self.spl = self.io + 0x3d
+        self.sram = self.io + 64
+        self.ramend = len(self.data) - 1
+        self.data[self.spl] = self.ramend
+
+        # with lazy flags the last flag-setting operation is kept as
+        # (mask, flags function, a, b, result) and SREG gets its flags
+        # only when somebody reads it
+        self.lazy_flags = kwargs.get('lazy_flags', True)
+        self.pending = None
+
+        # peripherals keep their ports through hooks, see io_read()
+        # and io_write()
+        self.read_hooks = {}
+        self.write_hooks = {}
 
         self.flags = {'i': 7, 't': 6, 'h': 5, 's': 4,
                       'v': 3, 'n': 2, 'z': 1, 'c': 0}
 
     def set_reg(self, reg_num, value):
-        self.reg_vals[reg_num] = value
+        self.data[reg_num] = value
 
     def set_port(self, port_num, value):
-        self.port_vals[port_num] = value
+        if self.io + port_num == self.sreg:
+            self.pending = None
+        self.data[self.io + port_num] = value
+
+    def io_read(self, a, now=None):
+        """ Returns the value of the I/O port at the cycle now, its
+        read hook brings the port up to date first. """
+        if self.io + a == self.sreg:
+            self.sreg_flush()
+        hook = self.read_hooks.get(a)
+        if hook is not None:
+            if now is None:
+                now = self.cycles
+            hook(a, now)
+        return self.data[self.io + a]
+
+    def io_write(self, a, value, bits=255, now=None):
+        """ Writes the I/O port at the cycle now, bits is the mask of
+        the bits the instruction writes. """
+        hook = self.write_hooks.get(a)
+        if hook is None:
+            self.set_port(a, value)
+            return
+        if now is None:
+            now = self.cycles
+        hook(a, value, bits, now)
+
+    def read_data(self, addr, now=None):
+        """ Returns the byte of the data space at addr as the load
+        instructions see it, the ports are read through io_read(). """
+        if self.io <= addr < self.io + 64:
+            return self.io_read(addr - self.io, now)
+        if not 0 <= addr < len(self.data):
+            raise Exception('ERROR: Address %04x is out of the data space' % (addr, ))
+        return self.data[addr]
+
+    def write_data(self, addr, value, now=None):
+        """ Writes the byte of the data space at addr as the store
+        instructions do, the ports are written through io_write(). """
+        if self.io <= addr < self.io + 64:
+            self.io_write(addr - self.io, value, 255, now)
+            self.limit = 0
+            return
+        if not 0 <= addr < len(self.data):
+            raise Exception('ERROR: Address %04x is out of the data space' % (addr, ))
+        self.data[addr] = value
+
+    def push_byte(self, value):
+        """ Puts the byte onto the stack. """
+        sp = self.data[self.spl]
+        if not self.sram <= sp <= self.ramend:
+            raise Exception('ERROR: Stack overflow at %04x' % (self.pointer, ))
+        self.data[sp] = value
+        self.data[self.spl] = sp - 1
+
+    def pop_byte(self):
+        """ Takes the byte from the stack. """
+        sp = self.data[self.spl] + 1
+        if not self.sram <= sp <= self.ramend:
+            raise Exception('ERROR: Stack underflow at %04x' % (self.pointer, ))
+        self.data[self.spl] = sp
+        return self.data[sp]
+
+    def push_address(self, addr):
+        """ Puts the address onto the stack as a word address, the high
+        byte goes below the low one. """
+        sp = self.data[self.spl]
+        if not self.sram < sp <= self.ramend:
+            raise Exception('ERROR: Stack overflow at %04x' % (self.pointer, ))
+        self.data[sp] = addr >> 1 & 255
+        self.data[sp - 1] = addr >> 9
+        self.data[self.spl] = sp - 2
+
+    def pop_address(self):
+        """ Takes the address from the stack. """
+        sp = self.data[self.spl] + 2
+        if not self.sram < sp <= self.ramend:
+            raise Exception('ERROR: Stack underflow at %04x' % (self.pointer, ))
+        self.data[self.spl] = sp
+        return (self.data[sp - 1] << 8 | self.data[sp]) << 1
 
     def set_bit(self, x, bitnum):
         """ Sets appropriate bit. """
@@ -30,10 +232,37 @@ class ALU(object):
         """ Checks if appropriate bit is set. """
         return (x & (1 << bitnum)) != 0
 
+    def sreg_update(self, mask, func, a, b, r):
+        """ Sets the flags from mask as func(a, b, r) computes them,
+        at once or when SREG is read. """
+        if self.lazy_flags:
+            pending = self.pending
+            if pending is not None and pending[0] & ~mask:
+                self.sreg_flush()
+            self.pending = (mask, func, a, b, r)
+        else:
+            self.data[self.sreg] = self.data[self.sreg] & ~mask | func(a, b, r)
+
+    def sreg_chain(self, mask, flags):
+        """ Sets the flags from mask at once, Z stays set only if it
+        was set, as sbc, sbci and cpc keep it over the bytes of a wider
+        number. """
+        self.sreg_flush()
+        sreg = self.data[self.sreg]
+        self.data[self.sreg] = sreg & ~mask | flags & (~2 | sreg)
+
+    def sreg_flush(self):
+        """ Computes the pending flags. """
+        pending = self.pending
+        if pending is not None:
+            self.pending = None
+            (mask, func, a, b, r) = pending
+            self.data[self.sreg] = self.data[self.sreg] & ~mask | func(a, b, r)
+
     def sreg_change(self, bit_name, action=None):
-        value = self.port_vals['3f']
+        self.sreg_flush()
         bit = self.flags[bit_name]
-        self.port_vals['3f'] = action(value, bit)
+        self.data[self.sreg] = action(self.data[self.sreg], bit)
 
     def sreg_set(self, bit_name):
         if type(bit_name) is tuple:
@@ -50,12 +279,13 @@ class ALU(object):
             self.sreg_change(bit_name, self.clear_bit)
 
     def sreg_check(self, bit_name):
-        value = self.port_vals['3f']
+        self.sreg_flush()
         bit = self.flags[bit_name]
-        return self.check_bit(value, bit)
+        return self.check_bit(self.data[self.sreg], bit)
 
     def get_sreg(self):
-        return self.port_vals['3f']
+        self.sreg_flush()
+        return self.data[self.sreg]
 
     def int2bin(self, n, count=16):
         """ Converts integer to binary representation. """
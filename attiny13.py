@@ -1,107 +1,644 @@
 # -*- coding: utf-8 -*-
 # (c) 2009 Ruslan Popov <ruslan.popov@gmail.com>
 
-import operator, re
-from alu import ALU
+import operator, re, struct, sys
+from alu import ALU, DataView, ARITHMETIC, LOGIC, SHIFT, \
+     flags_add, flags_adiw, flags_com, flags_dec, flags_inc, flags_logic, \
+     flags_ror, flags_sbiw, flags_sub
+from compiler import Compiler
+from images import Image
+from peripherals import ADConverter, Eeprom, PortB, Timer0, Watchdog
+from scheduler import Scheduler
+from tracer import NOWHERE
 
 class ATtiny13(ALU):
 
+    sram_size = 64
+
     def __init__(self, *args, **kwargs):
         super(ATtiny13, self).__init__(*args, **kwargs)
 
-        self.port_names = {'03': 'ADCSRB', '04': 'ADCL', '05': 'ADCH',  '06': 'ADCSRA',
-                      '07': 'ADMUX',  '08': 'ACSR', '14': 'DIDR0', '15': 'PCMSK',
-                      '16': 'PINB',   '17': 'DDRB', '18': 'PORTB', '1C': 'EECR',
-                      '1D': 'EEDR',
-                      '26': 'CLKPR', '28': 'GRCCR',
-                      '32': 'TCNT0', '39': 'TIMSK0',
-                      '3d': 'SPL',
-                      '3f': 'SREG' }
-
-        [self.reg_vals.update({'r%02i' % r: 0}) for r in xrange(32)]
-        [self.port_vals.update({p: 0}) for p in self.port_names.keys()]
+        self.port_names = {0x03: 'ADCSRB', 0x04: 'ADCL', 0x05: 'ADCH',  0x06: 'ADCSRA',
+                      0x07: 'ADMUX',  0x08: 'ACSR', 0x14: 'DIDR0', 0x15: 'PCMSK',
+                      0x16: 'PINB',   0x17: 'DDRB', 0x18: 'PORTB', 0x1c: 'EECR',
+                      0x1d: 'EEDR',   0x1e: 'EEARL', 0x21: 'WDTCR',
+                      0x26: 'CLKPR', 0x28: 'GRCCR', 0x29: 'OCR0B', 0x2f: 'TCCR0A',
+                      0x32: 'TCNT0', 0x33: 'TCCR0B', 0x34: 'MCUSR', 0x35: 'MCUCR',
+                      0x36: 'OCR0A', 0x37: 'SPMCSR', 0x38: 'TIFR0', 0x39: 'TIMSK0', 0x3a: 'GIFR',
+                      0x3b: 'GIMSK', 0x3d: 'SPL',
+                      0x3f: 'SREG' }
 
         self.mnemonics = {
             'adc': ('^000111(?P<ra>[01]{1})(?P<rd>[01]{5})(?P<rb>[01]{4})$', 'rd_rr', self.adc),
             'add': ('^000011(?P<ra>[01]{1})(?P<rd>[01]{5})(?P<rb>[01]{4})$', 'rd_rr', self.add),
-            'and': ('^001000(?P<ra>[01]{1})(?P<rd>[01]{5})(?P<rb>[01]{4})$', 'rd_rr', lambda: 'and'),
+            'adiw': ('^10010110(?P<ka>[01]{2})(?P<rd>[01]{2})(?P<kb>[01]{4})$', 'rw_k', self.adiw),
+            'and': ('^001000(?P<ra>[01]{1})(?P<rd>[01]{5})(?P<rb>[01]{4})$', 'rd_rr', self.and_op),
             'andi': ('^0111(?P<ka>[01]{4})(?P<rd>[01]{4})(?P<kb>[01]{4})$', 'rd_k', self.andi),
+            'asr': ('^1001010(?P<rd>[01]{5})0101$', 'rd', self.asr),
+            'bclr': ('^100101001(?P<s>[01]{3})1000$', 's', self.bclr),
             'bld': ('^1111100(?P<rd>[01]{5})0(?P<b>[01]{3})$', 'rd_b', self.bld),
-            'brcc': ('^111101(?P<k>[01]{7})000$', 'k', self.brcc),
-            'brcs': ('^111100(?P<k>[01]{7})000$', 'k', lambda: 'brcs'),
-            'breq': ('^111100(?P<k>[01]{7})001$', 'k', lambda: 'breq'),
-            'brne': ('^111101(?P<k>[01]{7})001$', 'k', self.brne),
+            'brcc': ('^111101(?P<k>[01]{7})000$', 'k7', self.brcc),
+            'break': ('^(?P<op>1001010110011000)$', None, self.break_op),
+            'brne': ('^111101(?P<k>[01]{7})001$', 'k7', self.brne),
+            'bset': ('^100101000(?P<s>[01]{3})1000$', 's', self.bset),
             'bst': ('^1111101(?P<rd>[01]{5})0(?P<b>[01]{3})$', 'rd_b', self.bst),
             'cbi': ('^10011000(?P<a>[01]{5})(?P<b>[01]{3})$', 'a_b', self.cbi),
             'cli': ('^(?P<op>1001010011111000)$', None, self.cli),
             'clr': (None, None, self.clr),
-            'com': ('^1001010(?P<rd>[01]{5})0000$', 'rd', lambda: 'com'),
-            'cpi': ('^0011(?P<ka>[01]{4})(?P<rd>[01]{4})(?P<kb>[01]{4})$', 'rd_k', lambda: 'cpi'),
+            'com': ('^1001010(?P<rd>[01]{5})0000$', 'rd', self.com),
+            'cp': ('^000101(?P<ra>[01]{1})(?P<rd>[01]{5})(?P<rb>[01]{4})$', 'rd_rr', self.cp),
+            'cpc': ('^000001(?P<ra>[01]{1})(?P<rd>[01]{5})(?P<rb>[01]{4})$', 'rd_rr', self.cpc),
+            'cpi': ('^0011(?P<ka>[01]{4})(?P<rd>[01]{4})(?P<kb>[01]{4})$', 'rd_k', self.cpi),
+            'cpse': ('^000100(?P<ra>[01]{1})(?P<rd>[01]{5})(?P<rb>[01]{4})$', 'rd_rr', self.cpse),
             'dec': ('^1001010(?P<rd>[01]{5})1010$', 'rd', self.dec),
-            'eor': ('^001001(?P<ra>[01]{1})(?P<rd>[01]{5})(?P<rb>[01]{4})$', 'rd_rr', lambda: 'eor'),
+            'eor': ('^001001(?P<ra>[01]{1})(?P<rd>[01]{5})(?P<rb>[01]{4})$', 'rd_rr', self.eor),
+            'icall': ('^(?P<op>1001010100001001)$', None, self.icall),
+            'ijmp': ('^(?P<op>1001010000001001)$', None, self.ijmp),
             'in': ('^10110(?P<aa>[01]{2})(?P<rd>[01]{5})(?P<ab>[01]{4})$', 'rd_a', self.in_op),
+            'inc': ('^1001010(?P<rd>[01]{5})0011$', 'rd', self.inc),
+            'ld': ('^1001000(?P<rd>[01]{5})(?P<m>[01]{4})$', 'rd_ptr', self.ld),
+            'ldd': ('^10(?P<qa>[01]{1})0(?P<qb>[01]{2})0(?P<rd>[01]{5})(?P<y>[01]{1})(?P<qc>[01]{3})$',
+                    'rd_q', self.ldd),
             'ldi': ('^1110(?P<ka>[01]{4})(?P<rd>[01]{4})(?P<kb>[01]{4})$', 'rd_k', self.ldi),
+            'lds': ('^1001000(?P<rd>[01]{5})0000$', 'rd', self.lds),
+            'lpm': ([('^(?P<op>1001010111001000)$', 'r0_z'),
+                     ('^1001000(?P<rd>[01]{5})010(?P<p>[01]{1})$', 'rd_p')], None, self.lpm),
+            'lsl': (None, None, self.lsl),
+            'lsr': ('^1001010(?P<rd>[01]{5})0110$', 'rd', self.lsr),
             'mov': ('^001011(?P<ra>[01]{1})(?P<rd>[01]{5})(?P<rb>[01]{4})$', 'rd_rr', self.mov),
+            'movw': ('^00000001(?P<rd>[01]{4})(?P<rr>[01]{4})$', 'rw_rw', self.movw),
+            'neg': ('^1001010(?P<rd>[01]{5})0001$', 'rd', self.neg),
+            'nop': ('^(?P<op>0000000000000000)$', None, self.nop),
             'or': ('^001010(?P<ra>[01]{1})(?P<rd>[01]{5})(?P<rb>[01]{4})$', 'rd_rr', self.or_op),
             'ori': ('^0110(?P<ka>[01]{4})(?P<rd>[01]{4})(?P<kb>[01]{4})$', 'rd_k', self.ori),
             'out': ('^10111(?P<aa>[01]{2})(?P<rr>[01]{5})(?P<ab>[01]{4})$', 'a_rr', self.out),
             'pop': ('^1001000(?P<rd>[01]{5})1111$', 'rd', self.pop),
             'push': ('^1001001(?P<rd>[01]{5})1111$', 'rd', self.push),
-            'rcall': ('^1101(?P<k>[01]{12})$', 'k', self.rcall),
+            'rcall': ('^1101(?P<k>[01]{12})$', 'k12', self.rcall),
             'ret': ('^(?P<op>1001010100001000)$', None, self.ret),
             'reti': ('^(?P<op>1001010100011000)$', None, self.reti),
-            'rjmp': ('^1100(?P<k>[01]{12})$', 'k', self.rjmp),
-            'rol': ('^000111(?P<ra>[01]{1})(?P<rd>[01]{5})(?P<rb>[01]{4})$', 'rd_rr', self.rol),
+            'rjmp': ('^1100(?P<k>[01]{12})$', 'k12', self.rjmp),
+            'rol': (None, None, self.rol),
             'ror': ('^1001010(?P<rd>[01]{5})0111$', 'rd', self.ror),
-            'sbi': ('^10011010(?P<a>[01]{5})(?P<b>[01]{3})$', 'a_b', lambda: 'sbi'),
+            'sbc': ('^000010(?P<ra>[01]{1})(?P<rd>[01]{5})(?P<rb>[01]{4})$', 'rd_rr', self.sbc),
+            'sbci': ('^0100(?P<ka>[01]{4})(?P<rd>[01]{4})(?P<kb>[01]{4})$', 'rd_k', self.sbci),
+            'sbi': ('^10011010(?P<a>[01]{5})(?P<b>[01]{3})$', 'a_b', self.sbi),
             'sbic': ('^10011001(?P<a>[01]{5})(?P<b>[01]{3})$', 'a_b', self.sbic),
-            'sbrc': ('^1111110(?P<rr>[01]{5})0(?P<b>[01]{3})', 'rr_b', lambda: 'sbrc'),
+            'sbis': ('^10011011(?P<a>[01]{5})(?P<b>[01]{3})$', 'a_b', self.sbis),
+            'sbiw': ('^10010111(?P<ka>[01]{2})(?P<rd>[01]{2})(?P<kb>[01]{4})$', 'rw_k', self.sbiw),
+            'sbrc': ('^1111110(?P<rr>[01]{5})0(?P<b>[01]{3})', 'rr_b', self.sbrc),
             'sbrs': ('^1111111(?P<rr>[01]{5})0(?P<b>[01]{3})', 'rr_b', self.sbrs),
             'sei': ('^(?P<op>1001010001111000)$', None, self.sei),
+            'sleep': ('^(?P<op>1001010110001000)$', None, self.sleep),
+            'spm': ('^(?P<op>1001010111101000)$', None, self.spm),
+            'st': ('^1001001(?P<rd>[01]{5})(?P<m>[01]{4})$', 'rd_ptr', self.st),
+            'std': ('^10(?P<qa>[01]{1})0(?P<qb>[01]{2})1(?P<rd>[01]{5})(?P<y>[01]{1})(?P<qc>[01]{3})$',
+                    'rd_q', self.std),
+            'sts': ('^1001001(?P<rd>[01]{5})0000$', 'rd', self.sts),
+            'sub': ('^000110(?P<ra>[01]{1})(?P<rd>[01]{5})(?P<rb>[01]{4})$', 'rd_rr', self.sub),
+            'subi': ('^0101(?P<ka>[01]{4})(?P<rd>[01]{4})(?P<kb>[01]{4})$', 'rd_k', self.subi),
+            'swap': ('^1001010(?P<rd>[01]{5})0010$', 'rd', self.swap),
+            'tst': (None, None, self.tst),
+            'wdr': ('^(?P<op>1001010110101000)$', None, self.wdr),
             }
 
+        # the pointer registers and the modes of ld and st by the low
+        # nibble of the opcode: 0 keeps the pointer, 1 increments it
+        # after the access, -1 decrements it before
+        self.pointer_modes = {0x1: (30, 1), 0x2: (30, -1), 0x9: (28, 1), 0xa: (28, -1),
+                              0xc: (26, 0), 0xd: (26, 1), 0xe: (26, -1)}
+
         self.logics = {
             'a_b': (('a', 'b'),
-                    lambda addr, a, b: (int(a,2), int(b,2))),
+                    lambda addr, a, b: (a, b)),
             'a_rr': (('aa', 'ab', 'rr'),
-                     lambda addr, aa, ab, rr: (int('%s%s' % (aa, ab), 2),
-                                               'r%s' % int(rr,2))),
-            'k': (('k',),
-                  lambda addr, k: (int(k, 2), k.startswith('1'))),
+                     lambda addr, aa, ab, rr: (aa << 4 | ab, rr)),
+            'k7': (('k',),
+                   lambda addr, k: (k, k >> 6 == 1)),
+            'k12': (('k',),
+                    lambda addr, k: (k, k >> 11 == 1)),
+            'r0_z': ((),
+                     lambda addr: (0, 0)),
             'rd': (('rd',),
-                   lambda addr, rd: 'r%s' % int(rd,2)),
+                   lambda addr, rd: rd),
             'rd_a': (('aa', 'ab', 'rd'),
-                     lambda addr, ka, kb, rd: ('r%i' % (int(rd,2)),
-                                               int('%s%s' % (ka, kb),2))),
+                     lambda addr, aa, ab, rd: (rd, aa << 4 | ab)),
             'rd_b': (('rd', 'b'),
-                     lambda addr, rd, b: ('r%s' % int(rd,2), int(b,2))),
+                     lambda addr, rd, b: (rd, b)),
             'rd_k': (('ka', 'kb', 'rd'),
-                     lambda addr, ka, kb, rd: ('r%s' % (int(rd,2) + 16),
-                                               int('%s%s' % (ka, kb), 2))),
+                     lambda addr, ka, kb, rd: (rd + 16, ka << 4 | kb)),
+            'rd_p': (('rd', 'p'),
+                     lambda addr, rd, p: (rd, p)),
+            'rd_ptr': (('rd', 'm'),
+                       lambda addr, rd, m: m in self.pointer_modes and
+                       (rd, ) + self.pointer_modes[m] or None),
+            'rd_q': (('rd', 'y', 'qa', 'qb', 'qc'),
+                     lambda addr, rd, y, qa, qb, qc: (rd, 28 if y else 30, qa << 5 | qb << 3 | qc)),
             'rd_rr': (('ra', 'rb', 'rd'),
-                      lambda addr, ra, rb, rd: ('r%s' % int(rd,2),
-                                                'r%s' % int('%s%s' % (ra, rb),2))),
+                      lambda addr, ra, rb, rd: (rd, ra << 4 | rb)),
             'rr_b': (('rr', 'b'),
-                     lambda addr, rr, b: ('r%i' % (int(rr,2)), int(b,2)))
+                     lambda addr, rr, b: (rr, b)),
+            'rw_k': (('ka', 'kb', 'rd'),
+                     lambda addr, ka, kb, rd: (24 + 2 * rd, ka << 4 | kb)),
+            'rw_rw': (('rd', 'rr'),
+                      lambda addr, rd, rr: (2 * rd, 2 * rr)),
+            's': (('s',),
+                  lambda addr, s: s)
             }
 
+        # conditional branches: flag and its state to take the branch
+        self.branch_flags = {'brcc': ('c', False),
+                             'brcs': ('c', True),
+                             'breq': ('z', True),
+                             'brge': ('s', False),
+                             'brhc': ('h', False),
+                             'brhs': ('h', True),
+                             'brid': ('i', False),
+                             'brie': ('i', True),
+                             'brlt': ('s', True),
+                             'brmi': ('n', True),
+                             'brne': ('z', False),
+                             'brpl': ('n', False),
+                             'brtc': ('t', False),
+                             'brts': ('t', True),
+                             'brvc': ('v', False),
+                             'brvs': ('v', True)}
+        for command, (flag, state) in self.branch_flags.items():
+            if command not in self.mnemonics:
+                regexp = '^1111%s(?P<k>[01]{7})%s$' % (state and '00' or '01',
+                                                       self.int2bin(self.flags[flag], 3))
+                self.mnemonics[command] = (regexp, 'k7', self.branch_op(command))
+
+        # instructions of two words, the second one is the address
+        self.long_commands = ('lds', 'sts')
+
+        # instructions which take more than one cycle
+        self.cycle_costs = {'adiw': 2, 'cbi': 2, 'icall': 3, 'ijmp': 2, 'ld': 2,
+                            'ldd': 2, 'lds': 2, 'lpm': 3, 'pop': 2, 'push': 2,
+                            'rcall': 3, 'ret': 4, 'reti': 4, 'rjmp': 2, 'sbi': 2,
+                            'sbiw': 2, 'st': 2, 'std': 2, 'sts': 2}
+
+        # interrupts in the order of their priority: name, vector, the
+        # port and the bit of the flag, the port and the bit of the mask,
+        # the flag when the interrupt is not pending; EE_RDY is pending
+        # while EEPE is clear, the hardware clears the other flags
+        self.interrupts = [('int0', 0x02, 0x3a, 0x40, 0x3b, 0x40, 0),
+                           ('pcint0', 0x04, 0x3a, 0x20, 0x3b, 0x20, 0),
+                           ('tim0_ovf', 0x06, 0x38, 0x02, 0x39, 0x02, 0),
+                           ('ee_rdy', 0x08, 0x1c, 0x02, 0x1c, 0x08, 0x02),
+                           ('tim0_compa', 0x0c, 0x38, 0x04, 0x39, 0x04, 0),
+                           ('tim0_compb', 0x0e, 0x38, 0x08, 0x39, 0x08, 0),
+                           ('wdt', 0x10, 0x21, 0x80, 0x21, 0x40, 0),
+                           ('adc', 0x12, 0x06, 0x10, 0x06, 0x08, 0)]
+
+        # peripherals schedule their events, the run loop stops at the
+        # nearest one to serve it; the EEPROM is kept in the image file
+        # from the keyword eeprom over the runs
+        self.frequency = 9600000
+        self.scheduler = Scheduler()
+        self.timer0 = Timer0(self, self.scheduler)
+        self.portb = PortB(self)
+        self.watchdog = Watchdog(self, self.scheduler)
+        self.adc = ADConverter(self, self.scheduler)
+        self.eeprom = Eeprom(self, self.scheduler, Image(64, kwargs.get('eeprom'), True))
+        self.peripherals = (self.timer0, self.portb, self.watchdog, self.adc, self.eeprom)
+        self.event_handlers = {'timer0': self.timer0.event,
+                               'watchdog': self.watchdog.event,
+                               'adc': self.adc.event,
+                               'eeprom': self.eeprom.event}
+
+        # sleep keeps the pointer until an interrupt wakes the MCU up;
+        # one more instruction goes after sei and reti, inhibit is the
+        # cycle they end at
+        self.sleeping = False
+        self.inhibit = -1
+
+        # flash keeps the image for lpm and spm, spm fills the buffer
+        # of the page first; the image file from the keyword flash is
+        # mapped copy-on-write, so the machines share it
+        self.flash_size = 1024
+        self.page_size = 32
+        self.flash_image = Image(self.flash_size, kwargs.get('flash'))
+        self.flash = self.flash_image.data
+        self.page_buffer = bytearray('\xff' * self.page_size)
+        # while it is set, the changes of the memories out of the data
+        # space go into journal as (memory, index, old value)
+        self.journal = None
+        self.code_tree = {}
+        self.code = []
+        self.breaks = set()
+
+        # compiled blocks run instead of single instructions, they never
+        # pass through the addresses from block_stops
+        self.use_blocks = kwargs.get('blocks', True)
+        self.compiler = Compiler(self)
+        self.blocks = []
+        self.block_stops = set()
+        self.limit = 0
+        # (until_pc, until_break) of the run, the pointer it starts at
+        # and the reason it stops for, see stop_at()
+        self.stopping = None
+        self.resume = None
+        self.stopped_by = None
+        self.tracer = None
+        self.profiler = None
+        self.watches = None
+
+        # two-operand instructions which become another mnemonic when
+        # both operands point to the same register
+        self.synonyms = {'adc': 'rol',
+                         'add': 'lsl',
+                         'and': 'tst',
+                         'eor': 'clr'}
+        self.flag_names = dict([(bit, name) for name, bit in self.flags.items()])
+
+        self.build_decoder()
+
+    def load(self, code_tree, code=None, image=None):
+        """ Sets the program to execute and its threaded code. The
+        flash image is what lpm reads. Without it the flash keeps the
+        image file it is mapped from or is erased. """
+        if image is not None:
+            self.flash_image.write(image)
+        elif self.flash_image.path is None:
+            self.flash_image.erase()
+        self.code_tree = code_tree
+        self.breaks = set([int(addr, 16) for addr, (command, args) in code_tree.items()
+                           if command == 'break'])
+        self.block_stops = set(self.breaks)
+        if self.watches is not None:
+            self.block_stops.update(self.watches.addresses())
+        if code is None or self.tracer is not None or self.profiler is not None or \
+               self.watches is not None:
+            self.code = self.compiler.compile(code_tree)
+            self.invalidate()
+        else:
+            # the given code does not check the stops
+            self.code = list(code)
+            self.recompile_at(self.block_stops)
+
+    def trace(self, tracer):
+        """ Starts writing the records of the executed instructions
+        to tracer or stops it if tracer is None. The code is compiled
+        again with or without the records. """
+        self.tracer = tracer
+        self.compiler.tracer = tracer
+        self.recompile()
+
+    def profile(self, profiler):
+        """ Starts counting the executions into profiler or stops it
+        if profiler is None. The code is compiled again. """
+        self.profiler = profiler
+        self.compiler.profiler = profiler
+        self.recompile()
+
+    def watch(self, watches):
+        """ Sets the breakpoints and the watchpoints from watches or
+        drops them if watches is None. The code is compiled again. """
+        self.watches = watches
+        self.compiler.watches = watches
+        self.block_stops = set(self.breaks)
+        if watches is not None:
+            self.block_stops.update(watches.addresses())
+        self.recompile()
+
+    def recompile(self):
+        self.code = self.compiler.compile(self.code_tree)
+        self.invalidate()
+
+    def recompile_at(self, addresses):
+        """ Compiles the instructions at the addresses again after
+        block_stops changed there. """
+        keys = [key for key in ['%04x' % addr for addr in addresses]
+                if key in self.code_tree and self.code_tree[key][0] in self.compiler.handlers]
+        if keys:
+            code = self.compiler.compile(self.code_tree, keys=keys)
+            for key in keys:
+                self.code[int(key, 16) >> 1] = code[int(key, 16) >> 1]
+        self.invalidate()
+
+    def invalidate(self):
+        """ Drops compiled blocks, they are compiled again on demand. """
+        self.blocks = self.compiler.blocks(self.code_tree, self.block_stops)
+
+    def write_word(self, addr, word):
+        """ Rewrites one word of flash. """
+        self.write_words(addr, [word])
+
+    def write_words(self, addr, words):
+        """ Rewrites the words of flash from addr. The two instructions
+        before them are compiled again too: a word may be the address
+        of lds or sts, or the instruction a skip jumps over. """
+        end = addr + 2 * len(words)
+        if self.journal is not None:
+            self.journal.append(('flash', addr, [self.flash[a] | self.flash[a + 1] << 8
+                                                 for a in xrange(addr, end, 2)]))
+        for i, word in enumerate(words):
+            self.flash[addr + 2 * i] = word & 255
+            self.flash[addr + 2 * i + 1] = word >> 8
+        for a in xrange(addr, end, 2):
+            key = '%04x' % a
+            mnemo = self.parse(a, self.flash[a] | self.flash[a + 1] << 8)
+            self.breaks.discard(a)
+            if mnemo is None:
+                self.code_tree.pop(key, None)
+                continue
+            self.code_tree[key] = mnemo
+            if mnemo[0] == 'break':
+                self.breaks.add(a)
+                self.block_stops.add(a)
+        first = max(0, addr - 4)
+        keys = []
+        for a in xrange(first, end, 2):
+            key = '%04x' % a
+            entry = self.code_tree.get(key)
+            if entry is None:
+                continue
+            (command, args) = entry
+            if command in self.long_commands and addr <= a + 2 < end:
+                self.code_tree[key] = (command, (args[0], self.flash[a + 2] | self.flash[a + 3] << 8))
+            keys.append(key)
+        code = self.compiler.compile(self.code_tree, keys=keys)
+        for a in xrange(first, addr + 2 * len(words), 2):
+            self.code[a >> 1] = code[a >> 1]
+        self.invalidate()
+
+    def program_flash(self):
+        """ Executes spm as SPMCSR tells: puts r1:r0 into the page
+        buffer, erases the page at Z or writes the buffer into it. The
+        flash changes at once, the halt of the MCU is not modeled. """
+        spmcsr = self.data[self.io + 0x37]
+        z = self.z() % self.flash_size
+        page = z & ~(self.page_size - 1)
+        if spmcsr & 0x1f == 0x01:
+            offset = z & (self.page_size - 2)
+            if self.journal is not None:
+                self.journal.append(('page_buffer', offset, str(self.page_buffer[offset:offset + 2])))
+            self.page_buffer[offset:offset + 2] = self.data[0:2]
+        elif spmcsr & 0x1f == 0x03:
+            self.write_words(page, [0xffff] * (self.page_size >> 1))
+        elif spmcsr & 0x1f == 0x05:
+            # programming only clears the bits of the erased flash
+            data = [self.flash[page + i] & self.page_buffer[i] for i in xrange(self.page_size)]
+            self.write_words(page, [data[i] | data[i + 1] << 8 for i in xrange(0, self.page_size, 2)])
+            self.clear_page_buffer()
+        elif spmcsr & 0x11 == 0x11:
+            self.clear_page_buffer()
+        self.data[self.io + 0x37] = spmcsr & ~0x1f
+        self.limit = 0
+
+    def clear_page_buffer(self):
+        """ Erases the page buffer of spm. """
+        if self.journal is not None:
+            self.journal.append(('page_buffer', 0, str(self.page_buffer)))
+        self.page_buffer[:] = '\xff' * self.page_size
+
+    def run(self, max_cycles=None, until_pc=None, until_break=False):
+        """ Executes the program without any output. Stops when
+        max_cycles cycles are spent, when the pointer reaches until_pc
+        or, if until_break is set, a break instruction. Breakpoints and
+        watchpoints from self.watches stop it too. Returns the reason
+        of the stop: 'cycles', 'pc', 'break', 'breakpoint' or 'watch'.
+        The code runs up to s.limit, the nearest event, then the events
+        and the interrupts are served. The code at the addresses from
+        block_stops asks stop_at() first, the other code runs with no
+        check. """
+        budget = max_cycles
+        if budget is None:
+            budget = sys.maxint
+        watches = self.watches
+        if watches is not None:
+            watches.hit = None
+        added = until_pc is not None and until_pc not in self.block_stops
+        pc = self.pointer
+        try:
+            if added:
+                self.block_stops.add(until_pc)
+                self.recompile_at([until_pc])
+            code = self.use_blocks and self.blocks or self.code
+            (self.stopping, self.stopped_by) = ((until_pc, until_break), None)
+            again = self.service()
+            # the run starts with the instruction at the pointer
+            pc = self.resume = self.pointer
+            while self.cycles < budget:
+                # entering an interrupt may hit a watchpoint on the stack
+                if watches is not None and watches.hit is not None:
+                    return 'watch'
+                self.limit = self.next_limit(budget, again)
+                while self.cycles < self.limit:
+                    pc = code[pc >> 1](self)
+                self.pointer = pc
+                if self.stopped_by is not None:
+                    return self.stopped_by
+                # the events may take the pointer away from a stop
+                if pc in self.block_stops:
+                    if self.stop_at(pc):
+                        return self.stopped_by
+                    self.resume = pc
+                if watches is not None and watches.hit is not None:
+                    return 'watch'
+                again = self.service()
+                # spm may have changed the code and the breaks
+                code = self.use_blocks and self.blocks or self.code
+                if self.pointer != pc:
+                    pc = self.pointer
+                    self.resume = None
+        finally:
+            self.pointer = pc
+            (self.stopping, self.resume) = (None, None)
+            self.sreg_flush()
+            if added:
+                self.block_stops.discard(until_pc)
+                self.recompile_at([until_pc])
+        return 'cycles'
+
+    def stop_at(self, pc):
+        """ Called by the code at an address from block_stops before
+        its instruction. Returns True and lowers s.limit if the run
+        stops at pc, the reason is kept in stopped_by. The instruction
+        the run starts with is not checked. """
+        if self.stopping is None:
+            return False
+        if pc == self.resume:
+            self.resume = None
+            return False
+        reason = self.stop_reason(pc, *self.stopping)
+        if reason is None:
+            return False
+        self.stopped_by = reason
+        self.limit = 0
+        return True
+
+    def stop_reason(self, pc, until_pc, until_break):
+        """ Returns the reason to stop at pc or None to go on. """
+        if pc == until_pc:
+            return 'pc'
+        if until_break and pc in self.breaks:
+            return 'break'
+        if self.watches is not None and self.watches.reached(pc):
+            return 'breakpoint'
+        return None
+
+    def next_limit(self, budget, again=False):
+        """ Returns the cycle to run up to: the nearest event or budget,
+        or the end of the next instruction if again is set. """
+        limit = budget
+        cycle = self.scheduler.next_cycle()
+        if cycle is not None and cycle < limit:
+            limit = cycle
+        if again:
+            limit = min(limit, self.cycles + 1)
+        return limit
+
+    def step(self, command, args, max_cycles=None):
+        """ Executes one instruction with the reference handlers and
+        serves the events. Sleep lasts up to the nearest event or
+        max_cycles. """
+        limit = self.scheduler.next_cycle()
+        if max_cycles is not None and (limit is None or max_cycles < limit):
+            limit = max_cycles
+        if limit is None:
+            limit = self.cycles + 1
+        self.limit = limit
+        tracer = self.tracer
+        if tracer is None:
+            self.process(command, args)
+        else:
+            (pointer, cycles) = (self.pointer, self.cycles)
+            self.process(command, args)
+            opcode = tracer.opcode(pointer)
+            locations = self.compiler.destination(command, args)
+            for location in locations:
+                tracer.write(cycles, pointer, opcode, location, self.data[location])
+            if not locations:
+                tracer.write(cycles, pointer, opcode, NOWHERE, 0)
+        self.service()
+
+    def service(self):
+        """ Runs the events due by now and enters the pending interrupt
+        of the highest priority. Returns True if the interrupts have to
+        be checked again after the next instruction. """
+        self.scheduler.run(self.cycles)
+        if self.inhibit == self.cycles:
+            return True
+        data = self.data
+        if data[self.sreg] & 0x80:
+            # the low level of INT0 raises the interrupt again while the
+            # pin stays low, after the handler cleared its flag too
+            portb = self.portb
+            data[self.io + portb.GIFR] |= portb.low_level(data[self.io + portb.PINB])
+            for name, vector, flags, flag, mask, bit, idle in self.interrupts:
+                if data[self.io + flags] & flag ^ idle and data[self.io + mask] & bit:
+                    self.enter_interrupt(name)
+                    break
+        return False
+
+    def enter_interrupt(self, name):
+        """ Calls the vector of the interrupt, its flag is cleared by
+        the hardware. """
+        for entry in self.interrupts:
+            if entry[0] == name:
+                (name, vector, flags, flag, mask, bit, idle) = entry
+                break
+        else:
+            raise Exception('ERROR: Unknown interrupt %s' % (name, ))
+        self.sreg_flush()
+        pointer = self.pointer
+        if self.sleeping:
+            # wake-up takes four more cycles
+            self.sleeping = False
+            pointer += 2
+            self.cycles += 4
+        self.push_address(pointer)
+        if self.watches is not None:
+            sp = self.data[self.spl]
+            for location in (sp + 2, sp + 1):
+                if self.watches.access(self, pointer, location, 'w'):
+                    self.limit = 0
+        self.data[self.sreg] &= ~0x80 & 255
+        if not idle:
+            self.data[self.io + flags] &= ~flag & 255
+        self.pointer = vector
+        self.cycles += 4
+
+    def reset(self, flags=0):
+        """ Resets the MCU, flags tell the reason in MCUSR. Registers
+        and SRAM keep their values. """
+        mcusr = self.data[self.io + 0x34]
+        for a in xrange(64):
+            self.data[self.io + a] = 0
+        self.data[self.io + 0x34] = mcusr | flags
+        self.data[self.spl] = self.ramend
+        self.pending = None
+        self.pointer = 0
+        self.sleeping = False
+        self.inhibit = -1
+        self.limit = 0
+        for peripheral in self.peripherals:
+            peripheral.reset()
+
+    # magic, version, pointer, cycles, inhibit, sleeping
+    snapshot_format = '<4sBHQqB'
+
+    def snapshot(self):
+        """ Returns the state of the machine as a binary string: the
+        data space, the EEPROM, the page buffer of spm, the peripherals
+        and the events. The program is not a part of it. """
+        self.sreg_flush()
+        parts = [struct.pack(self.snapshot_format, 'AT13', 4, self.pointer, self.cycles,
+                             self.inhibit, self.sleeping),
+                 bytes(self.data), str(buffer(self.eeprom.memory)), str(self.page_buffer)]
+        for peripheral in self.peripherals:
+            parts.append(struct.pack(peripheral.state_format, *peripheral.get_state()))
+        events = self.scheduler.get_events()
+        parts.append(struct.pack('<B', len(events)))
+        for name, cycle in events:
+            parts.append(struct.pack('<B%isQ' % len(name), len(name), name, cycle))
+        return ''.join(parts)
+
+    def restore(self, blob):
+        """ Sets the state of the machine from snapshot(). """
+        offset = struct.calcsize(self.snapshot_format)
+        (magic, version, pointer, cycles, inhibit, sleeping) = \
+                struct.unpack_from(self.snapshot_format, blob)
+        if magic != 'AT13' or version != 4:
+            raise Exception('ERROR: This is not a snapshot!')
+        (self.pointer, self.cycles, self.inhibit, self.sleeping) = (pointer, cycles, inhibit, bool(sleeping))
+        self.data[:] = blob[offset:offset + len(self.data)]
+        offset += len(self.data)
+        self.eeprom.image.write(blob[offset:offset + self.eeprom.image.size])
+        offset += self.eeprom.image.size
+        self.page_buffer[:] = blob[offset:offset + self.page_size]
+        offset += self.page_size
+        self.pending = None
+        for peripheral in self.peripherals:
+            peripheral.set_state(*struct.unpack_from(peripheral.state_format, blob, offset))
+            offset += struct.calcsize(peripheral.state_format)
+        (count, ) = struct.unpack_from('<B', blob, offset)
+        offset += 1
+        events = []
+        for i in xrange(count):
+            (length, ) = struct.unpack_from('<B', blob, offset)
+            events.append(struct.unpack_from('<%isQ' % length, blob, offset + 1))
+            offset += 1 + length + 8
+        self.set_events(events)
+
+    def set_events(self, events):
+        """ Schedules the events from scheduler.get_events() again. """
+        self.scheduler.clear()
+        for name, cycle in events:
+            self.scheduler.schedule(name, cycle, self.event_handlers[name])
+        self.limit = 0
+
     def get_pointer(self):
         return self.pointer
 
     def get_regs(self):
-        result = {}
-        for key in self.reg_vals.keys():
-            val = self.reg_vals[key]
-            result.update({key: (val, self.int2bin(val, 8))})
-        return result
+        return DataView(self.data, 0, 32)
 
     def get_ports(self):
-        result = []
-        for i in self.port_names.keys():
-            key = self.port_names[i]
-            val = self.port_vals[i]
-            result.append((i, key, val, self.int2bin(val, 8)))
-        return result
+        self.sreg_flush()
+        return DataView(self.data, self.io, 64)
 
     def get_port_by_name(self, port_name):
         for id, name in self.port_names.items():
@@ -110,39 +647,150 @@ class ATtiny13(ALU):
         return None
 
     def get_stack(self):
-        return self.stack
+        """ Returns (address, value) of the bytes on the stack from
+        the top. """
+        return [(addr, self.data[addr]) for addr in xrange(self.data[self.spl] + 1, self.ramend + 1)]
+
+    def instruction_size(self, addr):
+        """ Returns the size of the instruction at addr in bytes. """
+        entry = self.code_tree.get('%04x' % addr)
+        if entry is not None and entry[0] in self.long_commands:
+            return 4
+        return 2
+
+    def skip(self):
+        """ Skips the instruction at the pointer, a skip over two
+        words takes one more cycle. """
+        size = self.instruction_size(self.pointer)
+        self.pointer += size
+        self.cycles += size >> 1
+
+    def z(self):
+        return self.data[30] | self.data[31] << 8
+
+    def pointer_access(self, ptr, mode):
+        """ Returns the address in the pointer register ptr for ld and
+        st: mode -1 decrements the register before, 1 increments it
+        after the access. """
+        addr = self.data[ptr] | self.data[ptr + 1] << 8
+        if mode:
+            value = (addr + mode) & 0xffff
+            (self.data[ptr], self.data[ptr + 1]) = (value & 255, value >> 8)
+            if mode < 0:
+                addr = value
+        return addr
+
+    def pointer_name(self, ptr, mode):
+        name = {26: 'X', 28: 'Y', 30: 'Z'}[ptr]
+        if mode < 0:
+            return '-' + name
+        if mode > 0:
+            return name + '+'
+        return name
 
     def init_exception(self, name):
-        exceptions = {'tim0_ovf': 6,
-                      }
-        value = self.port_vals['3f']
+        value = self.get_sreg()
         if self.check_bit(value, 7):
-            self.stack.append(self.pointer)
-            self.pointer = exceptions[name]
+            self.enter_interrupt(name)
             print '%s interrupt' % (name, )
         else:
             print 'interrupts are not allowed'
 
-    def parse(self, addr, word):
-        """ Returns appropriate assembler mnemonic. """
-        b = self.int2bin(int(word, 16))
-
-        for mnemo in self.mnemonics.keys():
-            (regexp, mtype, func) = self.mnemonics[mnemo]
-            if regexp is None:
-                continue
-            m = re.match(regexp, b)
-            if m:
-                (fields, func) = self.logics.get(mtype, (tuple(), lambda addr: None))
+    def build_decoder(self):
+        """ Converts opcode definitions into mask/value pairs. Masks
+        are ordered from the most specific one, so decoding does not
+        depend on the order of the mnemonics. A mnemonic with several
+        encodings has the list of (regexp, operand logic) pairs. """
+        literal = re.compile(r'\(\?P<\w+>([01]+)\)')
+        token = re.compile(r'\(\?P<(\w+)>\[01\]\{(\d+)\}\)|([01])')
 
-                args = [addr]
-                for k in fields:
-                    args.append(m.group(k))
+        definitions = []
+        for mnemo, (regexp, mtype, func) in self.mnemonics.items():
+            if isinstance(regexp, list):
+                definitions.extend([(mnemo, r, m) for r, m in regexp])
+            elif regexp is not None:
+                definitions.append((mnemo, regexp, mtype))
 
-                if callable(func):
-                    return (mnemo, func(*args))
+        masks = {}
+        for mnemo, regexp, mtype in definitions:
+            pattern = literal.sub(r'\1', regexp.strip('^$'))
+            mask = value = 0
+            fields = {}
+            shift = 16
+            for name, width, bit in token.findall(pattern):
+                if bit:
+                    shift -= 1
+                    mask |= 1 << shift
+                    value |= int(bit) << shift
                 else:
-                    return (mnemo, ())
+                    shift -= int(width)
+                    fields[name] = (shift, (1 << int(width)) - 1)
+            if shift != 0:
+                raise Exception('ERROR: Bad opcode definition for %s' % (mnemo, ))
+            (names, func) = self.logics.get(mtype, (tuple(), None))
+            values = masks.setdefault(mask, {})
+            if value in values:
+                raise Exception('ERROR: %s and %s have the same opcode' % (mnemo, values[value][0]))
+            values[value] = (mnemo, tuple([fields[k] for k in names]), func)
+
+        self.decode_masks = [(mask, masks[mask]) for mask in
+                             sorted(masks.keys(), key=lambda m: -bin(m).count('1'))]
+        self.decode_cache = [None] * 65536
+
+    def decode(self, word):
+        """ Returns (mnemonic, operand fields, operand logic) for the
+        word or None if the word is unknown. """
+        entry = self.decode_cache[word]
+        if entry is None:
+            for mask, values in self.decode_masks:
+                entry = values.get(word & mask)
+                if entry is not None:
+                    (mnemo, fields, func) = entry
+                    entry = (mnemo, tuple([(word >> shift) & bits for shift, bits in fields]), func)
+                    break
+            else:
+                entry = False
+            self.decode_cache[word] = entry
+        return entry or None
+
+    def parse(self, addr, word, next_word=None):
+        """ Returns appropriate assembler mnemonic. The address of
+        lds and sts is next_word, it is read from flash if it is None. """
+        entry = self.decode(word)
+        if entry is None:
+            return None
+        (mnemo, fields, func) = entry
+        if func is None:
+            return (mnemo, None)
+        value = func(addr, *fields)
+        if value is None:
+            # reserved operands
+            return None
+        if mnemo in self.long_commands:
+            if next_word is None:
+                a = (addr + 2) % self.flash_size
+                next_word = self.flash[a] | self.flash[a + 1] << 8
+            return (mnemo, (value, next_word))
+
+        # operand synonyms
+        if mnemo in self.synonyms and value[0] == value[1]:
+            return (self.synonyms[mnemo], value[0])
+        return (mnemo, value)
+
+    def decode_image(self, image, size=None):
+        """ Returns the code tree of the flash image up to size bytes. """
+        if size is None:
+            size = len(image)
+        code_tree = {}
+        parse = self.parse
+        for addr in xrange(0, size & ~1, 2):
+            next_word = 0
+            if addr + 3 < len(image):
+                next_word = image[addr + 2] | image[addr + 3] << 8
+            mnemo = parse(addr, image[addr] | image[addr + 1] << 8, next_word)
+            if mnemo is not None:
+                code_tree['%04x' % addr] = mnemo
+        return code_tree
 
     def show(self, command, args):
         (regexp, mtype, func) = self.mnemonics[command]
@@ -151,38 +799,65 @@ class ATtiny13(ALU):
     def process(self, command, args):
         (regexp, mtype, func) = self.mnemonics[command]
         func(args, False)
+        self.cycles += self.cycle_costs.get(command, 1)
 
     def common_logic(self, command, action, args, print_line):
         (rd, k) = args
-        value = action(self.reg_vals[rd], k)
+        value = action(self.data[rd], k)
         if not print_line:
-            # s = n xor v
-            self.sreg_clear('v')
-            # n = r7
-            # z = neg(r7) and neg(r6) and .. and neg(r0)
-            self.reg_vals[rd] = value
+            self.data[rd] = value
+            self.sreg_update(LOGIC, flags_logic, 0, 0, value)
             self.pointer += 2
         else:
-            print '%04x : %s\t%s, 0b%s' % (self.pointer, command, rd, self.int2bin(k, 8))
+            print '%04x : %s\tr%i, 0b%s' % (self.pointer, command, rd, self.int2bin(k, 8))
 
-    def common_checkio(self, command, args, print_line):
+    def common_sub(self, command, args, immediate, carry, store, print_line):
+        (rd, rr) = args
+        if not print_line:
+            a = self.data[rd]
+            b = rr
+            if not immediate:
+                b = self.data[rr]
+            value = a - b
+            if carry:
+                value -= self.sreg_check('c')
+                self.sreg_chain(ARITHMETIC, flags_sub(a, b, value))
+            else:
+                self.sreg_update(ARITHMETIC, flags_sub, a, b, value)
+            if store:
+                self.data[rd] = value & 255
+            self.pointer += 2
+        elif immediate:
+            print '%04x : %s\tr%i, 0x%02X' % (self.pointer, command, rd, rr)
+        else:
+            print '%04x : %s\tr%i, r%i' % (self.pointer, command, rd, rr)
+
+    def common_checkio(self, command, state, args, print_line):
         (a, b) = args
-        a_hex = '%02x' % a
         if not print_line:
-            if not self.check_bit(self.port_vals[a_hex], b):
-                self.pointer += 2;
             self.pointer += 2
+            if self.check_bit(self.io_read(a), b) == state:
+                self.skip()
         else:
             print '%04x : %s\t$%02x, %s' % (self.pointer, command, a, b)
 
+    def branch_op(self, command):
+        """ Returns the reference handler of the conditional branch. """
+        def op(args, print_line):
+            self.common_branch(command, 128, args, print_line)
+        return op
+
     def common_branch(self, command, range, args, print_line):
         (k, is_negative) = args
         if is_negative:
             k -= range
         if not print_line:
-            if command == 'brne' and self.sreg_check('z'):
+            (flag, state) = self.branch_flags[command]
+            if self.sreg_check(flag) == state:
                 self.pointer += 2 * k + 2
-            #self.pointer += 2
+                self.cycles += 1
+            else:
+                self.pointer += 2
         else:
             print '%04x : %s\t%04x' % (self.pointer, command, self.pointer + 2 * k + 2),
             print '\t\t[i:%s][t:%s][h:%s][s:%s][v:%s][n:%s][z:%s][c:%s]' % tuple(self.int2bin(self.get_sreg(), 8))
@@ -190,37 +865,84 @@ class ATtiny13(ALU):
     def adc(self, args, print_line):
         (rd, rr) = args
         if not print_line:
-            self.reg_vals[rd] += self.reg_vals[rr]
-            if self.check_bit(self.port_vals['3f'], 0):
-                self.reg_vals[rd] += 1
-            # SET FLAGS HERE
+            (a, b) = (self.data[rd], self.data[rr])
+            value = a + b
+            if self.sreg_check('c'):
+                value += 1
+            self.data[rd] = value & 255
+            self.sreg_update(ARITHMETIC, flags_add, a, b, value)
             self.pointer += 2
         else:
-            print '%04x : adc\t%s, %s' % (self.pointer, rd, rr)
+            print '%04x : adc\tr%i, r%i' % (self.pointer, rd, rr)
 
     def add(self, args, print_line):
         (rd, rr) = args
         if not print_line:
-            self.reg_vals[rd] += self.reg_vals[rr]
-            # SET FLAGS HERE
+            (a, b) = (self.data[rd], self.data[rr])
+            value = a + b
+            self.data[rd] = value & 255
+            self.sreg_update(ARITHMETIC, flags_add, a, b, value)
             self.pointer += 2
         else:
-            print '%04x : add\t%s, %s' % (self.pointer, rd, rr)
+            print '%04x : add\tr%i, r%i' % (self.pointer, rd, rr)
+
+    def adiw(self, args, print_line):
+        (rd, k) = args
+        if not print_line:
+            a = self.data[rd] | self.data[rd + 1] << 8
+            value = a + k
+            self.data[rd] = value & 255
+            self.data[rd + 1] = value >> 8 & 255
+            self.sreg_update(SHIFT, flags_adiw, a, k, value)
+            self.pointer += 2
+        else:
+            print '%04x : adiw\tr%i, %i' % (self.pointer, rd, k)
+
+    def and_op(self, args, print_line):
+        (rd, rr) = args
+        if not print_line:
+            self.data[rd] &= self.data[rr]
+            self.sreg_update(LOGIC, flags_logic, 0, 0, self.data[rd])
+            self.pointer += 2
+        else:
+            print '%04x : and\tr%i, r%i' % (self.pointer, rd, rr)
 
     def andi(self, args, print_line):
         self.common_logic('andi', operator.__and__, args, print_line)
 
+    def asr(self, rd, print_line):
+        if not print_line:
+            a = self.data[rd]
+            value = a >> 1 | a & 128
+            self.data[rd] = value
+            self.sreg_update(SHIFT, flags_ror, a, 0, value)
+            self.pointer += 2
+        else:
+            print '%04x : asr\tr%i' % (self.pointer, rd)
+
+    def bclr(self, s, print_line):
+        if not print_line:
+            self.sreg_clear(self.flag_names[s])
+            self.pointer += 2
+        else:
+            print '%04x : bclr\t%i' % (self.pointer, s)
+
     def bld(self, args, print_line):
         (rd, b) = args
         if not print_line:
-            value = self.port_vals['3f']
-            if self.check_bit(value, 6):
-                self.set_bit(self.reg_vals[rd], b)
+            if self.sreg_check('t'):
+                self.data[rd] = self.set_bit(self.data[rd], b)
             else:
-                self.clear_bit(self.reg_vals[rd], b)
+                self.data[rd] = self.clear_bit(self.data[rd], b)
             self.pointer += 2
         else:
-            print '%04x : bst\t%s, %s' % (self.pointer, rd, b)
+            print '%04x : bld\tr%i, %s' % (self.pointer, rd, b)
+
+    def break_op(self, no, print_line):
+        if not print_line:
+            self.pointer += 2
+        else:
+            print '%04x : break' % (self.pointer, )
 
     def brcc(self, args, print_line):
         self.common_branch('brcc', 128, args, print_line)
@@ -228,20 +950,32 @@ class ATtiny13(ALU):
     def brne(self, args, print_line):
         self.common_branch('brne', 128, args, print_line)
 
+    def bset(self, s, print_line):
+        if not print_line:
+            self.sreg_set(self.flag_names[s])
+            self.pointer += 2
+        else:
+            print '%04x : bset\t%i' % (self.pointer, s)
+
     def bst(self, args, print_line):
         (rd, b) = args
         if not print_line:
-            value = self.reg_vals[rd]
+            value = self.data[rd]
             if self.check_bit(value, b):
                 self.sreg_set('t')
             else:
                 self.sreg_clear('t')
             self.pointer += 2
         else:
-            print '%04x : bst\t%s, %s' % (self.pointer, rd, b)
+            print '%04x : bst\tr%i, %s' % (self.pointer, rd, b)
 
     def cbi(self, args, print_line):
-        self.common_checkio('sbic', args, print_line)
+        (a, b) = args
+        if not print_line:
+            self.io_write(a, self.clear_bit(self.io_read(a), b), 1 << b)
+            self.pointer += 2
+        else:
+            print '%04x : cbi\t$%02x, %s' % (self.pointer, a, b)
 
     def cli(self, no, print_line):
         if not print_line:
@@ -252,91 +986,220 @@ class ATtiny13(ALU):
 
     def clr(self, rd, print_line):
         if not print_line:
-            self.sreg_set('z')
-            self.sreg_clear(('n', 'v', 's'))
-            self.reg_vals[rd] = 0
+            self.data[rd] = 0
+            self.sreg_update(LOGIC, flags_logic, 0, 0, 0)
             self.pointer += 2
         else:
-            print '%04x : clr\t%s' % (self.pointer, rd)
+            print '%04x : clr\tr%i' % (self.pointer, rd)
+
+    def com(self, rd, print_line):
+        if not print_line:
+            value = 255 - self.data[rd]
+            self.data[rd] = value
+            self.sreg_update(SHIFT, flags_com, 0, 0, value)
+            self.pointer += 2
+        else:
+            print '%04x : com\tr%i' % (self.pointer, rd)
+
+    def cp(self, args, print_line):
+        self.common_sub('cp', args, False, False, False, print_line)
+
+    def cpc(self, args, print_line):
+        self.common_sub('cpc', args, False, True, False, print_line)
+
+    def cpi(self, args, print_line):
+        self.common_sub('cpi', args, True, False, False, print_line)
+
+    def cpse(self, args, print_line):
+        (rd, rr) = args
+        if not print_line:
+            self.pointer += 2
+            if self.data[rd] == self.data[rr]:
+                self.skip()
+        else:
+            print '%04x : cpse\tr%i, r%i' % (self.pointer, rd, rr)
 
     def dec(self, rd, print_line):
         if not print_line:
-            value = self.reg_vals[rd]
+            value = self.data[rd]
             value -= 1
             if value == -1:
                 value = 255
-            self.reg_vals[rd] = value
-            bval = self.int2bin(value, 8)[::-1]
+            self.data[rd] = value
+            self.sreg_update(LOGIC, flags_dec, 0, 0, value)
+            self.pointer += 2
+        else:
+            print '%04x : dec\tr%i' % (self.pointer, rd)
 
-            self.sreg_change('s', self.sreg_check('n') ^ self.sreg_check('v') and self.set_bit or self.clear_bit)
-            self.sreg_change('v', value == 127 and self.set_bit or self.clear_bit)
-            self.sreg_change('n', bval[7] == 1 and self.set_bit or self.clear_bit)
-            self.sreg_change('z', value == 0 and self.set_bit or self.clear_bit)
+    def eor(self, args, print_line):
+        (rd, rr) = args
+        if not print_line:
+            self.data[rd] ^= self.data[rr]
+            self.sreg_update(LOGIC, flags_logic, 0, 0, self.data[rd])
             self.pointer += 2
         else:
-            print '%04x : dec\t%s' % (self.pointer, rd)
+            print '%04x : eor\tr%i, r%i' % (self.pointer, rd, rr)
+
+    def icall(self, no, print_line):
+        if not print_line:
+            self.push_address(self.pointer + 2)
+            self.pointer = self.z() << 1
+        else:
+            print '%04x : icall' % (self.pointer, )
+
+    def ijmp(self, no, print_line):
+        if not print_line:
+            self.pointer = self.z() << 1
+        else:
+            print '%04x : ijmp' % (self.pointer, )
 
     def in_op(self, args, print_line):
         (rd, a) = args
-        key = '%02x' % a
-        value = self.port_vals[key]
         if not print_line:
-            self.reg_vals[a] = value
+            self.data[rd] = self.io_read(a)
             self.pointer += 2
         else:
-            print '%04x : in\t%s, $%02x' % (self.pointer, rd, a)
+            print '%04x : in\tr%i, $%02x' % (self.pointer, rd, a)
+
+    def inc(self, rd, print_line):
+        if not print_line:
+            value = (self.data[rd] + 1) & 255
+            self.data[rd] = value
+            self.sreg_update(LOGIC, flags_inc, 0, 0, value)
+            self.pointer += 2
+        else:
+            print '%04x : inc\tr%i' % (self.pointer, rd)
+
+    def ld(self, args, print_line):
+        (rd, ptr, mode) = args
+        if not print_line:
+            self.data[rd] = self.read_data(self.pointer_access(ptr, mode))
+            self.pointer += 2
+        else:
+            print '%04x : ld\tr%i, %s' % (self.pointer, rd, self.pointer_name(ptr, mode))
+
+    def ldd(self, args, print_line):
+        (rd, ptr, q) = args
+        if not print_line:
+            self.data[rd] = self.read_data((self.data[ptr] | self.data[ptr + 1] << 8) + q)
+            self.pointer += 2
+        else:
+            print '%04x : ldd\tr%i, %s+%i' % (self.pointer, rd, self.pointer_name(ptr, 0), q)
 
     def ldi(self, args, print_line):
         (rd, k) = args
         if not print_line:
-            self.reg_vals[rd] = k
+            self.data[rd] = k
+            self.pointer += 2
+        else:
+            print '%04x : ldi\tr%i, 0x%02X' % (self.pointer, rd, k)
+
+    def lds(self, args, print_line):
+        (rd, k) = args
+        if not print_line:
+            self.data[rd] = self.read_data(k)
+            self.pointer += 4
+        else:
+            print '%04x : lds\tr%i, 0x%04x' % (self.pointer, rd, k)
+
+    def lpm(self, args, print_line):
+        (rd, increment) = args
+        if not print_line:
+            z = self.z()
+            self.data[rd] = self.flash[z % self.flash_size]
+            if increment:
+                z = (z + 1) & 0xffff
+                (self.data[30], self.data[31]) = (z & 255, z >> 8)
+            self.pointer += 2
+        else:
+            print '%04x : lpm\tr%i, Z%s' % (self.pointer, rd, increment and '+' or '')
+
+    def lsl(self, rd, print_line):
+        if not print_line:
+            a = self.data[rd]
+            value = a << 1
+            self.data[rd] = value & 255
+            self.sreg_update(ARITHMETIC, flags_add, a, a, value)
+            self.pointer += 2
+        else:
+            print '%04x : lsl\tr%i' % (self.pointer, rd)
+
+    def lsr(self, rd, print_line):
+        if not print_line:
+            a = self.data[rd]
+            value = a >> 1
+            self.data[rd] = value
+            self.sreg_update(SHIFT, flags_ror, a, 0, value)
             self.pointer += 2
         else:
-            print '%04x : ldi\t%s, 0x%02X' % (self.pointer, rd, k)
+            print '%04x : lsr\tr%i' % (self.pointer, rd)
 
     def mov(self, args, print_line):
         (rd, rr) = args
         if not print_line:
-            self.reg_vals[rd] = self.reg_vals[rr]
+            self.data[rd] = self.data[rr]
             self.pointer += 2
         else:
-            print '%04x : mov\t%s, %s' % (self.pointer, rd, rr)
+            print '%04x : mov\tr%i, r%i' % (self.pointer, rd, rr)
+
+    def movw(self, args, print_line):
+        (rd, rr) = args
+        if not print_line:
+            self.data[rd] = self.data[rr]
+            self.data[rd + 1] = self.data[rr + 1]
+            self.pointer += 2
+        else:
+            print '%04x : movw\tr%i, r%i' % (self.pointer, rd, rr)
+
+    def neg(self, rd, print_line):
+        if not print_line:
+            a = self.data[rd]
+            value = -a
+            self.data[rd] = value & 255
+            self.sreg_update(ARITHMETIC, flags_sub, 0, a, value)
+            self.pointer += 2
+        else:
+            print '%04x : neg\tr%i' % (self.pointer, rd)
+
+    def nop(self, no, print_line):
+        if not print_line:
+            self.pointer += 2
+        else:
+            print '%04x : nop' % (self.pointer, )
 
     def or_op(self, args, print_line):
         (rd, rr) = args
         if not print_line:
-            self.reg_vals[rd] |= self.reg_vals[rr]
-            # SET FLAGS HERE
+            self.data[rd] |= self.data[rr]
+            self.sreg_update(LOGIC, flags_logic, 0, 0, self.data[rd])
             self.pointer += 2
         else:
-            print '%04x : or\t%s, %s' % (self.pointer, rd, rr)
+            print '%04x : or\tr%i, r%i' % (self.pointer, rd, rr)
 
     def ori(self, args, print_line):
         self.common_logic('ori', operator.__or__, args, print_line)
 
     def out(self, args, print_line):
         (a, rr) = args
-        value = self.reg_vals[rr]
-        key = '%02x' % a
         if not print_line:
-            self.port_vals[key] = value
+            self.io_write(a, self.data[rr])
             self.pointer += 2
         else:
-            print '%04x : out\t$%02x, %s' % (self.pointer, a, rr)
+            print '%04x : out\t$%02x, r%i' % (self.pointer, a, rr)
 
     def pop(self, rd, print_line):
         if not print_line:
-            self.reg_vals[rd] = self.stack.pop()
+            self.data[rd] = self.pop_byte()
             self.pointer += 2
         else:
-            print '%04x : pop\t%s' % (self.pointer, rd)
+            print '%04x : pop\tr%i' % (self.pointer, rd)
 
     def push(self, rr, print_line):
         if not print_line:
-            self.stack.append(self.reg_vals[rr])
+            self.push_byte(self.data[rr])
             self.pointer += 2
         else:
-            print '%04x : push\t%s' % (self.pointer, rr)
+            print '%04x : push\tr%i' % (self.pointer, rr)
 
     def rcall(self, args, print_line):
         (k, is_negative) = args
@@ -344,22 +1207,22 @@ class ATtiny13(ALU):
             k -= 4096
         if not print_line:
             # SET FLAGS HERE
-            self.stack.append(self.pointer)
+            self.push_address(self.pointer + 2)
             self.pointer += 2 * k + 2
         else:
             print '%04x : rcall\t%04x' % (self.pointer, self.pointer + 2 * k + 2)
 
     def ret(self, no, print_line):
         if not print_line:
-            self.pointer = self.stack.pop()
-            self.pointer += 2
+            self.pointer = self.pop_address()
         else:
             print '%04x : ret' % (self.pointer, )
 
     def reti(self, no, print_line):
         if not print_line:
             self.sreg_set('i')
-            self.pointer = self.stack.pop()
+            self.inhibit = self.cycles + self.cycle_costs['reti']
+            self.pointer = self.pop_address()
         else:
             print '%04x : reti' % (self.pointer, )
 
@@ -372,46 +1235,155 @@ class ATtiny13(ALU):
         else:
             print '%04x : rjmp\t%04x' % (self.pointer, self.pointer + 2 * k + 2)
 
-    def rol(self, args, print_line):
-        (rd, rr) = args
-        value = self.reg_vals[rd]
+    def rol(self, rd, print_line):
         if not print_line:
-            func = self.clear_bit
-            if self.check_bit(value, 7):
-                func = self.set_bit
-            self.reg_vals[rd] = func(value << 1, 0) & 255
-            # SET FLAGS HERE
+            a = self.data[rd]
+            value = a << 1
+            if self.sreg_check('c'):
+                value += 1
+            self.data[rd] = value & 255
+            self.sreg_update(ARITHMETIC, flags_add, a, a, value)
             self.pointer += 2
         else:
-            print '%04x : rol\t%s' % (self.pointer, rd)
+            print '%04x : rol\tr%i' % (self.pointer, rd)
 
     def ror(self, rd, print_line):
         if not print_line:
-            func = self.clear_bit
-            if self.check_bit(self.reg_vals[rd], 0):
-                func = self.set_bit
-            self.reg_vals[rd] >> 1
-            func(self.reg_vals[rd], 7)
-            # SET FLAGS HERE
+            a = self.data[rd]
+            value = a >> 1
+            if self.sreg_check('c'):
+                value |= 128
+            self.data[rd] = value
+            self.sreg_update(SHIFT, flags_ror, a, 0, value)
+            self.pointer += 2
+        else:
+            print '%04x : ror\tr%i' % (self.pointer, rd)
+
+    def sbc(self, args, print_line):
+        self.common_sub('sbc', args, False, True, True, print_line)
+
+    def sbci(self, args, print_line):
+        self.common_sub('sbci', args, True, True, True, print_line)
+
+    def sbi(self, args, print_line):
+        (a, b) = args
+        if not print_line:
+            self.io_write(a, self.set_bit(self.io_read(a), b), 1 << b)
             self.pointer += 2
         else:
-            print '%04x : rol\t%s' % (self.pointer, rd)
+            print '%04x : sbi\t$%02x, %s' % (self.pointer, a, b)
 
     def sbic(self, args, print_line):
-        self.common_checkio('sbic', args, print_line)
+        self.common_checkio('sbic', False, args, print_line)
+
+    def sbis(self, args, print_line):
+        self.common_checkio('sbis', True, args, print_line)
+
+    def sbiw(self, args, print_line):
+        (rd, k) = args
+        if not print_line:
+            a = self.data[rd] | self.data[rd + 1] << 8
+            value = a - k
+            self.data[rd] = value & 255
+            self.data[rd + 1] = value >> 8 & 255
+            self.sreg_update(SHIFT, flags_sbiw, a, k, value)
+            self.pointer += 2
+        else:
+            print '%04x : sbiw\tr%i, %i' % (self.pointer, rd, k)
+
+    def sbrc(self, args, print_line):
+        (rr, b) = args
+        if not print_line:
+            self.pointer += 2
+            if not self.check_bit(self.data[rr], b):
+                self.skip()
+        else:
+            print '%04x : sbrc\tr%i, %s' % (self.pointer, rr, b)
 
     def sbrs(self, args, print_line):
         (rr, b) = args
         if not print_line:
-            if self.check_bit(self.reg_vals[rr], b):
-                self.pointer += 2
             self.pointer += 2
+            if self.check_bit(self.data[rr], b):
+                self.skip()
         else:
-            print '%04x : sbrs\t%s, %s' % (self.pointer, rr, b)
+            print '%04x : sbrs\tr%i, %s' % (self.pointer, rr, b)
 
     def sei(self, args, print_line):
         if not print_line:
             self.sreg_set('i')
+            self.inhibit = self.cycles + self.cycle_costs.get('sei', 1)
             self.pointer += 2
         else:
             print '%04x : sei' % (self.pointer, )
+
+    def sleep(self, no, print_line):
+        if not print_line:
+            # nothing happens until the next event, so its time comes at
+            # once; the pointer stays here until an interrupt wakes up
+            if self.check_bit(self.data[self.io + 0x35], 5):
+                self.sleeping = True
+                self.cycles = max(self.cycles, self.limit - self.cycle_costs.get('sleep', 1))
+            else:
+                self.pointer += 2
+        else:
+            print '%04x : sleep' % (self.pointer, )
+
+    def spm(self, no, print_line):
+        if not print_line:
+            self.program_flash()
+            self.pointer += 2
+        else:
+            print '%04x : spm' % (self.pointer, )
+
+    def st(self, args, print_line):
+        (rr, ptr, mode) = args
+        if not print_line:
+            self.write_data(self.pointer_access(ptr, mode), self.data[rr])
+            self.pointer += 2
+        else:
+            print '%04x : st\t%s, r%i' % (self.pointer, self.pointer_name(ptr, mode), rr)
+
+    def std(self, args, print_line):
+        (rr, ptr, q) = args
+        if not print_line:
+            self.write_data((self.data[ptr] | self.data[ptr + 1] << 8) + q, self.data[rr])
+            self.pointer += 2
+        else:
+            print '%04x : std\t%s+%i, r%i' % (self.pointer, self.pointer_name(ptr, 0), q, rr)
+
+    def sts(self, args, print_line):
+        (rr, k) = args
+        if not print_line:
+            self.write_data(k, self.data[rr])
+            self.pointer += 4
+        else:
+            print '%04x : sts\t0x%04x, r%i' % (self.pointer, k, rr)
+
+    def sub(self, args, print_line):
+        self.common_sub('sub', args, False, False, True, print_line)
+
+    def subi(self, args, print_line):
+        self.common_sub('subi', args, True, False, True, print_line)
+
+    def swap(self, rd, print_line):
+        if not print_line:
+            value = self.data[rd]
+            self.data[rd] = (value << 4 | value >> 4) & 255
+            self.pointer += 2
+        else:
+            print '%04x : swap\tr%i' % (self.pointer, rd)
+
+    def tst(self, rd, print_line):
+        if not print_line:
+            self.sreg_update(LOGIC, flags_logic, 0, 0, self.data[rd])
+            self.pointer += 2
+        else:
+            print '%04x : tst\tr%i' % (self.pointer, rd)
+
+    def wdr(self, no, print_line):
+        if not print_line:
+            self.watchdog.restart(self.cycles)
+            self.pointer += 2
+        else:
+            print '%04x : wdr' % (self.pointer, )
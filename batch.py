@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# (c) 2009 Ruslan Popov <ruslan.popov@gmail.com>
+
+import json, multiprocessing, os, sys, tempfile
+from optparse import OptionParser
+
+from attiny13 import ATtiny13
+from images import save_image
+
+# A scenario is a dict:
+#   name        - any name to tell the results apart
+#   cycles      - cycles to run
+#   until_pc    - stop address, see ATtiny13.run()
+#   until_break - stop on the break instruction
+#   registers   - {number: value} set before running
+#   ports       - {name: value} set before running, PINB drives the pins
+#   adc         - samples of the ADC channels
+#   eeprom      - bytes of the EEPROM from address 0, the rest is erased
+#   trace       - collect (cycle, PINB) of the pin changes
+# Values may be written as strings like in emulator.py: 0b101, 0x2a, 99.
+
+# every worker process keeps its machine with the program loaded and
+# the state after power-on to start every scenario from, program is
+# the code tree, the code and the flash to load again after spm
+machine = None
+power_on = None
+program = None
+
+def number(value):
+    if isinstance(value, basestring):
+        return int(value, 0)
+    return value
+
+def init_worker(flash, size, lazy_flags=True):
+    """ Maps the flash image file, decodes and compiles it once per
+    process. """
+    global machine, power_on, program
+    machine = ATtiny13(lazy_flags=lazy_flags, flash=flash)
+    machine.load(machine.decode_image(machine.flash, size))
+    # spm and write_words() change the code tree and the code in place
+    program = (dict(machine.code_tree), list(machine.code), str(buffer(machine.flash)))
+    power_on = machine.snapshot()
+
+def run_scenario(scenario):
+    """ Runs the scenario from power-on, returns its result. The
+    program is loaded again if a scenario before changed the flash,
+    the snapshot of power-on does not keep it. """
+    (code_tree, code, image) = program
+    if str(buffer(machine.flash)) != image:
+        machine.load(dict(code_tree), list(code), image)
+    machine.portb.trace = None
+    machine.restore(power_on)
+    machine.eeprom.image.write([number(value) for value in scenario.get('eeprom', [])])
+    for reg, value in scenario.get('registers', {}).items():
+        machine.set_reg(number(reg), number(value))
+    for name, value in scenario.get('ports', {}).items():
+        if name.upper() == 'PINB':
+            machine.portb.set_inputs(number(value))
+            continue
+        port = machine.get_port_by_name(name.upper())
+        if port is None:
+            raise Exception('ERROR: Unknown port %s' % (name, ))
+        machine.io_write(port, number(value))
+    for channel, value in enumerate(scenario.get('adc', [])):
+        machine.adc.set_sample(channel, number(value))
+    if scenario.get('trace'):
+        machine.portb.trace = []
+
+    until_pc = scenario.get('until_pc')
+    if until_pc is not None:
+        until_pc = number(until_pc)
+    reason = machine.run(number(scenario['cycles']), until_pc, scenario.get('until_break', False))
+    return {'name': scenario.get('name'),
+            'reason': reason,
+            'pointer': machine.get_pointer(),
+            'cycles': machine.cycles,
+            'registers': list(machine.get_regs()),
+            'ports': list(machine.get_ports()),
+            'eeprom': list(bytearray(machine.eeprom.memory)),
+            'trace': machine.portb.trace}
+
+def run_batch(image, size, scenarios, processes=None, lazy_flags=True):
+    """ Runs the scenarios on the program from the flash image in a
+    pool of processes. The image is written into a temporary file once,
+    every process maps it and they share its pages; the scenarios and
+    their results are small. Returns the results in the order of the
+    scenarios. """
+    (fd, flash) = tempfile.mkstemp(prefix='emuattiny-', suffix='.bin')
+    os.close(fd)
+    try:
+        save_image(flash, image)
+        if processes == 1:
+            init_worker(flash, size, lazy_flags)
+            return [run_scenario(scenario) for scenario in scenarios]
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(processes, init_worker, (flash, size, lazy_flags))
+        try:
+            chunksize = max(1, len(scenarios) // (4 * processes))
+            return pool.map(run_scenario, scenarios, chunksize)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        os.remove(flash)
+
+def read_scenarios(filename):
+    """ Reads a JSON list of scenarios or one scenario per line. """
+    text = open(filename, 'r').read().strip()
+    if text.startswith('['):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+if __name__ == '__main__':
+    from hex_loader import HexLoader
+
+    parser = OptionParser()
+    parser.add_option("-f", "--hex-file", action="store", dest="hexfile",
+                      help="HEX file", default=None)
+    parser.add_option("-s", "--scenarios", action="store", dest="scenarios",
+                      help="JSON file with the scenarios", default=None)
+    parser.add_option("-c", "--cycles", action="store", type="int", dest="cycles",
+                      help="cycles of the scenarios without their own", default=1000000)
+    parser.add_option("-j", "--jobs", action="store", type="int", dest="jobs",
+                      help="number of processes, all cores by default", default=None)
+    (options, args) = parser.parse_args()
+
+    for key in ['hexfile', 'scenarios']:
+        if not getattr(options, key, None):
+            print 'ERROR: Parameter %s is required!' % (key, )
+            parser.print_help()
+            sys.exit(1)
+
+    loader = HexLoader(ATtiny13(), options.hexfile)
+    image = loader.get_image()
+    scenarios = read_scenarios(options.scenarios)
+    for scenario in scenarios:
+        scenario.setdefault('cycles', options.cycles)
+    for result in run_batch(image, loader.size, scenarios, options.jobs):
+        print json.dumps(result)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# (c) 2009 Ruslan Popov <ruslan.popov@gmail.com>
+
+import json, multiprocessing, os, platform, resource, sys, time
+from optparse import OptionParser
+
+from attiny13 import ATtiny13
+from hex_loader import HexLoader
+from profiler import Profiler
+
+# the programs from bench/ with their sources there: name, cycles to run
+PROGRAMS = [('delay', 100000000),
+            ('uart', 10000000),
+            ('pwm', 20000000),
+            ('arith', 2000000)]
+
+def bench_file(name):
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench', '%s.hex' % name)
+
+def measure(task):
+    """ Runs one program, returns its result as a dict. Every program
+    goes to its own process, so the peak memory is its own too. """
+    (name, cycles, repeat, lazy_flags, blocks) = task
+    decode = run = None
+    for i in xrange(repeat):
+        alu = ATtiny13(lazy_flags=lazy_flags, blocks=blocks)
+        loader = HexLoader(alu, bench_file(name))
+        start = time.time()
+        code_tree = loader.get_code_tree()
+        code = loader.get_code(code_tree)
+        spent = time.time() - start
+        if decode is None or spent < decode:
+            decode = spent
+        alu.load(code_tree, code, loader.image)
+        start = time.time()
+        alu.run(cycles)
+        spent = time.time() - start
+        if run is None or spent < run:
+            run = spent
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # the instructions are counted apart, the counters cost time
+    alu = ATtiny13(lazy_flags=lazy_flags, blocks=blocks)
+    alu.load(code_tree, image=loader.image)
+    profiler = Profiler(alu)
+    alu.profile(profiler)
+    alu.run(cycles)
+    instructions = sum(profiler.executions())
+
+    return {'name': name,
+            'cycles': alu.cycles,
+            'instructions': instructions,
+            'decode_seconds': decode,
+            'run_seconds': run,
+            'cycles_per_second': alu.cycles / run,
+            'instructions_per_second': instructions / run,
+            'peak_memory_kb': peak}
+
+def run_bench(names=None, scale=1.0, repeat=3, lazy_flags=True, blocks=True):
+    """ Measures the programs, all of them if names is None. """
+    tasks = [(name, int(cycles * scale), repeat, lazy_flags, blocks)
+             for name, cycles in PROGRAMS if names is None or name in names]
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        results = pool.map(measure, tasks, 1)
+    finally:
+        pool.close()
+        pool.join()
+    return {'python': platform.python_version(),
+            'machine': platform.machine(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'lazy_flags': lazy_flags,
+            'blocks': blocks,
+            'results': results}
+
+def compare(old, new, tolerance):
+    """ Prints the speed of new against old. Returns the names of the
+    programs which became slower than tolerance allows. """
+    before = dict([(result['name'], result) for result in old['results']])
+    slower = []
+    for result in new['results']:
+        previous = before.get(result['name'])
+        if previous is None:
+            continue
+        ratio = result['cycles_per_second'] / previous['cycles_per_second']
+        print '%-8s %12.0f -> %12.0f cycles/s %+7.1f%%' % \
+              (result['name'], previous['cycles_per_second'], result['cycles_per_second'],
+               100.0 * (ratio - 1))
+        if ratio < 1 - tolerance:
+            slower.append(result['name'])
+    return slower
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options] [program ...]')
+    parser.add_option("-o", "--output", action="store", dest="output",
+                      help="write the results to this JSON file", default=None)
+    parser.add_option("-c", "--compare", action="store", dest="compare",
+                      help="compare with the results from this JSON file", default=None)
+    parser.add_option("-t", "--tolerance", action="store", type="float", dest="tolerance",
+                      help="allowed slowdown for --compare, 0.1 is 10%", default=0.1)
+    parser.add_option("-s", "--scale", action="store", type="float", dest="scale",
+                      help="scale the cycles of the programs", default=1.0)
+    parser.add_option("-r", "--repeat", action="store", type="int", dest="repeat",
+                      help="take the best of this number of runs", default=3)
+    parser.add_option("--eager-flags", action="store_false", dest="lazy_flags",
+                      help="compute the flags at once", default=True)
+    parser.add_option("--no-blocks", action="store_false", dest="blocks",
+                      help="run the threaded code only", default=True)
+    (options, args) = parser.parse_args()
+
+    known = [name for name, cycles in PROGRAMS]
+    for name in args:
+        if name not in known:
+            print 'ERROR: Unknown program %s, there are %s' % (name, ', '.join(known))
+            sys.exit(1)
+
+    report = run_bench(args or None, options.scale, options.repeat,
+                       options.lazy_flags, options.blocks)
+    for result in report['results']:
+        print '%(name)-8s %(cycles)12i cycles %(instructions)12i instructions ' \
+              '%(decode_seconds)8.4f s decode %(run_seconds)8.3f s run ' \
+              '%(cycles_per_second)12.0f cycles/s %(instructions_per_second)12.0f instructions/s ' \
+              '%(peak_memory_kb)8i KB' % result
+    if options.output:
+        open(options.output, 'w').write(json.dumps(report, indent=1, sort_keys=True) + '\n')
+    if options.compare:
+        slower = compare(json.load(open(options.compare)), report, options.tolerance)
+        if slower:
+            print 'ERROR: %s became slower!' % (', '.join(slower), )
+            sys.exit(1)
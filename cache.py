@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# (c) 2009 Ruslan Popov <ruslan.popov@gmail.com>
+
+import hashlib, marshal, os, sys, tempfile
+
+# bump it when the format of the entries changes, old entries will not
+# be found anymore and go away with the time
+VERSION = '2'
+
+# the modules the code tree and the compiled code come from, a change
+# of any of them changes the keys too
+SOURCES = ('alu', 'attiny13', 'compiler')
+
+def sources_digest():
+    """ Returns the SHA-256 of the files of SOURCES and the version
+    of Python, which marshals the code. The source file is taken if it
+    is there, otherwise the compiled one. """
+    digest = hashlib.sha256(sys.version)
+    for name in SOURCES:
+        filename = __import__(name).__file__
+        source = os.path.splitext(filename)[0] + '.py'
+        if os.path.exists(source):
+            filename = source
+        with open(filename, 'rb') as f:
+            digest.update(':')
+            digest.update(f.read())
+    return digest.hexdigest()
+
+class CodeCache(object):
+    """ On-disk cache of decoded programs. An entry is keyed by the
+    SHA-256 of the flash image, the version and the sources of the
+    decoder and the compiler, it keeps the code tree and the compiled
+    threaded code. The least recently used entries are removed when the
+    cache grows over max_size bytes. """
+
+    def __init__(self, path=None, max_size=64 << 20, *args, **kwargs):
+        if path is None:
+            path = os.environ.get('EMUATTINY_CACHE',
+                                  os.path.join(os.path.expanduser('~'), '.cache', 'emuattiny'))
+        self.path = path
+        self.max_size = max_size
+        self.sources = sources_digest()
+
+    def key(self, image, *options):
+        """ Returns the key of the image, options are the settings the
+        compiled code depends on. """
+        digest = hashlib.sha256(VERSION)
+        digest.update(':%s' % (self.sources, ))
+        for option in options:
+            digest.update(':%s' % (option, ))
+        digest.update(':')
+        digest.update(bytes(image))
+        return digest.hexdigest()
+
+    def get(self, key):
+        """ Returns the entry or None. """
+        filename = os.path.join(self.path, key)
+        try:
+            with open(filename, 'rb') as f:
+                entry = marshal.loads(f.read())
+            os.utime(filename, None)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+        return entry
+
+    def put(self, key, entry):
+        """ Stores the entry, the file is replaced at once, so parallel
+        runs never see a half written one. """
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            (fd, temp) = tempfile.mkstemp(dir=self.path, prefix='.')
+            try:
+                os.write(fd, marshal.dumps(entry))
+            finally:
+                os.close(fd)
+            os.rename(temp, os.path.join(self.path, key))
+        except (IOError, OSError, ValueError):
+            # the cache only saves time, running goes on without it
+            return
+        self.evict()
+
+    def evict(self):
+        """ Removes the least recently used entries over max_size. """
+        files = []
+        total = 0
+        for name in os.listdir(self.path):
+            filename = os.path.join(self.path, name)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, filename))
+            total += stat.st_size
+        files.sort()
+        for mtime, size, filename in files:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                continue
+            total -= size
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# (c) 2009 Ruslan Popov <ruslan.popov@gmail.com>
+
+class Checkpoints(object):
+    """ Snapshots of the machine taken every interval cycles while it
+    runs. A checkpoint keeps its snapshot as pages, and the pages which
+    did not change since the previous checkpoint are shared with it,
+    so a checkpoint costs only what changed. At most limit checkpoints
+    are kept, the oldest ones go first. """
+
+    page_size = 32
+
+    def __init__(self, alu, interval, limit=None, *args, **kwargs):
+        self.alu = alu
+        self.interval = interval
+        self.limit = limit
+        self.checkpoints = [] # (cycles, pages)
+
+    def __len__(self):
+        return len(self.checkpoints)
+
+    def take(self):
+        """ Stores the current state of the machine. """
+        blob = self.alu.snapshot()
+        size = self.page_size
+        pages = [blob[i:i + size] for i in xrange(0, len(blob), size)]
+        if self.checkpoints:
+            previous = self.checkpoints[-1][1]
+            for i, page in enumerate(pages[:len(previous)]):
+                if page == previous[i]:
+                    pages[i] = previous[i]
+        self.checkpoints.append((self.alu.cycles, pages))
+        if self.limit is not None and len(self.checkpoints) > self.limit:
+            del self.checkpoints[0]
+
+    def run(self, max_cycles, until_pc=None, until_break=False):
+        """ Runs the machine like ATtiny13.run() taking the checkpoints
+        on the way. """
+        if not self.checkpoints:
+            self.take()
+        while self.alu.cycles < max_cycles:
+            following = self.checkpoints[-1][0] + self.interval
+            reason = self.alu.run(min(max_cycles, following), until_pc, until_break)
+            if self.alu.cycles >= following:
+                self.take()
+            if reason != 'cycles':
+                return reason
+        return 'cycles'
+
+    def blob(self, index):
+        """ Returns the snapshot of the checkpoint, any machine with the
+        same program can be restored from it. """
+        return ''.join(self.checkpoints[index][1])
+
+    def find(self, cycles):
+        """ Returns the index of the latest checkpoint taken not later
+        than cycles or None. """
+        for index in xrange(len(self.checkpoints) - 1, -1, -1):
+            if self.checkpoints[index][0] <= cycles:
+                return index
+        return None
+
+    def rewind(self, cycles):
+        """ Restores the latest checkpoint taken not later than cycles
+        and drops the ones after it. Returns its cycles or None. """
+        index = self.find(cycles)
+        if index is None:
+            return None
+        self.alu.restore(self.blob(index))
+        del self.checkpoints[index + 1:]
+        return self.checkpoints[index][0]
@@ -0,0 +1,1018 @@
+# -*- coding: utf-8 -*-
+# (c) 2009 Ruslan Popov <ruslan.popov@gmail.com>
+
+from alu import ARITHMETIC, LOGIC, SHIFT, \
+     flags_add, flags_adiw, flags_com, flags_dec, flags_inc, flags_logic, \
+     flags_ror, flags_sbiw, flags_sub
+from tracer import NOWHERE, RECORD
+
+class Compiler(object):
+    """ Compiles decoded instructions into threaded code: a list of
+    functions indexed by word address. Each function executes its
+    instruction on the given state and returns the next pointer, so
+    running is just pointer = code[pointer >> 1](state). Straight-line
+    runs of instructions can be compiled into one function too, see
+    blocks(). """
+
+    def __init__(self, alu, *args, **kwargs):
+        self.alu = alu
+        self.sreg = 'd[%i]' % alu.sreg
+
+        # the longest block in instructions
+        self.block_size = 64
+
+        # what the block compiler knows about the previous instructions:
+        # flags set by the last flag-setting one (mask, func, a, b, r),
+        # the previous instruction itself (command, args) and the mask
+        # of the pending flags (0 if there are none, None if unknown)
+        self.reset()
+
+        # the cycle of the instruction is counter + acc, the hooks of the
+        # peripherals get it; a volatile instruction may lower s.limit,
+        # so it ends its block
+        self.counter = 's.cycles'
+        self.acc = 0
+        self.volatile = False
+
+        # the functions of the addresses without code, made once and
+        # shared by every compiled program
+        self.missing_code = None
+
+        # with a tracer every instruction writes its record, see
+        # tracer.Tracer
+        self.tracer = None
+        # with a profiler the code counts the executions of the
+        # instructions, see profiler.Profiler
+        self.profiler = None
+        # with watches the instructions accessing the watched locations
+        # check them, see watches.Watches; the stack instructions access
+        # their bytes of the stack as (access, count)
+        self.watches = None
+        self.stack_bytes = {'push': ('w', 1), 'rcall': ('w', 2), 'icall': ('w', 2),
+                            'pop': ('r', 1), 'ret': ('r', 2), 'reti': ('r', 2)}
+
+        self.handlers = {'adc': self.adc, 'add': self.add, 'adiw': self.word,
+                         'and': self.and_op, 'andi': self.andi, 'asr': self.asr,
+                         'bclr': self.bclr, 'bld': self.bld, 'break': self.nop,
+                         'bset': self.bset, 'bst': self.bst, 'cbi': self.cbi,
+                         'cli': self.cli, 'clr': self.clr, 'com': self.com,
+                         'cp': self.subtract, 'cpc': self.subtract, 'cpi': self.subtract,
+                         'cpse': self.cpse, 'dec': self.dec, 'eor': self.eor,
+                         'icall': self.icall, 'ijmp': self.ijmp, 'in': self.in_op,
+                         'inc': self.inc, 'ld': self.ld, 'ldd': self.ld, 'ldi': self.ldi,
+                         'lds': self.lds, 'lpm': self.lpm, 'lsl': self.lsl,
+                         'lsr': self.lsr, 'mov': self.mov, 'movw': self.movw,
+                         'neg': self.neg, 'nop': self.nop, 'or': self.or_op,
+                         'ori': self.ori, 'out': self.out, 'pop': self.pop,
+                         'push': self.push, 'rcall': self.rcall, 'ret': self.ret,
+                         'reti': self.reti, 'rjmp': self.rjmp, 'rol': self.rol,
+                         'ror': self.ror, 'sbc': self.subtract, 'sbci': self.subtract,
+                         'sbi': self.sbi, 'sbic': self.sbic, 'sbis': self.sbis,
+                         'sbiw': self.word, 'sbrc': self.sbrc, 'sbrs': self.sbrs,
+                         'sei': self.sei, 'sleep': self.sleep, 'spm': self.spm,
+                         'st': self.st, 'std': self.st, 'sts': self.sts,
+                         'sub': self.subtract, 'subi': self.subtract, 'swap': self.swap,
+                         'tst': self.tst, 'wdr': self.wdr}
+        for command in alu.branch_flags:
+            self.handlers[command] = self.branch
+
+        # instructions which always start their own block
+        self.barriers = ('sleep', )
+
+        # instructions which only spend cycles in countdown loops
+        self.idle = ('nop', )
+
+        # the instructions around the compiled one, skips need the size
+        # of the next one
+        self.code_tree = {}
+
+    def compile(self, code_tree, program=None, keys=None):
+        """ Returns the list of functions indexed by word address.
+        program is the code object from program() if it is known, keys
+        limit the compiled instructions. """
+        if self.missing_code is None:
+            self.missing_code = [self.missing(i * 2) for i in xrange(self.alu.flash_size / 2)]
+        code = list(self.missing_code)
+        if program is None:
+            program = self.program(code_tree, keys)
+
+        namespace = self.namespace()
+        exec program in namespace
+        for name, func in namespace.items():
+            if name.startswith('op_'):
+                code[int(name[3:], 16) >> 1] = func
+        return code
+
+    def program(self, code_tree, keys=None):
+        """ Returns the code object defining the functions of all the
+        instructions or the ones from keys, it can be marshalled. """
+        self.code_tree = code_tree
+        if keys is None:
+            keys = code_tree.keys()
+        source = []
+        for key in keys:
+            (command, args) = code_tree[key]
+            if command in self.handlers:
+                source.extend(self.function('op_%s' % key, int(key, 16), command, args))
+        return compile('\n'.join(source), '<threaded code>', 'exec')
+
+    def namespace(self):
+        """ Returns globals of the compiled code. """
+        namespace = {'flags_add': flags_add, 'flags_adiw': flags_adiw,
+                     'flags_com': flags_com, 'flags_dec': flags_dec,
+                     'flags_inc': flags_inc, 'flags_logic': flags_logic,
+                     'flags_ror': flags_ror, 'flags_sbiw': flags_sbiw,
+                     'flags_sub': flags_sub}
+        if self.tracer is not None:
+            namespace.update({'tracer': self.tracer, 'packs': self.tracer.packs,
+                              'buffer': self.tracer.buffer, 'position': self.tracer.position})
+        if self.profiler is not None:
+            namespace.update({'hits': self.profiler.hits, 'block_passes': self.profiler.passes,
+                              'taken': self.profiler.taken})
+        if self.watches is not None:
+            namespace['watches'] = self.watches
+        return namespace
+
+    def blocks(self, code_tree, stops=()):
+        """ Returns the list of blocks indexed by word address. A block
+        is compiled on its first call and replaces its entry in the
+        list, the addresses without code keep the threaded code of
+        alu. Blocks never pass through an address from stops. """
+        blocks = list(self.alu.code)
+        def entry(addr):
+            def op(s):
+                func = self.block(code_tree, addr, stops) or s.code[addr >> 1]
+                blocks[addr >> 1] = func
+                return func(s)
+            return op
+        for key in code_tree:
+            addr = int(key, 16)
+            blocks[addr >> 1] = entry(addr)
+        return blocks
+
+    def block(self, code_tree, start, stops):
+        """ Compiles the straight line of instructions from start up to
+        the first one which may jump. The block goes to the threaded
+        code when it can exceed s.limit cycles, and becomes a loop when
+        its last instruction can jump back to start, unless start is
+        one of stops. Returns None if there is nothing to compile at
+        start. """
+        (body, exits, cycles, following) = self.straight(code_tree, start, stops)
+        if not body:
+            return None
+
+        worst = cycles + max([0] + [extra for cond, target, extra in exits])
+        countdown = None
+        if start not in stops:
+            countdown = self.countdown(start, exits, cycles, following, worst)
+        if countdown:
+            return countdown
+        loop = None
+        indent = '    '
+        source = ['def block(s):',
+                  '    d = s.data',
+                  '    if s.cycles + %i > s.limit:' % worst,
+                  '        return s.code[%i](s)' % (start >> 1)]
+        if start in stops:
+            source += self.stop_check(start)
+        if start not in stops and self.commands[-1][0] in self.alu.branch_flags and \
+               [target for cond, target, extra in exits if cond is not None and target == start]:
+            loop = start
+            indent = '        '
+            # the pending flags of the next pass are the ones of this
+            # pass, so only the first pass needs to check them
+            (first, last) = (self.first_update, self.pending_mask)
+            if last == 0:
+                # a pass leaves nothing pending, the first one has to
+                # start so too
+                self.pending_mask = None
+                source += ['    %s' % line for line in self.flush()]
+            elif first is not None and last is not None:
+                self.pending_mask = None
+                source += ['    %s' % line for line in self.update_check(first)]
+            else:
+                last = None
+            (body, exits, cycles, following) = self.straight(code_tree, start, stops, last, 'c')
+            source += ['    c = s.cycles',
+                       '    limit = s.limit',
+                       '    while True:']
+        body = self.traced_body(body) + [self.profiled(start, following)]
+        for lines in body:
+            source.extend(['%s%s' % (indent, line) for line in lines])
+        source.extend(self.exits(exits, cycles, following, indent, loop, worst))
+        self.reset()
+
+        namespace = self.namespace()
+        exec '\n'.join(source) in namespace
+        return namespace['block']
+
+    def straight(self, code_tree, start, stops, pending_mask=None, counter='s.cycles'):
+        """ Returns the bodies of instructions from start, the exits of
+        the last one, their cycles and the address after them. """
+        self.reset()
+        self.code_tree = code_tree
+        self.pending_mask = pending_mask
+        self.counter = counter
+        body = []
+        exits = []
+        cycles = 0
+        addr = start
+        while len(body) < self.block_size:
+            entry = code_tree.get('%04x' % addr)
+            if entry is None or entry[0] not in self.handlers:
+                break
+            if addr != start and addr in stops:
+                break
+            (command, args) = entry
+            if addr != start and command in self.barriers:
+                break
+            self.commands.append(entry)
+            self.recorded = None
+            self.sreg_written = False
+            self.acc = cycles
+            (lines, exits) = self.instruction(addr, command, args)
+            body.append(lines)
+            cycles += self.alu.cycle_costs.get(command, 1)
+            addr += self.size(command)
+            if self.recorded is not None:
+                self.known = self.recorded
+            elif self.sreg_written:
+                self.known = None
+            self.previous = entry
+            if exits or self.volatile:
+                break
+        self.counter = 's.cycles'
+        self.acc = 0
+        return (body, exits, cycles, addr)
+
+    def reset(self):
+        """ Forgets what is known about the previous instructions. """
+        self.known = None
+        self.previous = None
+        self.recorded = None
+        self.sreg_written = False
+        self.pending_mask = None
+        self.first_update = None
+        self.commands = []
+        self.traced = []
+
+    def countdown(self, start, exits, cycles, following, worst):
+        """ Compiles the loop which only decrements a register until it
+        becomes zero, like the delay loops, into a function computing
+        its end in closed form. Passes which can exceed s.limit are not
+        made. Returns None for any other block. """
+        commands = self.commands
+        if self.tracer is not None:
+            # every pass has to leave its records
+            return None
+        if len(commands) < 2 or commands[-1][0] not in self.alu.branch_flags:
+            return None
+        if self.alu.branch_flags[commands[-1][0]] != ('z', False):
+            return None
+        if commands[-2][0] != 'dec' or [c for c, a in commands[:-2] if c not in self.idle]:
+            return None
+        taken = [cycles + extra for cond, target, extra in exits if target == start]
+        if not taken:
+            return None
+        taken = taken[0]
+        rd = commands[-2][1]
+
+        self.reset()
+        update = self.update(LOGIC, 'flags_dec', 0, 0, 'r')
+        self.reset()
+        source = ['def block(s):',
+                  '    d = s.data',
+                  '    if s.cycles + %i > s.limit:' % worst,
+                  '        return s.code[%i](s)' % (start >> 1),
+                  '    n = %s or 256' % self.reg(rd),
+                  '    passes = 1 + (s.limit - %i - s.cycles) // %i' % (worst, taken),
+                  '    if n <= passes:',
+                  '        r = 0',
+                  '        %s = 0' % self.reg(rd)]
+        source += ['        %s' % line for line in update]
+        source += ['        %s' % line for line in self.profiled(start, following, 'n', 'n - 1')]
+        source += ['        s.cycles += (n - 1) * %i + %i' % (taken, cycles),
+                   '        return %i' % following,
+                   '    r = n - passes',
+                   '    %s = r' % self.reg(rd)]
+        source += ['    %s' % line for line in update]
+        source += ['    %s' % line for line in self.profiled(start, following, 'passes', 'passes')]
+        source += ['    s.cycles += passes * %i' % taken,
+                   '    return %i' % start]
+
+        namespace = self.namespace()
+        exec '\n'.join(source) in namespace
+        return namespace['block']
+
+    def missing(self, addr):
+        """ Returns the function for the address without code. """
+        def op(s):
+            s.pointer = addr
+            raise Exception('ERROR: %04x' % addr)
+        return op
+
+    def function(self, name, addr, command, args):
+        """ Returns source lines of the function for one instruction. """
+        self.reset()
+        self.acc = 0
+        (body, exits) = self.instruction(addr, command, args)
+        lines = ['def %s(s):' % name,
+                 '    d = s.data']
+        if addr in self.alu.block_stops:
+            lines += self.stop_check(addr)
+        for body_lines in self.traced_body([body]):
+            lines.extend(['    %s' % line for line in body_lines])
+        if self.profiler is not None:
+            lines.append('    hits[%i] += 1' % (addr >> 1))
+        lines.extend(self.exits(exits, self.alu.cycle_costs.get(command, 1),
+                                addr + self.size(command), '    '))
+        return lines
+
+    def stop_check(self, addr):
+        """ Returns lines which leave the pointer at addr before the
+        instruction if the run stops there, see ATtiny13.stop_at(). """
+        return ['    if s.stop_at(%i):' % addr,
+                '        return %i' % addr]
+
+    def size(self, command):
+        """ Returns the size of the instruction in bytes. """
+        if command in self.alu.long_commands:
+            return 4
+        return 2
+
+    def skip(self, addr):
+        """ Returns the address after the instruction the skip at addr
+        jumps over and the extra cycles of the jump. """
+        entry = self.code_tree.get('%04x' % (addr + 2))
+        size = 2
+        if entry is not None:
+            size = self.size(entry[0])
+        return (addr + 2 + size, size >> 1)
+
+    def instruction(self, addr, command, args):
+        """ Returns the body of the instruction and its exits. The body
+        is a list of Python lines, the exits are a list of (condition,
+        pointer, extra cycles) which leave the straight line; condition
+        None means an unconditional jump. """
+        self.volatile = False
+        if self.tracer is not None:
+            self.traced.append((self.now(), addr, self.tracer.opcode(addr),
+                                self.destination(command, args)))
+        (body, exits) = self.handlers[command](addr, command, args)
+        if self.watches is not None:
+            checks = self.watches.checks(self.sources(command, args),
+                                         self.destination(command, args))
+            if checks:
+                # a hit lowers s.limit, so the block has to end here
+                self.volatile = True
+                body = list(body)
+                for location, access in checks:
+                    body += ['if watches.access(s, %i, %i, %r):' % (addr, location, access),
+                             '    s.limit = 0']
+            # ld and st leave their address in x
+            access = {'ld': 'r', 'ldd': 'r', 'st': 'w', 'std': 'w'}.get(command)
+            if access is not None and self.watches.watched(access):
+                self.volatile = True
+                body = list(body) + ['if watches.access(s, %i, x, %r):' % (addr, access),
+                                     '    s.limit = 0']
+            # the stack instructions leave the address of their first
+            # byte in sp, the others go below it
+            (access, count) = self.stack_bytes.get(command, (None, 0))
+            if access is not None and self.watches.watched(access):
+                self.volatile = True
+                body = list(body)
+                for i in xrange(count):
+                    body += ['if watches.access(s, %i, sp - %i, %r):' % (addr, i, access),
+                             '    s.limit = 0']
+        return (body, exits)
+
+    def sources(self, command, args):
+        """ Returns the locations of the data space the instruction
+        reads besides SREG. """
+        if command in ('adc', 'add', 'and', 'cp', 'cpc', 'cpse', 'eor', 'or', 'sbc', 'sub'):
+            return args
+        if command in ('andi', 'bld', 'bst', 'cpi', 'ori', 'sbci', 'sbrc', 'sbrs', 'sts',
+                       'subi'):
+            return (args[0], )
+        if command in ('asr', 'com', 'dec', 'inc', 'lsl', 'lsr', 'neg', 'push', 'rol', 'ror',
+                       'swap', 'tst'):
+            return (args, )
+        if command in ('mov', 'out', 'lds'):
+            return (args[1], )
+        if command in ('adiw', 'sbiw'):
+            return (args[0], args[0] + 1)
+        if command in ('ld', 'ldd', 'movw'):
+            return (args[1], args[1] + 1)
+        if command in ('st', 'std'):
+            return (args[0], args[1], args[1] + 1)
+        if command in ('icall', 'ijmp', 'lpm'):
+            return (30, 31)
+        if command == 'in':
+            return (self.alu.io + args[1], )
+        if command in ('cbi', 'sbi', 'sbic', 'sbis'):
+            return (self.alu.io + args[0], )
+        return ()
+
+    def destination(self, command, args):
+        """ Returns the locations of the data space the instruction
+        writes besides SREG, the stack and the address of st. """
+        if command in ('cbi', 'out', 'sbi'):
+            return (self.alu.io + args[0], )
+        if command in ('adiw', 'movw', 'sbiw'):
+            return (args[0], args[0] + 1)
+        if command == 'ld' and args[2]:
+            # the pointer is written before the loaded register
+            return tuple([ptr for ptr in (args[1], args[1] + 1) if ptr != args[0]]) + \
+                   (args[0], )
+        if command == 'st' and args[2]:
+            return (args[1], args[1] + 1)
+        if command == 'lpm' and args[1]:
+            return tuple([z for z in (30, 31) if z != args[0]]) + (args[0], )
+        if command in ('adc', 'add', 'and', 'andi', 'bld', 'eor', 'in', 'ld', 'ldd', 'ldi',
+                       'lds', 'lpm', 'mov', 'or', 'ori', 'sbc', 'sbci', 'sub', 'subi'):
+            return (args[0], )
+        if command == 'sts':
+            return (args[1], )
+        if command in ('asr', 'clr', 'com', 'dec', 'inc', 'lsl', 'lsr', 'neg', 'pop', 'rol',
+                       'ror', 'swap'):
+            return (args, )
+        return ()
+
+    def traced_body(self, body):
+        """ Returns the bodies of the instructions with the lines which
+        write their records at once, one for every written location or
+        one with NOWHERE. The records go after the bodies to take the
+        written values; a value written again later is kept in a local.
+        Without any values they go first, since sleep moves the
+        cycles. """
+        traced = self.traced
+        if self.tracer is None or not traced:
+            return body
+        body = [list(lines) for lines in body]
+        fields = []
+        for i, (now, addr, opcode, locations) in enumerate(traced):
+            if not locations:
+                fields.append('%s, %i, %i, %i, 0' % (now, addr, opcode, NOWHERE))
+                continue
+            for location in locations:
+                value = 'd[%i]' % location
+                if [entry for entry in traced[i + 1:] if location in entry[3]]:
+                    body[i].append('v%i_%i = %s' % (i, location, value))
+                    value = 'v%i_%i' % (i, location)
+                fields.append('%s, %i, %i, %i, %s' % (now, addr, opcode, location, value))
+        size = RECORD.size * len(fields)
+        lines = ['o = position[0]',
+                 'if o + %i > position[1]:' % size,
+                 '    o = tracer.hand_over()',
+                 'packs[%i](buffer, o, %s)' % (len(fields), ', '.join(fields)),
+                 'position[0] = o + %i' % size]
+        if [entry for entry in traced if entry[3]]:
+            return body + [lines]
+        return [lines] + body
+
+    def profiled(self, start, following, count='1', jumps=None):
+        """ Returns lines which count count passes of the block from
+        start to following, and jumps taken by its last instruction if
+        they are known. """
+        if self.profiler is None:
+            return []
+        self.profiler.block(start, following)
+        lines = ['block_passes[%i] += %s' % (start >> 1, count)]
+        if jumps is not None:
+            lines.append('taken[%i] += %s' % ((following - 2) >> 1, jumps))
+        return lines
+
+    def exits(self, exits, cycles, following, indent, loop=None, worst=0):
+        """ Returns lines which count cycles and return the next
+        pointer. Inside a loop cycles are counted in the local c and a
+        jump to the loop address continues the loop while worst cycles
+        of the next pass fit the local limit. """
+        count = 's.cycles += %i'
+        if loop is not None:
+            count = 's.cycles = c + %i'
+        lines = []
+        for cond, target, extra in exits:
+            if cond is None:
+                return lines + [indent + count % (cycles + extra),
+                                '%sreturn %s' % (indent, target)]
+            lines += ['%sif %s:' % (indent, cond)]
+            if self.profiler is not None and extra:
+                lines += ['%s    taken[%i] += 1' % (indent, (following - 2) >> 1)]
+            if target == loop:
+                lines += ['%s    c += %i' % (indent, cycles + extra),
+                          '%s    if c + %i > limit:' % (indent, worst),
+                          '%s        s.cycles = c' % indent,
+                          '%s        return %s' % (indent, target),
+                          '%s    continue' % indent]
+            else:
+                lines += ['%s    %s' % (indent, count % (cycles + extra)),
+                          '%s    return %s' % (indent, target)]
+        return lines + [indent + count % cycles,
+                        '%sreturn %i' % (indent, following)]
+
+    def flag(self, name):
+        """ Returns mask of SREG's flag. """
+        return 1 << self.alu.flags[name]
+
+    def flush(self):
+        """ Returns lines which compute pending flags before SREG is
+        read. """
+        pending_mask = self.pending_mask
+        self.pending_mask = 0
+        if not self.alu.lazy_flags or pending_mask == 0:
+            return []
+        if pending_mask is not None:
+            return ['s.sreg_flush()']
+        return ['if s.pending is not None:',
+                '    s.sreg_flush()']
+
+    def update(self, mask, func, a, b, r):
+        """ Returns lines which set the flags from mask, see
+        ALU.sreg_update(). """
+        self.recorded = (mask, func, a, b, r)
+        if not self.alu.lazy_flags:
+            return ['%s = %s & %i | %s(%s, %s, %s)' % (self.sreg, self.sreg, 255 & ~mask, func, a, b, r)]
+        if self.first_update is None:
+            self.first_update = mask
+        lines = self.update_check(mask)
+        self.pending_mask = mask
+        return lines + ['s.pending = (%i, %s, %s, %s, %s)' % (mask, func, a, b, r)]
+
+    def chain(self, mask, flags):
+        """ Returns lines which set the flags from mask at once, Z
+        stays set only if it was set, see ALU.sreg_chain(). The pending
+        flags have to be flushed before. """
+        self.sreg_written = True
+        return ['f = %s' % flags,
+                '%s = %s & %i | f & (%i | %s)' % (self.sreg, self.sreg, 255 & ~mask,
+                                                  255 & ~self.flag('z'), self.sreg)]
+
+    def update_check(self, mask):
+        """ Returns lines which compute the pending flags if the new
+        ones from mask do not replace all of them. """
+        pending_mask = self.pending_mask
+        if pending_mask is None:
+            if ARITHMETIC & ~mask:
+                return ['p = s.pending',
+                        'if p is not None and p[0] & %i:' % (ARITHMETIC & ~mask),
+                        '    s.sreg_flush()']
+        elif pending_mask & ~mask:
+            return ['s.sreg_flush()']
+        return []
+
+    def known_flag(self, flag):
+        """ Returns the expression for the flag computed from the result
+        of the previous flag-setting instruction in the block, so it
+        needs no SREG, or None. """
+        if self.known is None:
+            return None
+        (mask, func, a, b, r) = self.known
+        if not mask & self.flag(flag):
+            return None
+        if func in ('flags_adiw', 'flags_sbiw'):
+            # the results of words
+            if flag == 'z':
+                return '((%s) & 65535) == 0' % r
+            if flag == 'n':
+                return '(%s) & 32768' % r
+            if flag == 'c':
+                return func == 'flags_adiw' and '(%s) > 65535' % r or '(%s) < 0' % r
+            return None
+        if flag == 'z':
+            return '((%s) & 255) == 0' % r
+        if flag == 'n':
+            return '(%s) & 128' % r
+        if flag == 'c' and func == 'flags_add':
+            return '(%s) > 255' % r
+        if flag == 'c' and func == 'flags_sub':
+            return '(%s) < 0' % r
+        return None
+
+    def reg(self, rd):
+        return 'd[%i]' % rd
+
+    def port(self, a):
+        return 'd[%i]' % (self.alu.io + a)
+
+    def now(self):
+        """ Returns the expression for the cycle of the instruction. """
+        if self.acc:
+            return '%s + %i' % (self.counter, self.acc)
+        return self.counter
+
+    def io_value(self, a):
+        """ Returns the expression reading the port through its hook. """
+        if a in self.alu.read_hooks:
+            return 's.io_read(%i, %s)' % (a, self.now())
+        return self.port(a)
+
+    def io_write(self, a, value, bits=255):
+        """ Returns lines writing the port through its hook. """
+        self.volatile = True
+        return ['s.io_write(%i, %s, %i, %s)' % (a, value, bits, self.now())]
+
+    def address(self, command, ptr, mode):
+        """ Returns lines which put the address of ld, ldd, st or std
+        into x. mode is the displacement of ldd and std, or the change
+        of the pointer register: -1 before the access, 1 after it. """
+        pointer = '%s | %s << 8' % (self.reg(ptr), self.reg(ptr + 1))
+        if command in ('ldd', 'std'):
+            return ['x = (%s) + %i' % (pointer, mode)]
+        if mode < 0:
+            return ['x = (%s) - 1 & 65535' % pointer,
+                    '%s = x & 255' % self.reg(ptr),
+                    '%s = x >> 8' % self.reg(ptr + 1)]
+        if mode > 0:
+            return ['x = %s' % pointer,
+                    'w = (x + 1) & 65535',
+                    '%s = w & 255' % self.reg(ptr),
+                    '%s = w >> 8' % self.reg(ptr + 1)]
+        return ['x = %s' % pointer]
+
+    def target(self, addr, args, range):
+        (k, is_negative) = args
+        if is_negative:
+            k -= range
+        return addr + 2 * k + 2
+
+    def adc(self, addr, command, args):
+        (rd, rr) = args
+        return (self.flush() +
+                ['a = %s' % self.reg(rd),
+                 'b = %s' % self.reg(rr),
+                 'r = a + b + (%s & 1)' % self.sreg,
+                 '%s = r & 255' % self.reg(rd)] +
+                self.update(ARITHMETIC, 'flags_add', 'a', 'b', 'r'), [])
+
+    def add(self, addr, command, args):
+        (rd, rr) = args
+        return (['a = %s' % self.reg(rd),
+                 'b = %s' % self.reg(rr),
+                 'r = a + b',
+                 '%s = r & 255' % self.reg(rd)] +
+                self.update(ARITHMETIC, 'flags_add', 'a', 'b', 'r'), [])
+
+    def and_op(self, addr, command, args):
+        (rd, rr) = args
+        return (['r = %s & %s' % (self.reg(rd), self.reg(rr)),
+                 '%s = r' % self.reg(rd)] +
+                self.update(LOGIC, 'flags_logic', 0, 0, 'r'), [])
+
+    def andi(self, addr, command, args):
+        (rd, k) = args
+        return (['r = %s & %i' % (self.reg(rd), k),
+                 '%s = r' % self.reg(rd)] +
+                self.update(LOGIC, 'flags_logic', 0, 0, 'r'), [])
+
+    def asr(self, addr, command, rd):
+        return (['a = %s' % self.reg(rd),
+                 'r = a >> 1 | a & 128',
+                 '%s = r' % self.reg(rd)] +
+                self.update(SHIFT, 'flags_ror', 'a', 0, 'r'), [])
+
+    def bclr(self, addr, command, s):
+        self.sreg_written = True
+        lines = []
+        if ARITHMETIC & 1 << s:
+            lines = self.flush()
+        return (lines + ['%s &= %i' % (self.sreg, 255 & ~(1 << s))], [])
+
+    def bld(self, addr, command, args):
+        (rd, b) = args
+        return (['if %s & %i:' % (self.sreg, self.flag('t')),
+                 '    %s |= %i' % (self.reg(rd), 1 << b),
+                 'else:',
+                 '    %s &= %i' % (self.reg(rd), 255 & ~(1 << b))], [])
+
+    def branch(self, addr, command, args):
+        (flag, state) = self.alu.branch_flags[command]
+        cond = self.known_flag(flag)
+        lines = []
+        if cond is None:
+            cond = '%s & %i' % (self.sreg, self.flag(flag))
+            lines = self.flush()
+        if not state:
+            cond = 'not (%s)' % cond
+        return (lines, [(cond, self.target(addr, args, 128), 1)])
+
+    def bset(self, addr, command, s):
+        self.sreg_written = True
+        lines = []
+        if ARITHMETIC & 1 << s:
+            lines = self.flush()
+        return (lines + ['%s |= %i' % (self.sreg, 1 << s)], [])
+
+    def bst(self, addr, command, args):
+        (rd, b) = args
+        return (['if %s & %i:' % (self.reg(rd), 1 << b),
+                 '    %s |= %i' % (self.sreg, self.flag('t')),
+                 'else:',
+                 '    %s &= %i' % (self.sreg, 255 & ~self.flag('t'))], [])
+
+    def cbi(self, addr, command, args):
+        (a, b) = args
+        if a in self.alu.write_hooks:
+            return (self.io_write(a, '%s & %i' % (self.io_value(a), 255 & ~(1 << b)), 1 << b), [])
+        return (['%s &= %i' % (self.port(a), 255 & ~(1 << b))], [])
+
+    def cli(self, addr, command, args):
+        return (['%s &= %i' % (self.sreg, 255 & ~self.flag('i'))], [])
+
+    def clr(self, addr, command, rd):
+        return (['%s = 0' % self.reg(rd)] +
+                self.update(LOGIC, 'flags_logic', 0, 0, 0), [])
+
+    def com(self, addr, command, rd):
+        return (['r = %s ^ 255' % self.reg(rd),
+                 '%s = r' % self.reg(rd)] +
+                self.update(SHIFT, 'flags_com', 0, 0, 'r'), [])
+
+    def cpse(self, addr, command, args):
+        (rd, rr) = args
+        (target, extra) = self.skip(addr)
+        return ([], [('%s == %s' % (self.reg(rd), self.reg(rr)), target, extra)])
+
+    def dec(self, addr, command, rd):
+        return (['r = (%s - 1) & 255' % self.reg(rd),
+                 '%s = r' % self.reg(rd)] +
+                self.update(LOGIC, 'flags_dec', 0, 0, 'r'), [])
+
+    def eor(self, addr, command, args):
+        (rd, rr) = args
+        return (['r = %s ^ %s' % (self.reg(rd), self.reg(rr)),
+                 '%s = r' % self.reg(rd)] +
+                self.update(LOGIC, 'flags_logic', 0, 0, 'r'), [])
+
+    def icall(self, addr, command, args):
+        following = (addr + 2) >> 1
+        return (self.put(addr, [following & 255, following >> 8]),
+                [(None, '(d[31] << 8 | d[30]) << 1', 0)])
+
+    def ijmp(self, addr, command, args):
+        return ([], [(None, '(d[31] << 8 | d[30]) << 1', 0)])
+
+    def in_op(self, addr, command, args):
+        (rd, a) = args
+        lines = []
+        if self.alu.io + a == self.alu.sreg:
+            lines = self.flush()
+        return (lines + ['%s = %s' % (self.reg(rd), self.io_value(a))], [])
+
+    def inc(self, addr, command, rd):
+        return (['r = (%s + 1) & 255' % self.reg(rd),
+                 '%s = r' % self.reg(rd)] +
+                self.update(LOGIC, 'flags_inc', 0, 0, 'r'), [])
+
+    def ld(self, addr, command, args):
+        (rd, ptr, mode) = args
+        lines = self.address(command, ptr, mode)
+        return (lines + ['%s = d[x] if %i <= x < %i else s.read_data(x, %s)' %
+                         (self.reg(rd), self.alu.sram, len(self.alu.data), self.now())], [])
+
+    def ldi(self, addr, command, args):
+        (rd, k) = args
+        return (['%s = %i' % (self.reg(rd), k)], [])
+
+    def lds(self, addr, command, args):
+        (rd, k) = args
+        if self.alu.io <= k < self.alu.io + 64:
+            return self.in_op(addr, 'in', (rd, k - self.alu.io))
+        if 0 <= k < len(self.alu.data):
+            return (['%s = d[%i]' % (self.reg(rd), k)], [])
+        return (['%s = s.read_data(%i)' % (self.reg(rd), k)], [])
+
+    def lpm(self, addr, command, args):
+        (rd, increment) = args
+        lines = ['z = d[30] | d[31] << 8',
+                 '%s = s.flash[z %% %i]' % (self.reg(rd), self.alu.flash_size)]
+        if increment:
+            lines += ['z = (z + 1) & 65535',
+                      'd[30] = z & 255',
+                      'd[31] = z >> 8']
+        return (lines, [])
+
+    def lsl(self, addr, command, rd):
+        return (['a = %s' % self.reg(rd),
+                 'r = a << 1',
+                 '%s = r & 255' % self.reg(rd)] +
+                self.update(ARITHMETIC, 'flags_add', 'a', 'a', 'r'), [])
+
+    def lsr(self, addr, command, rd):
+        return (['a = %s' % self.reg(rd),
+                 'r = a >> 1',
+                 '%s = r' % self.reg(rd)] +
+                self.update(SHIFT, 'flags_ror', 'a', 0, 'r'), [])
+
+    def mov(self, addr, command, args):
+        (rd, rr) = args
+        return (['%s = %s' % (self.reg(rd), self.reg(rr))], [])
+
+    def movw(self, addr, command, args):
+        (rd, rr) = args
+        return (['%s = %s' % (self.reg(rd), self.reg(rr)),
+                 '%s = %s' % (self.reg(rd + 1), self.reg(rr + 1))], [])
+
+    def neg(self, addr, command, rd):
+        return (['a = %s' % self.reg(rd),
+                 'r = -a',
+                 '%s = r & 255' % self.reg(rd)] +
+                self.update(ARITHMETIC, 'flags_sub', 0, 'a', 'r'), [])
+
+    def nop(self, addr, command, args):
+        return ([], [])
+
+    def or_op(self, addr, command, args):
+        (rd, rr) = args
+        return (['r = %s | %s' % (self.reg(rd), self.reg(rr)),
+                 '%s = r' % self.reg(rd)] +
+                self.update(LOGIC, 'flags_logic', 0, 0, 'r'), [])
+
+    def ori(self, addr, command, args):
+        (rd, k) = args
+        return (['r = %s | %i' % (self.reg(rd), k),
+                 '%s = r' % self.reg(rd)] +
+                self.update(LOGIC, 'flags_logic', 0, 0, 'r'), [])
+
+    def out(self, addr, command, args):
+        (a, rr) = args
+        value = self.reg(rr)
+        if self.previous is not None and self.previous[0] == 'ldi' and self.previous[1][0] == rr:
+            value = self.previous[1][1]
+        if a in self.alu.write_hooks:
+            return (self.io_write(a, value), [])
+        lines = ['%s = %s' % (self.port(a), value)]
+        if self.alu.io + a == self.alu.sreg:
+            # the interrupts may become enabled
+            self.volatile = True
+            self.sreg_written = True
+            lines.append('s.limit = 0')
+            if self.alu.lazy_flags:
+                lines.append('s.pending = None')
+                self.pending_mask = 0
+        return (lines, [])
+
+    def pull(self, addr, count):
+        """ Returns lines taking count bytes from the stack, sp is the
+        address of the last one. """
+        return ['sp = %s + %i' % (self.port(0x3d), count),
+                'if not %i <= sp <= %i:' % (self.alu.sram + count - 1, self.alu.ramend),
+                '    raise Exception(\'ERROR: Stack underflow at %04x\')' % addr,
+                '%s = sp' % self.port(0x3d)]
+
+    def put(self, addr, values):
+        """ Returns lines putting the values onto the stack. """
+        lines = ['sp = %s' % self.port(0x3d),
+                 'if not %i <= sp <= %i:' % (self.alu.sram + len(values) - 1, self.alu.ramend),
+                 '    raise Exception(\'ERROR: Stack overflow at %04x\')' % addr]
+        for i, value in enumerate(values):
+            lines.append('d[sp - %i] = %s' % (i, value) if i else 'd[sp] = %s' % value)
+        return lines + ['%s = sp - %i' % (self.port(0x3d), len(values))]
+
+    def pop(self, addr, command, rd):
+        return (self.pull(addr, 1) + ['%s = d[sp]' % self.reg(rd)], [])
+
+    def push(self, addr, command, rr):
+        return (self.put(addr, [self.reg(rr)]), [])
+
+    def rcall(self, addr, command, args):
+        # the return address goes as a word address, its high byte below
+        following = (addr + 2) >> 1
+        return (self.put(addr, [following & 255, following >> 8]),
+                [(None, self.target(addr, args, 4096), 0)])
+
+    def ret(self, addr, command, args):
+        return (self.pull(addr, 2), [(None, '(d[sp - 1] << 8 | d[sp]) << 1', 0)])
+
+    def reti(self, addr, command, args):
+        return (self.enable(command) + self.pull(addr, 2),
+                [(None, '(d[sp - 1] << 8 | d[sp]) << 1', 0)])
+
+    def rjmp(self, addr, command, args):
+        return ([], [(None, self.target(addr, args, 4096), 0)])
+
+    def rol(self, addr, command, rd):
+        return (self.flush() +
+                ['a = %s' % self.reg(rd),
+                 'r = a << 1 | %s & 1' % self.sreg,
+                 '%s = r & 255' % self.reg(rd)] +
+                self.update(ARITHMETIC, 'flags_add', 'a', 'a', 'r'), [])
+
+    def ror(self, addr, command, rd):
+        return (self.flush() +
+                ['a = %s' % self.reg(rd),
+                 'r = a >> 1 | (%s & 1) << 7' % self.sreg,
+                 '%s = r' % self.reg(rd)] +
+                self.update(SHIFT, 'flags_ror', 'a', 0, 'r'), [])
+
+    def sbi(self, addr, command, args):
+        (a, b) = args
+        if a in self.alu.write_hooks:
+            return (self.io_write(a, '%s | %i' % (self.io_value(a), 1 << b), 1 << b), [])
+        return (['%s |= %i' % (self.port(a), 1 << b)], [])
+
+    def sbic(self, addr, command, args):
+        (a, b) = args
+        (target, extra) = self.skip(addr)
+        return ([], [('not %s & %i' % (self.io_value(a), 1 << b), target, extra)])
+
+    def sbis(self, addr, command, args):
+        (a, b) = args
+        (target, extra) = self.skip(addr)
+        return ([], [('%s & %i' % (self.io_value(a), 1 << b), target, extra)])
+
+    def sbrc(self, addr, command, args):
+        (rr, b) = args
+        (target, extra) = self.skip(addr)
+        return ([], [('not %s & %i' % (self.reg(rr), 1 << b), target, extra)])
+
+    def sbrs(self, addr, command, args):
+        (rr, b) = args
+        (target, extra) = self.skip(addr)
+        return ([], [('%s & %i' % (self.reg(rr), 1 << b), target, extra)])
+
+    def sei(self, addr, command, args):
+        return (self.enable(command), [])
+
+    def enable(self, command):
+        """ Returns lines setting the flag I, the interrupts wait for
+        one more instruction after this one. """
+        self.volatile = True
+        return ['%s |= %i' % (self.sreg, self.flag('i')),
+                's.inhibit = %s + %i' % (self.now(), self.alu.cycle_costs.get(command, 1)),
+                's.limit = 0']
+
+    def sleep(self, addr, command, args):
+        # nothing happens until s.limit, the next event or the end of
+        # the run, so skip the cycles at once; sleep always starts its
+        # block, so s.cycles is exact here. The pointer stays here
+        # until an interrupt wakes up
+        cost = self.alu.cycle_costs.get(command, 1)
+        return (['se = %s & 32' % self.port(0x35),
+                 'if se:',
+                 '    s.sleeping = True',
+                 '    s.cycles = max(s.cycles, s.limit - %i)' % cost], [('se', addr, 0)])
+
+    def spm(self, addr, command, args):
+        # the flash and the code change, so the run loop takes the new
+        # code after this instruction
+        self.volatile = True
+        return (['s.program_flash()'], [])
+
+    def st(self, addr, command, args):
+        # any port may be written, so the block ends here
+        (rr, ptr, mode) = args
+        self.volatile = True
+        lines = self.address(command, ptr, mode)
+        return (lines + ['if %i <= x < %i:' % (self.alu.sram, len(self.alu.data)),
+                         '    d[x] = %s' % self.reg(rr),
+                         'else:',
+                         '    s.write_data(x, %s, %s)' % (self.reg(rr), self.now())], [])
+
+    def sts(self, addr, command, args):
+        (rr, k) = args
+        if self.alu.io <= k < self.alu.io + 64:
+            return self.out(addr, 'out', (k - self.alu.io, rr))
+        if 0 <= k < len(self.alu.data):
+            return (['d[%i] = %s' % (k, self.reg(rr))], [])
+        return (['s.write_data(%i, %s)' % (k, self.reg(rr))], [])
+
+    def subtract(self, addr, command, args):
+        """ Compiles sub, sbc, cp, cpc and their immediate forms. The
+        ones with the carry keep Z set only if it was set, so they set
+        the flags at once. """
+        (rd, rr) = args
+        b = self.reg(rr)
+        if command in ('cpi', 'sbci', 'subi'):
+            b = '%i' % rr
+        lines = ['a = %s' % self.reg(rd),
+                 'b = %s' % b]
+        if command in ('cpc', 'sbc', 'sbci'):
+            lines = self.flush() + lines + ['r = a - b - (%s & 1)' % self.sreg]
+        else:
+            lines += ['r = a - b']
+        if command not in ('cp', 'cpc', 'cpi'):
+            lines += ['%s = r & 255' % self.reg(rd)]
+        if command in ('cpc', 'sbc', 'sbci'):
+            return (lines + self.chain(ARITHMETIC, 'flags_sub(a, b, r)'), [])
+        return (lines + self.update(ARITHMETIC, 'flags_sub', 'a', 'b', 'r'), [])
+
+    def swap(self, addr, command, rd):
+        return (['v = %s' % self.reg(rd),
+                 '%s = (v << 4 | v >> 4) & 255' % self.reg(rd)], [])
+
+    def tst(self, addr, command, rd):
+        return (['r = %s' % self.reg(rd)] +
+                self.update(LOGIC, 'flags_logic', 0, 0, 'r'), [])
+
+    def wdr(self, addr, command, args):
+        return (['s.watchdog.restart(%s)' % self.now()], [])
+
+    def word(self, addr, command, args):
+        """ Compiles adiw and sbiw. """
+        (rd, k) = args
+        (sign, func) = command == 'adiw' and ('+', 'flags_adiw') or ('-', 'flags_sbiw')
+        return (['a = %s | %s << 8' % (self.reg(rd), self.reg(rd + 1)),
+                 'r = a %s %i' % (sign, k),
+                 '%s = r & 255' % self.reg(rd),
+                 '%s = r >> 8 & 255' % self.reg(rd + 1)] +
+                self.update(SHIFT, func, 'a', k, 'r'), [])
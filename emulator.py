@@ -8,6 +8,26 @@ from optparse import OptionParser
 parser = OptionParser()
 parser.add_option("-f", "--hex-file", action="store", dest="hexfile",
                   help="HEX file", default=None)
+parser.add_option("-r", "--run", action="store_true", dest="run",
+                  help="run without prompts and show the state on stop", default=False)
+parser.add_option("-c", "--cycles", action="store", type="int", dest="cycles",
+                  help="stop running after this number of cycles", default=None)
+parser.add_option("-u", "--until-pc", action="store", dest="until_pc",
+                  help="stop running when the pointer reaches this hex address", default=None)
+parser.add_option("-b", "--until-break", action="store_true", dest="until_break",
+                  help="stop running on the break instruction", default=False)
+parser.add_option("-e", "--eeprom", action="store", dest="eeprom",
+                  help="keep the EEPROM in this image file over the runs", default=None)
+parser.add_option("--cache", action="store", dest="cache",
+                  help="keep decoded programs in this directory", default=None)
+parser.add_option("--trace", action="store", dest="trace",
+                  help="write the executed instructions to this file, see tracer.py", default=None)
+parser.add_option("--vcd", action="store", dest="vcd",
+                  help="write the changes of port B to this VCD file", default=None)
+parser.add_option("--stimulus", action="store", dest="stimulus",
+                  help="drive the inputs from this timeline, see stimulus.py", default=None)
+parser.add_option("--profile", action="store_true", dest="profile",
+                  help="show where the cycles go after running", default=False)
 (options, args) = parser.parse_args()
 
 for key in ['hexfile']:
@@ -26,7 +46,20 @@ def help_info():
     print '\tp[orts]     - show ports'
     print '\tl[ist]      - show scope'
     print '\ts[stack]    - show stack'
-    print '\tn[ext]      - execute line'
+    print '\tn[ext]      - execute line, tell the points it hits'
+    print '\tb[ack]      - undo the last line'
+    print '\trc          - undo lines back to the previous break, breakpoint or'
+    print '\t              write of a watched location'
+    print '\tc[ontinue]  - run up to a breakpoint or a watchpoint'
+    print
+    print '\tbp <addr> [condition]              - break at the hex address'
+    print '\twp <location>[:r|w|rw] [condition] - watch r<regnum>, p<name> or 0x<addr>'
+    print '\tbl          - list breakpoints and watchpoints'
+    print '\tbd <number> - delete a breakpoint or a watchpoint'
+    print '\tconditions are Python expressions of r0..r31, the ports, pc, cycles'
+    print '\tand value, the value of the watched location'
+    print '\texamples:'
+    print '\t\tbp 001a r16 > 3 \twp r17 value == 0 \twp pportb:rw'
     print
     print '\tt|int timer - raise timer interrupt'
     print
@@ -42,15 +75,17 @@ def show_registers(alu):
     registers = alu.get_regs()
     for i in xrange(8):
         for j in xrange(4):
-            val, binval = registers['r%02i' % (j * 8 + i)]
-            print 'r%02i = % 4i : 0x%02x : %s\t' % (j * 8 + i, val, val, binval),
+            val = registers[j * 8 + i]
+            print 'r%02i = % 4i : 0x%02x : %s\t' % (j * 8 + i, val, val, alu.int2bin(val, 8)),
         print
     print
 
 def show_ports(alu):
     """ Shows current state of I/O ports. """
-    for i, key, val, binval in alu.get_ports():
-        print '%02x : %s\t= % 4i : 0x%02x : %s' % (int(i, 16), key, val, val, binval)
+    ports = alu.get_ports()
+    for i in sorted(alu.port_names.keys()):
+        val = ports[i]
+        print '%02x : %s\t= % 4i : 0x%02x : %s' % (i, alu.port_names[i], val, val, alu.int2bin(val, 8))
     print
 
 def show_scope(pointer):
@@ -66,10 +101,51 @@ def show_scope(pointer):
             print '%04x : %s' % (list + i * 2, command)
     print
 
+def parse_location(alu, name):
+    """ Returns the location of the data space: r<regnum>, p<name> or
+    a hex address. """
+    if re.match('^r[0-9]+$', name) and int(name[1:]) < 32:
+        return int(name[1:])
+    if name.startswith('0x'):
+        return int(name, 16)
+    if name.startswith('p'):
+        port_addr = alu.get_port_by_name(name[1:].upper())
+        if port_addr is not None:
+            return alu.io + port_addr
+    raise Exception('ERROR: Bad location %s' % (name, ))
+
+def add_point(alu, watches, user):
+    """ Adds the breakpoint or the watchpoint the user asked for. """
+    from watches import Breakpoint, Watchpoint
+    parts = user.split(None, 2)
+    if len(parts) < 2:
+        print 'ERROR: Too few arguments, see help'
+        return
+    condition = None
+    if len(parts) > 2:
+        condition = parts[2]
+    try:
+        if parts[0] == 'bp':
+            point = Breakpoint(int(parts[1], 16), condition)
+        else:
+            (name, access) = (parts[1].split(':') + ['w'])[:2]
+            point = Watchpoint(parse_location(alu, name), access, condition)
+        print 'point %i: %s' % (watches.add(point), point)
+    except (Exception, SyntaxError), e:
+        print e
+    print
+
+def show_points(watches):
+    """ Shows the breakpoints and the watchpoints. """
+    for number, point in enumerate(watches.points):
+        if point is not None:
+            print '%i: %s' % (number, point)
+    print
+
 def show_stack(alu):
     """ Shows current state of the stack. """
-    for i in alu.get_stack():
-        print '[ %i ]' % i
+    for addr, value in alu.get_stack():
+        print '%02x : [ %i ]' % (addr, value)
     print
 
 if __name__ == '__main__':
@@ -77,11 +153,55 @@ if __name__ == '__main__':
 
     from attiny13 import ATtiny13
     from hex_loader import HexLoader
+    from cache import CodeCache
+    from journal import Journal
+    from tracer import Tracer
+    from vcd import VCDWriter
+    from profiler import Profiler
+    from watches import Watches
+    from stimulus import Stimulus, read_stimulus
 
-    alu = ATtiny13()
-    loader = HexLoader(alu, options.hexfile)
+    alu = ATtiny13(eeprom=options.eeprom)
+    cache = None
+    if options.cache:
+        cache = CodeCache(options.cache)
+    loader = HexLoader(alu, options.hexfile, cache=cache)
 
     code_tree = loader.get_code_tree()
+    alu.load(code_tree, loader.get_code(code_tree), loader.image)
+    tracer = None
+    if options.trace:
+        tracer = Tracer(options.trace, loader.image)
+        alu.trace(tracer)
+    vcd = None
+    if options.vcd:
+        vcd = VCDWriter(options.vcd, alu)
+    if options.stimulus:
+        Stimulus(alu, read_stimulus(options.stimulus))
+
+    if options.run:
+        profiler = None
+        if options.profile:
+            profiler = Profiler(alu)
+            alu.profile(profiler)
+        until_pc = options.until_pc and int(options.until_pc, 16)
+        try:
+            reason = alu.run(options.cycles, until_pc, options.until_break)
+        finally:
+            if tracer is not None:
+                tracer.close()
+            if vcd is not None:
+                vcd.close()
+            alu.eeprom.image.flush()
+        print 'stopped by %s at %04x after %i cycles\n' % (reason, alu.get_pointer(), alu.cycles)
+        show_registers(alu)
+        show_ports(alu)
+        if profiler is not None:
+            profiler.report(code_tree, 40)
+        sys.exit(0)
+
+    journal = Journal(alu)
+    watches = Watches(alu)
 
     show_scope(alu.get_pointer())
     while True:
@@ -96,8 +216,49 @@ if __name__ == '__main__':
         user = raw_input('# ')
 
         if user in ['n', 'next']:
-            alu.process(command, args)
+            # one line runs whatever the points say, they only tell
+            # what it hit
+            journal.step(command, args)
+            watches.hit = None
+            if journal.written(watches, journal.entries[-1][1]) or \
+                   watches.reached(alu.get_pointer()):
+                print watches.hit
+        if user in ['b', 'back']:
+            if not journal.back():
+                print 'nothing to undo'
+        if user in ['rc']:
+            # the breaks of the code as it is now, spm may have changed them
+            print '%i lines undone' % (journal.reverse_continue(alu.breaks, watches), )
+            if watches.hit is not None:
+                print watches.hit
+        if user in ['c', 'continue']:
+            try:
+                reason = alu.run(None)
+            except KeyboardInterrupt:
+                reason = 'Ctrl-C'
+            # the run is not journaled, so there is nothing to undo
+            journal.entries.clear()
+            print 'stopped by %s at %04x after %i cycles' % (reason, alu.get_pointer(), alu.cycles)
+            if watches.hit is not None:
+                print watches.hit
+            print
+        if user.startswith('bp ') or user.startswith('wp '):
+            add_point(alu, watches, user)
+        if user in ['bl']:
+            show_points(watches)
+        if user.startswith('bd '):
+            try:
+                watches.remove(int(user[3:]))
+            except ValueError:
+                print 'ERROR: Bad number %s' % (user[3:], )
+            except Exception, e:
+                print e
         if user in ['q', 'quit']:
+            if tracer is not None:
+                tracer.close()
+            if vcd is not None:
+                vcd.close()
+            alu.eeprom.image.flush()
             break
         if user in ['h', 'help']:
             help_info()
@@ -130,13 +291,29 @@ if __name__ == '__main__':
                         value = int(m.group('value'), 16)
                     else:
                         value = int(m.group('value'))
-                    if dest == 'port':
+                    if value > 255:
+                        print 'ERROR: Bad value %s' % (m.group('value'), )
+                    elif dest == 'port':
                         port_name = m.group('port_name')
-                        port_addr = alu.get_port_by_name(port_name)
-                        alu.set_port(ports_values[port_addr], value)
+                        port_addr = alu.get_port_by_name(port_name.upper())
+                        if port_addr is None:
+                            print 'ERROR: Unknown port %s' % (port_name, )
+                        elif port_name.upper() == 'PINB':
+                            # the pins are driven from outside, like
+                            # batch.run_scenario() does
+                            alu.portb.set_inputs(value)
+                        else:
+                            # the hooks of the peripherals see the write
+                            alu.io_write(port_addr, value)
                     else:
-                        reg_name = 'r%s' % m.group('reg_number')
-                        alu.set_reg(reg_name, value)
+                        try:
+                            reg_number = int(m.group('reg_number'))
+                        except ValueError:
+                            reg_number = None
+                        if reg_number is None or not 0 <= reg_number < 32:
+                            print 'ERROR: Bad register %s' % (m.group('reg_number'), )
+                        else:
+                            alu.set_reg(reg_number, value)
                     break
 
     sys.exit(0)
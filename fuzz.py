@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# (c) 2009 Ruslan Popov <ruslan.popov@gmail.com>
+
+import multiprocessing, random, sys, time
+from optparse import OptionParser
+
+from attiny13 import ATtiny13
+from swarm import numpy, Swarm
+
+# the engines compared with the reference handlers: name, kind and lazy
+# flags. The reference handlers with lazy flags and threaded code are
+# compared after every instruction, blocks and the swarm at the end of
+# the run. The swarm needs NumPy and takes only the cases it models.
+ENGINES = (('threaded', 'threaded', True),
+           ('threaded-eager', 'threaded', False),
+           ('blocks', 'blocks', True),
+           ('blocks-eager', 'blocks', False),
+           ('reference-lazy', 'reference', True),
+           ('swarm', 'swarm', False))
+
+# the ports the swarm models: PINB, DDRB, PORTB, SPL and SREG
+SWARM_PORTS = set([0x16, 0x17, 0x18, 0x3d, 0x3f])
+
+# spm would rewrite the program
+EXCLUDED = ('spm', )
+
+# relative jumps besides the conditional branches
+JUMPS = ('rcall', 'rjmp')
+
+# the jumps through Z and the stack, Fuzzer.program() loads their
+# target into Z and pushes it for the returns
+INDIRECT = ('icall', 'ijmp', 'ret', 'reti')
+
+class Reference(ATtiny13):
+    """ The reference machine, it remembers the ports it accessed. """
+
+    def __init__(self, *args, **kwargs):
+        super(Reference, self).__init__(*args, **kwargs)
+        self.ports = set()
+
+    def io_read(self, a, now=None):
+        self.ports.add(a)
+        return super(Reference, self).io_read(a, now)
+
+    def io_write(self, a, value, bits=255, now=None):
+        self.ports.add(a)
+        super(Reference, self).io_write(a, value, bits, now)
+
+class Fuzzer(object):
+    """ Runs random instruction sequences on the reference handlers of
+    ATtiny13 and on every engine of ENGINES and looks for divergences.
+
+    A case is (instructions, data, flash, cycles): instructions are
+    (command, args, target), target is the index of the instruction a
+    jump goes to, so instructions can be removed and the jumps still
+    land on the others. The sequence ends with a jump to itself. data
+    is the data space to start from: random registers, SREG and SRAM,
+    the ports are cleared, the pointer registers point to SRAM. The
+    EEPROM is erased. The run lasts for cycles cycles.
+
+    icall, ijmp, ret and reti have targets too: the program sets Z to
+    the target and pushes it before the returns. A skip before them
+    skips a nop, so they always go to an instruction. """
+
+    def __init__(self, length=16, cycles=500, *args, **kwargs):
+        self.length = length
+        self.cycles = cycles
+        self.reference = Reference(lazy_flags=False)
+        self.power_on = self.reference.snapshot()
+        self.machines = []
+        for name, kind, lazy_flags in ENGINES:
+            if kind == 'swarm':
+                if numpy is not None:
+                    self.machines.append((name, kind, Swarm(self.reference, 1)))
+            else:
+                machine = ATtiny13(lazy_flags=lazy_flags, blocks=kind == 'blocks')
+                self.machines.append((name, kind, machine))
+
+        # the words of every instruction, a command is chosen first, so
+        # the ones with few operands come as often as the others
+        alu = self.reference
+        self.words = {}
+        for word in xrange(65536):
+            mnemo = alu.parse(0, word, 0)
+            if mnemo is not None and mnemo[0] not in EXCLUDED:
+                self.words.setdefault(mnemo[0], []).append(word)
+        self.commands = sorted(self.words.keys())
+
+    def generate(self, rand):
+        """ Returns a random case, rand is random.Random. """
+        alu = self.reference
+        instructions = []
+        for i in xrange(self.length):
+            command = rand.choice(self.commands)
+            word = rand.choice(self.words[command])
+            (command, args) = alu.parse(0, word, rand.randrange(len(alu.data)))
+            target = None
+            if command in alu.branch_flags or command in JUMPS or command in INDIRECT:
+                target = rand.randint(max(0, i - 8), min(self.length, i + 8))
+            instructions.append((command, args, target))
+        data = bytearray(len(alu.data))
+        for i in range(32) + range(alu.sram, len(data)):
+            data[i] = rand.randrange(256)
+        for ptr in (26, 28, 30):
+            (data[ptr], data[ptr + 1]) = (rand.randint(alu.sram, alu.ramend), 0)
+        data[alu.sreg] = rand.randrange(256)
+        data[alu.spl] = alu.ramend
+        flash = bytearray([rand.randrange(256) for i in xrange(alu.flash_size)])
+        return (instructions, data, flash, self.cycles)
+
+    def prefix(self, command, target):
+        """ Returns the instructions which go before the jump through Z
+        or the stack to the word address target. """
+        if command not in INDIRECT:
+            return []
+        prefix = [('nop', None), ('ldi', (30, target & 255)), ('ldi', (31, target >> 8))]
+        if command in ('ret', 'reti'):
+            prefix += [('push', 30), ('push', 31)]
+        return prefix
+
+    def program(self, instructions):
+        """ Returns the code tree of the instructions followed by two
+        jumps to themselves, a skip may jump over the first one. """
+        alu = self.reference
+        addresses = [0]
+        for command, args, target in instructions:
+            addresses.append(addresses[-1] + alu.compiler.size(command) +
+                             2 * len(self.prefix(command, 0)))
+        code_tree = {}
+        for (command, args, target), addr in zip(instructions, addresses):
+            if target is not None:
+                for mnemo in self.prefix(command, addresses[target] >> 1):
+                    code_tree['%04x' % addr] = mnemo
+                    addr += 2
+            if target is not None and command not in INDIRECT:
+                k = (addresses[target] - addr - 2) >> 1
+                range = command in JUMPS and 4096 or 128
+                args = (k % range, k < 0)
+            code_tree['%04x' % addr] = (command, args)
+        for addr in (addresses[-1], addresses[-1] + 2):
+            code_tree['%04x' % addr] = ('rjmp', (4095, True))
+        return code_tree
+
+    def start(self, alu, code_tree, data, flash, code=None):
+        """ Sets the machine to the state of the case. """
+        alu.restore(self.power_on)
+        alu.eeprom.image.erase()
+        alu.data[:] = data
+        alu.load(code_tree, code, flash)
+
+    def state(self, alu):
+        """ Returns what has to be the same on every engine. """
+        alu.sreg_flush()
+        return (alu.pointer, alu.cycles, bytes(alu.data), tuple(alu.scheduler.get_events()),
+                str(buffer(alu.eeprom.memory)))
+
+    def reference_step(self, alu, cycles):
+        """ Executes one instruction with the reference handlers. """
+        mnemo = alu.code_tree.get('%04x' % alu.pointer)
+        if mnemo is None:
+            raise Exception('ERROR: %04x' % alu.pointer)
+        alu.step(mnemo[0], mnemo[1], cycles)
+
+    def step(self, alu, cycles):
+        """ Executes one function of the threaded code like step()
+        executes the reference handler. """
+        limit = alu.scheduler.next_cycle()
+        if limit is None or cycles < limit:
+            limit = cycles
+        alu.limit = limit
+        alu.pointer = alu.code[alu.pointer >> 1](alu)
+        alu.service()
+
+    def check(self, case):
+        """ Runs the case everywhere. Returns None or the divergence:
+        (engine, step or None, what differs). """
+        (instructions, data, flash, cycles) = case
+        code_tree = self.program(instructions)
+        alu = self.reference
+        self.start(alu, code_tree, data, flash)
+        alu.ports.clear()
+        states = [self.state(alu)]
+        error = None
+        try:
+            while alu.cycles < cycles:
+                self.reference_step(alu, cycles)
+                states.append(self.state(alu))
+        except Exception, e:
+            error = str(e)
+
+        # the threaded code is compiled once for each kind of flags,
+        # the engines of the same flags take it from the first one
+        codes = {alu.lazy_flags: alu.code}
+        for name, kind, machine in self.machines:
+            if kind == 'swarm':
+                divergence = self.check_swarm(machine, code_tree, data, states, error, cycles)
+            else:
+                self.start(machine, code_tree, data, flash, codes.get(machine.lazy_flags))
+                codes[machine.lazy_flags] = machine.code
+                if kind == 'blocks':
+                    divergence = self.check_blocks(machine, states, error, cycles)
+                elif kind == 'reference':
+                    divergence = self.check_steps(machine, self.reference_step, states,
+                                                  error, cycles)
+                else:
+                    divergence = self.check_steps(machine, self.step, states, error, cycles)
+            if divergence is not None:
+                return (name, ) + divergence
+        return None
+
+    def check_steps(self, alu, step, states, error, cycles):
+        """ Compares the states after every step(alu, cycles). """
+        for i in xrange(1, len(states)):
+            try:
+                step(alu, cycles)
+            except Exception, e:
+                return (i, 'raised %s' % (e, ))
+            state = self.state(alu)
+            if state != states[i]:
+                return (i, self.difference(states[i], state))
+        if error is None:
+            return None
+        # the next step has to raise the error of the reference
+        try:
+            step(alu, cycles)
+        except Exception, e:
+            if str(e) == error:
+                return None
+            return (len(states), 'raised %s' % (e, ))
+        return (len(states), 'did not raise %s' % (error, ))
+
+    def check_blocks(self, alu, states, error, cycles):
+        try:
+            alu.run(cycles)
+        except Exception, e:
+            if str(e) == error:
+                return None
+            return (None, 'raised %s' % (e, ))
+        if error is not None:
+            return (None, 'did not raise %s' % (error, ))
+        state = self.state(alu)
+        if state != states[-1]:
+            return (None, self.difference(states[-1], state))
+        return None
+
+    def check_swarm(self, swarm, code_tree, data, states, error, cycles):
+        """ Runs the case on the only instance of the swarm if the
+        swarm models the instructions and the ports the reference
+        accessed. The swarm stops where the reference raises. """
+        reference = self.reference
+        if not reference.ports <= SWARM_PORTS:
+            return None
+        for command, args in code_tree.values():
+            if command not in swarm.handlers:
+                return None
+        # lpm reads the flash of the reference, it has the case loaded
+        swarm.load(code_tree)
+        swarm.data[0] = numpy.frombuffer(bytes(data), numpy.uint8)
+        (swarm.pointer[0], swarm.cycles[0]) = states[0][:2]
+        swarm.stopped[0] = False
+        swarm.set_inputs(reference.portb.inputs, reference.portb.driven)
+        swarm.run(cycles)
+        if swarm.stopped[0]:
+            if error is None:
+                return (None, 'stopped at %04x' % (swarm.pointer[0], ))
+            return None
+        if error is not None:
+            return (None, 'did not stop on %s' % (error, ))
+        if ((swarm.data[0] & ~255) != 0).any():
+            return (None, 'data out of bytes %s' % (swarm.data[0], ))
+        state = (int(swarm.pointer[0]), int(swarm.cycles[0]),
+                 swarm.data[0].astype(numpy.uint8).tostring()) + states[-1][3:]
+        if state != states[-1]:
+            return (None, self.difference(states[-1], state))
+        return None
+
+    def difference(self, expected, got):
+        """ Returns the text telling how got differs from expected. """
+        parts = []
+        for name, a, b in zip(('pointer', 'cycles', 'data', 'events', 'eeprom'), expected, got):
+            if a == b:
+                continue
+            if name in ('data', 'eeprom'):
+                prefix = name == 'eeprom' and name or ''
+                parts += ['%s[%02x] %02x, not %02x' % (prefix, i, ord(x), ord(y))
+                          for i, (x, y) in enumerate(zip(a, b)) if x != y]
+            else:
+                parts.append('%s %s, not %s' % (name, a, b))
+        return '; '.join(parts)
+
+    def remove(self, instructions, index):
+        """ Returns the instructions without the one at index. """
+        result = []
+        for i, (command, args, target) in enumerate(instructions):
+            if i == index:
+                continue
+            if target is not None and target > index:
+                target -= 1
+            result.append((command, args, target))
+        return result
+
+    def minimize(self, case):
+        """ Removes the instructions one by one and lowers the cycles
+        while the case still fails. Returns the shortest failing case. """
+        (instructions, data, flash, cycles) = case
+        changed = True
+        while changed:
+            changed = False
+            for i in reversed(xrange(len(instructions))):
+                shorter = self.remove(instructions, i)
+                if self.check((shorter, data, flash, cycles)) is not None:
+                    (instructions, changed) = (shorter, True)
+        (low, high) = (0, cycles)
+        while high - low > 1:
+            middle = (low + high) // 2
+            if self.check((instructions, data, flash, middle)) is not None:
+                high = middle
+            else:
+                low = middle
+        return (instructions, data, flash, high)
+
+    def show(self, case):
+        """ Prints the case like ATtiny13.show() does. """
+        (instructions, data, flash, cycles) = case
+        alu = self.reference
+        print '%i cycles from' % (cycles, ),
+        print ' '.join(['r%i=%02x' % (i, data[i]) for i in xrange(32)]),
+        print 'SREG=%02x' % (data[alu.sreg], )
+        print '\tSRAM %s' % (str(data[alu.sram:]).encode('hex'), )
+        code_tree = self.program(instructions)
+        for key in sorted(code_tree.keys())[:-1]:
+            alu.pointer = int(key, 16)
+            alu.show(*code_tree[key])
+
+# every worker process keeps its fuzzer with the machines
+fuzzer = None
+
+def init_worker(length, cycles):
+    global fuzzer
+    fuzzer = Fuzzer(length, cycles)
+
+def case_random(seed, number):
+    return random.Random('%i:%i' % (seed, number))
+
+def run_chunk(task):
+    """ Checks count cases from first of the seed. Returns the count
+    and the failures: ((seed, number), divergence, minimized case). """
+    (seed, first, count) = task
+    failures = []
+    for number in xrange(first, first + count):
+        case = fuzzer.generate(case_random(seed, number))
+        if fuzzer.check(case) is not None:
+            case = fuzzer.minimize(case)
+            failures.append(((seed, number), fuzzer.check(case), case))
+    return (count, failures)
+
+def run_fuzz(count, seed=0, length=16, cycles=500, processes=None, chunk=200):
+    """ Checks count random cases in a pool of processes, yields the
+    number of the checked ones and the failures of every chunk as the
+    chunks come. """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    tasks = [(seed, first, min(chunk, count - first)) for first in xrange(0, count, chunk)]
+    pool = multiprocessing.Pool(processes, init_worker, (length, cycles))
+    try:
+        for result in pool.imap_unordered(run_chunk, tasks):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("-n", "--count", action="store", type="int", dest="count",
+                      help="number of cases", default=10000)
+    parser.add_option("-l", "--length", action="store", type="int", dest="length",
+                      help="instructions of a case", default=16)
+    parser.add_option("-c", "--cycles", action="store", type="int", dest="cycles",
+                      help="cycles of a case", default=500)
+    parser.add_option("-s", "--seed", action="store", type="int", dest="seed",
+                      help="seed of the cases", default=0)
+    parser.add_option("-j", "--jobs", action="store", type="int", dest="jobs",
+                      help="number of processes, all cores by default", default=None)
+    parser.add_option("-r", "--replay", action="store", type="int", dest="replay",
+                      help="check and show only this case of the seed", default=None)
+    (options, args) = parser.parse_args()
+
+    if options.replay is not None:
+        init_worker(options.length, options.cycles)
+        case = fuzzer.generate(case_random(options.seed, options.replay))
+        divergence = fuzzer.check(case)
+        if divergence is not None:
+            case = fuzzer.minimize(case)
+            divergence = fuzzer.check(case)
+        fuzzer.show(case)
+        print divergence or 'OK'
+        sys.exit(divergence is not None)
+
+    start = time.time()
+    (checked, failed) = (0, 0)
+    shower = Fuzzer(options.length, options.cycles)
+    for count, failures in run_fuzz(options.count, options.seed, options.length,
+                                    options.cycles, options.jobs):
+        checked += count
+        for (seed, number), (engine, step, text), case in failures:
+            failed += 1
+            print 'case %i of seed %i diverges on %s at step %s: %s' % (number, seed, engine, step, text)
+            shower.show(case)
+        sys.stderr.write('\r%i cases, %i failed, %.0f cases/s' %
+                         (checked, failed, checked / (time.time() - start)))
+    sys.stderr.write('\n')
+    sys.exit(failed != 0)
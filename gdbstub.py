@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# (c) 2009 Ruslan Popov <ruslan.popov@gmail.com>
+
+import binascii, os, select, socket, sys
+from optparse import OptionParser
+
+from watches import Watches, Breakpoint, Watchpoint
+
+# the address spaces of avr-gdb
+DATA = 0x800000
+EEPROM = 0x810000
+
+# cycles to run between the checks of Ctrl-C from gdb
+SLICE = 1000000
+
+# the stop replies of the watchpoints by their access
+WATCH_KINDS = {'w': 'watch', 'r': 'rwatch', 'rw': 'awatch'}
+
+# the accesses of the watchpoint types of Z packets
+Z_ACCESS = {'2': 'w', '3': 'r', '4': 'rw'}
+
+class GDBStub(object):
+    """ Server of the GDB remote serial protocol for avr-gdb. The
+    registers are r0..r31, SREG, SP and PC in bytes. The breakpoints
+    and the watchpoints of the Z packets become the points of Watches,
+    so continue runs the compiled code at full speed. The packets are
+    read in chunks and g/m answer with all the bytes asked at once, so
+    a stop costs gdb a few round trips only. """
+
+    def __init__(self, alu, rfd, wfd, *args, **kwargs):
+        self.alu = alu
+        self.rfd = rfd
+        self.wfd = wfd
+        self.input = ''
+        self.ack = True
+        self.watches = Watches(alu)
+        # the points of the Z packets by (type, address)
+        self.points = {}
+        self.applied = None
+        self.handlers = {'?': self.halt_reason, 'c': self.cont, 'D': self.detach,
+                         'g': self.read_registers, 'G': self.write_registers,
+                         'H': self.thread, 'k': self.kill, 'm': self.read_memory,
+                         'M': self.write_memory, 'p': self.read_register,
+                         'P': self.write_register, 'q': self.query, 'Q': self.set_query,
+                         's': self.step, 'X': self.write_binary,
+                         'z': self.remove_point, 'Z': self.insert_point}
+        self.running = False
+
+    def serve(self):
+        """ Answers the packets until gdb detaches or kills. """
+        self.running = True
+        while self.running:
+            packet = self.receive()
+            if packet is None:
+                break
+            handler = self.handlers.get(packet[:1])
+            if handler is None:
+                reply = ''
+            else:
+                try:
+                    reply = handler(packet[1:])
+                except Exception, e:
+                    sys.stderr.write('%s\n' % (e, ))
+                    reply = 'E01'
+            if reply is not None:
+                self.send(reply)
+
+    def fill(self):
+        """ Reads what there is, returns False at the end of input. """
+        chunk = os.read(self.rfd, 4096)
+        if not chunk:
+            return False
+        self.input += chunk
+        return True
+
+    def receive(self):
+        """ Returns the data of the next packet or None at the end of
+        input. Acks and Ctrl-C outside of a run are skipped. """
+        while True:
+            start = self.input.find('$')
+            if start >= 0:
+                end = self.input.find('#', start)
+                if end >= 0 and len(self.input) >= end + 3:
+                    data = self.input[start + 1:end]
+                    checksum = self.input[end + 1:end + 3]
+                    self.input = self.input[end + 3:]
+                    if int(checksum, 16) != sum(bytearray(data)) & 255:
+                        if self.ack:
+                            os.write(self.wfd, '-')
+                        continue
+                    if self.ack:
+                        os.write(self.wfd, '+')
+                    return data
+            if not self.fill():
+                return None
+
+    def send(self, data):
+        """ Sends the packet and waits for its ack. """
+        packet = '$%s#%02x' % (data, sum(bytearray(data)) & 255)
+        while True:
+            os.write(self.wfd, packet)
+            if not self.ack:
+                return
+            while True:
+                if not self.input and not self.fill():
+                    return
+                (char, self.input) = (self.input[0], self.input[1:])
+                if char == '+':
+                    return
+                if char == '-':
+                    break
+
+    def interrupted(self):
+        """ Returns True if gdb sent Ctrl-C during a run. """
+        if select.select([self.rfd], [], [], 0)[0]:
+            if not self.fill():
+                self.running = False
+                return True
+        if '\x03' in self.input:
+            self.input = self.input.replace('\x03', '')
+            return True
+        return False
+
+    def apply(self):
+        """ Compiles the code for the points, gdb inserts them before
+        every continue and removes them after it, so the code is
+        compiled again only when they change. """
+        points = sorted(self.points)
+        if points != self.applied:
+            self.watches.points = [self.points[key] for key in points]
+            self.watches.update()
+            self.applied = points
+
+    def halt_reason(self, data):
+        return 'S05'
+
+    def thread(self, data):
+        return 'OK'
+
+    def kill(self, data):
+        self.running = False
+        return None
+
+    def detach(self, data):
+        self.running = False
+        return 'OK'
+
+    def query(self, data):
+        if data.startswith('Supported'):
+            return 'PacketSize=4000;QStartNoAckMode+'
+        if data == 'Attached':
+            return '1'
+        if data == 'C':
+            return 'QC0'
+        return ''
+
+    def set_query(self, data):
+        if data == 'StartNoAckMode':
+            self.send('OK')
+            self.ack = False
+            return None
+        return ''
+
+    def registers(self):
+        """ Returns the registers of avr-gdb as bytes. """
+        alu = self.alu
+        alu.sreg_flush()
+        sp = alu.data[alu.spl]
+        pc = alu.pointer
+        return str(alu.data[:32]) + chr(alu.data[alu.sreg]) + \
+               chr(sp & 255) + chr(sp >> 8) + \
+               chr(pc & 255) + chr(pc >> 8 & 255) + chr(pc >> 16 & 255) + chr(pc >> 24)
+
+    def set_registers(self, number, value):
+        """ Sets the registers from number on to the bytes of value. """
+        alu = self.alu
+        value = bytearray(value)
+        while value:
+            if number < 32:
+                alu.set_reg(number, value.pop(0))
+            elif number == 32:
+                alu.set_port(alu.sreg - alu.io, value.pop(0))
+            elif number == 33:
+                # there is no SPH
+                alu.data[alu.spl] = value[0]
+                value = value[2:]
+            elif number == 34:
+                alu.pointer = (value[0] | value[1] << 8) & ~1
+                value = value[4:]
+            else:
+                raise Exception('ERROR: There is no register %i' % (number, ))
+            number += 1
+
+    def read_registers(self, data):
+        return binascii.hexlify(self.registers())
+
+    def write_registers(self, data):
+        self.set_registers(0, binascii.unhexlify(data))
+        return 'OK'
+
+    def read_register(self, data):
+        number = int(data, 16)
+        offsets = range(34) + [35, 39]
+        if number > 34:
+            return 'E01'
+        return binascii.hexlify(self.registers()[offsets[number]:offsets[number + 1]])
+
+    def write_register(self, data):
+        (number, value) = data.split('=')
+        self.set_registers(int(number, 16), binascii.unhexlify(value))
+        return 'OK'
+
+    def read_bytes(self, addr, length):
+        """ Returns length bytes of flash or of the data space. """
+        alu = self.alu
+        if addr >= EEPROM:
+            a = addr - EEPROM
+            if a + length > len(alu.eeprom.memory):
+                raise Exception('ERROR: Address %x is out of EEPROM' % (addr, ))
+            return str(bytearray(alu.eeprom.memory[a:a + length]))
+        if addr >= DATA:
+            a = addr - DATA
+            if a + length > len(alu.data):
+                raise Exception('ERROR: Address %x is out of the data space' % (addr, ))
+            alu.sreg_flush()
+            values = bytearray(alu.data[a:a + length])
+            # the ports are read through their hooks
+            for i in xrange(max(a, alu.io), min(a + length, alu.io + 64)):
+                values[i - a] = alu.io_read(i - alu.io)
+            return str(values)
+        if addr + length > len(alu.flash):
+            raise Exception('ERROR: Address %x is out of flash' % (addr, ))
+        return str(bytearray(alu.flash[addr:addr + length]))
+
+    def write_bytes(self, addr, values):
+        """ Writes the bytes to flash or to the data space. """
+        alu = self.alu
+        values = bytearray(values)
+        if addr >= EEPROM:
+            a = addr - EEPROM
+            if a + len(values) > len(alu.eeprom.memory):
+                raise Exception('ERROR: Address %x is out of EEPROM' % (addr, ))
+            alu.eeprom.memory[a:a + len(values)] = values
+            return
+        if addr >= DATA:
+            a = addr - DATA
+            if a + len(values) > len(alu.data):
+                raise Exception('ERROR: Address %x is out of the data space' % (addr, ))
+            for i, value in enumerate(values, a):
+                if alu.io <= i < alu.io + 64:
+                    alu.io_write(i - alu.io, value)
+                else:
+                    alu.data[i] = value
+            return
+        if addr + len(values) > len(alu.flash):
+            raise Exception('ERROR: Address %x is out of flash' % (addr, ))
+        flash = bytearray(alu.flash)
+        flash[addr:addr + len(values)] = values
+        first = addr & ~1
+        alu.write_words(first, [flash[word] | flash[word + 1] << 8
+                                for word in xrange(first, addr + len(values), 2)])
+
+    def read_memory(self, data):
+        (addr, length) = [int(value, 16) for value in data.split(',')]
+        return binascii.hexlify(self.read_bytes(addr, length))
+
+    def write_memory(self, data):
+        (place, values) = data.split(':')
+        addr = int(place.split(',')[0], 16)
+        self.write_bytes(addr, binascii.unhexlify(values))
+        return 'OK'
+
+    def write_binary(self, data):
+        (place, values) = data.split(':', 1)
+        addr = int(place.split(',')[0], 16)
+        # '}' escapes the next byte xored with 0x20
+        parts = values.split('}')
+        values = parts[0] + ''.join([chr(ord(part[0]) ^ 0x20) + part[1:]
+                                     for part in parts[1:] if part])
+        self.write_bytes(addr, values)
+        return 'OK'
+
+    def insert_point(self, data):
+        (kind, addr, length) = data.split(',')[:3]
+        addr = int(addr, 16)
+        if kind in ('0', '1'):
+            self.points.setdefault((kind, addr), Breakpoint(addr))
+            return 'OK'
+        if kind not in Z_ACCESS or addr < DATA:
+            return ''
+        for location in xrange(addr - DATA, addr - DATA + int(length, 16)):
+            if location == self.alu.sreg:
+                raise Exception('ERROR: SREG can not be watched')
+            self.points.setdefault((kind, location), Watchpoint(location, Z_ACCESS[kind]))
+        return 'OK'
+
+    def remove_point(self, data):
+        (kind, addr, length) = data.split(',')[:3]
+        addr = int(addr, 16)
+        keys = [(kind, addr)]
+        if kind in Z_ACCESS:
+            keys = [(kind, location) for location in xrange(addr - DATA, addr - DATA + int(length, 16))]
+        for key in keys:
+            self.points.pop(key, None)
+        return 'OK'
+
+    def resume(self, data):
+        if data:
+            self.alu.pointer = int(data, 16)
+        self.apply()
+
+    def cont(self, data):
+        """ Runs at full speed up to a point, a break instruction or
+        Ctrl-C. """
+        alu = self.alu
+        self.resume(data)
+        while True:
+            reason = alu.run(alu.cycles + SLICE, None, True)
+            if reason != 'cycles':
+                break
+            if self.interrupted():
+                return 'S02'
+        point = self.watches.hit
+        if reason == 'watch':
+            return 'T05%s:%x;' % (WATCH_KINDS[point.access], DATA + point.location)
+        return 'S05'
+
+    def step(self, data):
+        """ Executes one instruction. """
+        alu = self.alu
+        self.resume(data)
+        mnemo = alu.code_tree.get('%04x' % alu.pointer)
+        if mnemo is None:
+            return 'S04'
+        (command, args) = mnemo
+        alu.step(command, args)
+        return 'S05'
+
+if __name__ == '__main__':
+    from attiny13 import ATtiny13
+    from hex_loader import HexLoader
+
+    parser = OptionParser(usage='%prog [options]\n\n'
+                          '\tavr-gdb: target remote localhost:1234\n'
+                          '\t     or: target remote | python gdbstub.py --pipe -f some.hex')
+    parser.add_option("-f", "--hex-file", action="store", dest="hexfile",
+                      help="HEX file", default=None)
+    parser.add_option("-p", "--port", action="store", type="int", dest="port",
+                      help="listen to this TCP port on localhost", default=1234)
+    parser.add_option("--pipe", action="store_true", dest="pipe",
+                      help="talk to gdb through stdin and stdout", default=False)
+    parser.add_option("-e", "--eeprom", action="store", dest="eeprom",
+                      help="keep the EEPROM in this image file", default=None)
+    (options, args) = parser.parse_args()
+
+    if not options.hexfile:
+        print 'ERROR: Parameter hexfile is required!'
+        parser.print_help()
+        sys.exit(1)
+
+    alu = ATtiny13(eeprom=options.eeprom)
+    loader = HexLoader(alu, options.hexfile)
+    code_tree = loader.get_code_tree()
+    alu.load(code_tree, loader.get_code(code_tree), loader.image)
+
+    if options.pipe:
+        try:
+            GDBStub(alu, sys.stdin.fileno(), sys.stdout.fileno()).serve()
+        finally:
+            alu.eeprom.image.flush()
+        sys.exit(0)
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('127.0.0.1', options.port))
+    server.listen(1)
+    sys.stderr.write('waiting for gdb on port %i\n' % (options.port, ))
+    (connection, address) = server.accept()
+    server.close()
+    connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    try:
+        GDBStub(alu, connection.fileno(), connection.fileno()).serve()
+    finally:
+        connection.close()
+        alu.eeprom.image.flush()
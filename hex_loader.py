@@ -1,13 +1,21 @@
 # -*- coding: utf-8 -*-
 # (c) 2009 Ruslan Popov <ruslan.popov@gmail.com>
 
-import os, re
+import binascii, os
+from compiler import Compiler
 
 class HexLoader(object):
 
     def __init__(self, alu, filename, *args, **kwargs):
         self.alu = alu
         self.filename = filename
+        self.image = None
+        self.size = 0
+
+        # decoded programs are kept in the CodeCache, if any
+        self.cache = kwargs.get('cache', None)
+        self.code_tree = None
+        self.program = None
         self.record_types = {'00': 'Data',
                              '01': 'End of File',
                              '02': 'Extended Segment Address',
@@ -19,56 +27,78 @@ class HexLoader(object):
         """ Checks record count+addrH+addrL+type+sum(dd)+ss == 0x00. If
         checksum doesn't match, it raises exceptions, else silently
         return. """
-        checking = reduce(lambda x,y: x + y, [int(record[i*2:i*2+2], 16) for i in [x for x in xrange(len(record)/2)]])
-        if ('%02x' % checking)[-2:] != '00':
-            raise Exception ('ERROR: Checksum doesn\' match! Record is %s' % (record, ))
+        if sum(record) & 255:
+            raise Exception ('ERROR: Checksum doesn\' match! Record is %s' % (binascii.hexlify(record).upper(), ))
 
-    def get_code_tree(self):
-        """ Builds code tree. """
+    def get_image(self):
+        """ Reads the file line by line into the flash image, a
+        bytearray of the flash size with 0xff where nothing is loaded.
+        Any line ending will do. """
         if not os.path.isfile(self.filename):
             raise Exception('ERROR: Does the %s exist?' % (self.filename, ))
-        hex = open(self.filename, 'r').read().split('\r\n')
 
-        code_tree = {}
-        segment_address = 0
+        image = bytearray('\xff' * self.alu.flash_size)
+        self.size = 0
+        base = 0
 
-        for line in hex:
-            if len(line) == 0:
-                continue
-            self.check_record(line[1:])
-            regexp = re.compile(r"""
-                     ^\: # intel hex record start byte
-                     (?P<count>[0-9A-F]{2}) # record's byte count
-                     (?P<addr>[0-9A-F]{4}) # record's first address
-                     (?P<type>[0-9A-F]{2}) # record type
-                     (?P<data>[0-9A-F]*) # actual data (0..255 bytes)
-                     (?P<checksum>[0-9A-F]{2}) # checksum
-                     $""", re.X)
-            m = re.match(regexp, line)
-            if not m:
-                raise Exception('ERROR: This is not Intel HEX!')
-            (count, addr, rtype, data, checksum) = m.group('count', 'addr', 'type', 'data', 'checksum')
+        hex = open(self.filename, 'rU')
+        try:
+            for line in hex:
+                line = line.strip()
+                if len(line) == 0:
+                    continue
+                try:
+                    if line[0] != ':':
+                        raise TypeError(line)
+                    record = bytearray(binascii.unhexlify(line[1:]))
+                except (TypeError, binascii.Error):
+                    raise Exception('ERROR: This is not Intel HEX!')
+                self.check_record(record)
+                count = record[0]
+                if len(record) != count + 5:
+                    raise Exception('ERROR: This is not Intel HEX!')
+                rtype = record[3]
+                data = record[4:4 + count]
 
-            if rtype == '02':
-                segment_address = int(data, 16)
-            elif rtype == '01':
-                pass
-            elif rtype == '00':
-                record_start_address = segment_address + int(addr, 16)
-                op_addr = record_start_address
-                for i in xrange(len(data)/4):
-                    word = '%s%s' % (data[i*4+2:i*4+4], data[i*4:i*4+2])
-                    (mnemo, value) = self.alu.parse(op_addr, word)
+                if rtype == 0x00:
+                    addr = base + (record[1] << 8 | record[2])
+                    if addr + count > len(image):
+                        raise Exception('ERROR: Record at %04x does not fit the flash!' % (addr, ))
+                    image[addr:addr + count] = data
+                    self.size = max(self.size, addr + count)
+                elif rtype == 0x01:
+                    break
+                elif rtype == 0x02:
+                    base = (data[0] << 8 | data[1]) << 4
+                elif rtype == 0x04:
+                    base = (data[0] << 8 | data[1]) << 16
+        finally:
+            hex.close()
+        self.image = image
+        return image
 
-                    # operand synonyms
-                    if type(value) is tuple:
-                        if mnemo == 'eor' and value[0] == value[1]:
-                            mnemo = 'clr'
-                            value = value[0]
+    def get_code_tree(self):
+        """ Builds code tree from the flash image. A cached program
+        needs no decoding. """
+        image = self.get_image()
+        if self.cache is not None:
+            key = self.cache.key(image, self.alu.lazy_flags)
+            entry = self.cache.get(key)
+            if entry is not None:
+                (self.code_tree, self.program) = entry
+                return self.code_tree
 
-                    code_tree.update({'%04x' % op_addr: (mnemo, value)})
-                    op_addr += 2
-            else:
-                continue
+        code_tree = self.alu.decode_image(image, self.size)
+        self.code_tree = code_tree
+        self.program = None
+        if self.cache is not None:
+            self.program = Compiler(self.alu).program(code_tree)
+            self.cache.put(key, (code_tree, self.program))
         return code_tree
 
+    def get_code(self, code_tree):
+        """ Compiles code tree into threaded code. """
+        program = None
+        if code_tree is self.code_tree:
+            program = self.program
+        return Compiler(self.alu).compile(code_tree, program)
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# (c) 2009 Ruslan Popov <ruslan.popov@gmail.com>
+
+import ctypes, mmap, os
+
+class Image(object):
+    """ Non-volatile memory of the MCU, flash or EEPROM, kept in a
+    memory-mapped file. data is a ctypes array over the mapping, it is
+    indexed by integers like a bytearray, so lpm and the EEPROM read
+    and write the file with no copy.
+
+    A persistent image writes its changes into the file, it is created
+    or filled up to size with 0xff, the erased state. The other one
+    maps the file copy-on-write: the processes mapping the same file
+    share its pages until they change them, and the file never changes.
+    Without a file the memory is anonymous and erased. """
+
+    def __init__(self, size, path=None, persistent=False, *args, **kwargs):
+        self.size = size
+        self.path = path
+        self.persistent = persistent
+        if path is None:
+            self.mapping = mmap.mmap(-1, size)
+        else:
+            if persistent:
+                if not os.path.exists(path):
+                    open(path, 'wb').close()
+                image = open(path, 'r+b')
+            else:
+                image = open(path, 'rb')
+            try:
+                length = os.fstat(image.fileno()).st_size
+                if length < size:
+                    if not persistent:
+                        raise Exception('ERROR: Image %s is shorter than %i bytes!' % (path, size))
+                    image.seek(length)
+                    image.write('\xff' * (size - length))
+                    image.flush()
+                access = persistent and mmap.ACCESS_WRITE or mmap.ACCESS_COPY
+                self.mapping = mmap.mmap(image.fileno(), size, access=access)
+            finally:
+                # the mapping stays valid without the file
+                image.close()
+        self.data = (ctypes.c_ubyte * size).from_buffer(self.mapping)
+        if path is None:
+            self.erase()
+
+    def erase(self):
+        ctypes.memset(self.data, 0xff, self.size)
+
+    def write(self, image):
+        """ Copies the bytes of image from the start, the rest is erased. """
+        length = min(len(image), self.size)
+        self.data[:length] = bytearray(image[:length])
+        if length < self.size:
+            ctypes.memset(ctypes.byref(self.data, length), 0xff, self.size - length)
+
+    def flush(self):
+        """ Writes the changes of a persistent image to its file. """
+        if self.persistent and self.path is not None:
+            self.mapping.flush()
+
+def save_image(path, image, size=None):
+    """ Writes image into the file for Image, up to size bytes, the
+    missing ones are erased. """
+    data = bytearray(image)
+    if size is not None:
+        data = data[:size]
+        data.extend('\xff' * (size - len(data)))
+    output = open(path, 'wb')
+    try:
+        output.write(data)
+    finally:
+        output.close()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+# (c) 2009 Ruslan Popov <ruslan.popov@gmail.com>
+
+import collections
+
+from watches import Watchpoint
+
+class JournaledData(bytearray):
+    """ Data space which writes the old values of the changed bytes
+    into journal, a list of (index, old value), while it is set. """
+
+    journal = None
+
+    def __setitem__(self, index, value):
+        journal = self.journal
+        if journal is not None:
+            journal.append((index, bytearray.__getitem__(self, index)))
+        bytearray.__setitem__(self, index, value)
+
+class Journal(object):
+    """ Undo journal of the machine stepped instruction by
+    instruction. An entry keeps the registers of the CPU, the state of
+    the peripherals and the old values of the bytes the instruction
+    wrote, so stepping back costs only the changes. The EEPROM, the
+    flash and the page buffer of spm are not in the data space: the
+    machine logs their old values into alu.journal while it is set,
+    stepping back over spm writes the old words again with
+    write_words(). At most size entries are kept, the oldest ones go
+    first. """
+
+    def __init__(self, alu, size=100000, *args, **kwargs):
+        self.alu = alu
+        self.entries = collections.deque(maxlen=size)
+        if not isinstance(alu.data, JournaledData):
+            alu.data = JournaledData(alu.data)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get_state(self):
+        alu = self.alu
+        return (alu.pointer, alu.cycles, alu.pending, alu.sleeping, alu.inhibit,
+                [p.get_state() for p in alu.peripherals],
+                alu.scheduler.get_events())
+
+    def set_state(self, state):
+        alu = self.alu
+        (alu.pointer, alu.cycles, alu.pending, alu.sleeping, alu.inhibit,
+         peripherals, events) = state
+        for peripheral, values in zip(alu.peripherals, peripherals):
+            peripheral.set_state(*values)
+        alu.set_events(events)
+
+    def step(self, command, args):
+        """ Executes the instruction with alu.step() and keeps its entry. """
+        writes = []
+        memories = []
+        state = self.get_state()
+        alu = self.alu
+        data = alu.data
+        (data.journal, alu.journal) = (writes, memories)
+        try:
+            alu.step(command, args)
+        finally:
+            (data.journal, alu.journal) = (None, None)
+        self.entries.append((state, writes, memories))
+
+    def back(self):
+        """ Undoes the last instruction. Returns False if there is
+        nothing to undo. """
+        if not self.entries:
+            return False
+        (state, writes, memories) = self.entries.pop()
+        alu = self.alu
+        data = alu.data
+        for index, value in reversed(writes):
+            bytearray.__setitem__(data, index, value)
+        for memory, index, value in reversed(memories):
+            if memory == 'eeprom':
+                alu.eeprom.memory[index] = value
+            elif memory == 'flash':
+                # the code of the words is compiled again
+                alu.write_words(index, value)
+            else:
+                alu.page_buffer[index:index + len(value)] = value
+        self.set_state(state)
+        return True
+
+    def written(self, watches, writes):
+        """ Returns True if a watchpoint of watches catches the writes
+        of an entry, the values are the ones the data space has now.
+        The journal keeps only the writes, so the watchpoints of the
+        reads are not checked. """
+        data = self.alu.data
+        hit = False
+        for location in sorted(set([index for index, value in writes])):
+            for point in watches.points:
+                if isinstance(point, Watchpoint) and point.location == location and \
+                       'w' in point.access and point.check(self.alu, data[location]):
+                    watches.hit = point
+                    hit = True
+        return hit
+
+    def reverse_continue(self, stops, watches=None):
+        """ Steps back until the pointer reaches an address from stops,
+        a breakpoint of watches or an instruction which wrote a watched
+        location, or the journal is over. Returns the number of the
+        steps. """
+        count = 0
+        if watches is not None:
+            watches.hit = None
+        while self.entries:
+            written = watches is not None and self.written(watches, self.entries[-1][1])
+            self.back()
+            count += 1
+            if written or self.alu.pointer in stops:
+                break
+            if watches is not None and watches.reached(self.alu.pointer):
+                break
+        return count
@@ -0,0 +1,526 @@
+# -*- coding: utf-8 -*-
+# (c) 2009 Ruslan Popov <ruslan.popov@gmail.com>
+
+# Peripherals see their I/O ports through the hooks of the ALU: a read
+# hook hook(a, now) brings the port up to date for the cycle now, a
+# write hook hook(a, value, bits, now) stores the value. A hook which
+# can raise an interrupt or move an event sets alu.limit to 0, so the
+# run loop serves it after the current instruction. get_state() returns
+# what a snapshot keeps of the peripheral, packed with state_format.
+
+class Timer0(object):
+    """ 8-bit Timer/Counter0. TCNT0 and the flags of TIFR0 are counted
+    from the cycles passed only when somebody reads them or when the
+    nearest enabled interrupt of the timer is due. """
+
+    TCNT0 = 0x32
+    TCCR0A = 0x2f
+    TCCR0B = 0x33
+    OCR0A = 0x36
+    OCR0B = 0x29
+    TIMSK0 = 0x39
+    TIFR0 = 0x38
+
+    TOV0 = 0x02
+    OCF0A = 0x04
+    OCF0B = 0x08
+
+    # clock select, the external clock on T0 is not connected
+    prescalers = (0, 1, 8, 64, 256, 1024, 0, 0)
+
+    def __init__(self, alu, scheduler, *args, **kwargs):
+        self.alu = alu
+        self.scheduler = scheduler
+        alu.read_hooks[self.TCNT0] = self.read
+        alu.read_hooks[self.TIFR0] = self.read
+        for a in (self.TCCR0A, self.TCCR0B, self.OCR0A, self.OCR0B, self.TIMSK0):
+            alu.write_hooks[a] = self.write
+        alu.write_hooks[self.TCNT0] = self.write_counter
+        alu.write_hooks[self.TIFR0] = self.write_flags
+        self.reset()
+
+    state_format = '<QH'
+
+    def reset(self):
+        self.last = self.alu.cycles # the counter is counted up to this cycle
+        self.position = 0
+        self.scheduler.cancel('timer0')
+
+    def get_state(self):
+        return (self.last, self.position)
+
+    def set_state(self, last, position):
+        (self.last, self.position) = (last, position)
+
+    def port(self, a):
+        return self.alu.data[self.alu.io + a]
+
+    def mode(self):
+        """ Returns (waveform mode, top, period). The counter goes round
+        the positions 0..period-1, in the phase correct modes it counts
+        down in the second half of them. """
+        wgm = self.port(self.TCCR0A) & 3 | self.port(self.TCCR0B) >> 1 & 4
+        top = 255
+        if wgm in (2, 5, 7):
+            top = self.port(self.OCR0A)
+        if wgm in (1, 5):
+            return (wgm, top, max(1, 2 * top))
+        return (wgm, top, top + 1)
+
+    def value(self, position, top):
+        if position <= top:
+            return position
+        return 2 * top - position
+
+    def targets(self, wgm, top, period):
+        """ Returns (flag, positions) of the positions setting the flags. """
+        if wgm in (1, 5):
+            overflow = [0]
+        elif wgm in (3, 7):
+            overflow = [top]
+        elif top == 255:
+            overflow = [0]
+        else:
+            overflow = []
+        result = [(self.TOV0, overflow)]
+        for flag, a in ((self.OCF0A, self.OCR0A), (self.OCF0B, self.OCR0B)):
+            match = self.port(a)
+            if wgm in (1, 5):
+                positions = set([match % period, (period - match) % period])
+                result.append((flag, [p for p in positions if self.value(p, top) == match]))
+            else:
+                result.append((flag, [p for p in [match] if p < period]))
+        return result
+
+    def sync(self, now):
+        """ Counts the timer clocks up to now and sets the flags of the
+        positions passed. """
+        last = self.last
+        if now <= last:
+            return
+        self.last = now
+        prescaler = self.prescalers[self.port(self.TCCR0B) & 7]
+        if not prescaler:
+            return
+        ticks = now // prescaler - last // prescaler
+        if not ticks:
+            return
+        (wgm, top, period) = self.mode()
+        position = self.position
+        flags = 0
+        for flag, positions in self.targets(wgm, top, period):
+            for target in positions:
+                if (target - position - 1) % period < ticks:
+                    flags |= flag
+        self.position = (position + ticks) % period
+        data = self.alu.data
+        data[self.alu.io + self.TCNT0] = self.value(self.position, top)
+        data[self.alu.io + self.TIFR0] |= flags
+
+    def reschedule(self):
+        """ Schedules the nearest enabled interrupt of the timer. """
+        enabled = self.port(self.TIMSK0)
+        prescaler = self.prescalers[self.port(self.TCCR0B) & 7]
+        (wgm, top, period) = self.mode()
+        distances = [(target - self.position - 1) % period + 1
+                     for flag, positions in self.targets(wgm, top, period) if flag & enabled
+                     for target in positions]
+        if not prescaler or not distances:
+            self.scheduler.cancel('timer0')
+            return
+        cycle = (self.last // prescaler + min(distances)) * prescaler
+        self.scheduler.schedule('timer0', cycle, self.event)
+
+    def event(self, cycle):
+        self.sync(cycle)
+        self.reschedule()
+
+    def read(self, a, now):
+        self.sync(now)
+
+    def write(self, a, value, bits, now):
+        self.sync(now)
+        self.alu.data[self.alu.io + a] = value
+        (wgm, top, period) = self.mode()
+        self.position = self.port(self.TCNT0) % period
+        self.reschedule()
+        self.alu.limit = 0
+
+    def write_counter(self, a, value, bits, now):
+        self.sync(now)
+        (wgm, top, period) = self.mode()
+        self.alu.data[self.alu.io + a] = value
+        self.position = value % period
+        self.reschedule()
+        self.alu.limit = 0
+
+    def write_flags(self, a, value, bits, now):
+        # writing one clears the flag
+        self.sync(now)
+        self.alu.data[self.alu.io + a] &= ~value & 255
+
+class PortB(object):
+    """ I/O port B. PINB reads the outputs on the pins from DDRB, the
+    driven levels of the inputs, and the pull-ups of the inputs nobody
+    drives. Changes of the pins set PCIF for the pins from PCMSK, and
+    INTF0 for the pin INT0 as MCUCR tells. """
+
+    PCMSK = 0x15
+    PINB = 0x16
+    DDRB = 0x17
+    PORTB = 0x18
+    MCUCR = 0x35
+    GIFR = 0x3a
+    GIMSK = 0x3b
+
+    PCIF = 0x20
+    INTF0 = 0x40
+    INT0 = 0x02 # PB1
+
+    pins = 0x3f
+
+    def __init__(self, alu, *args, **kwargs):
+        self.alu = alu
+        self.inputs = 0
+        self.driven = 0
+        self.trace = None # (cycle, PINB) of the changes if it is a list
+        self.monitor = None # called as monitor(now, PORTB, DDRB, PINB) on updates
+        alu.write_hooks[self.PORTB] = self.write
+        alu.write_hooks[self.DDRB] = self.write
+        alu.write_hooks[self.PINB] = self.write_pins
+        alu.write_hooks[self.GIMSK] = self.write_mask
+        alu.write_hooks[self.MCUCR] = self.write_mask
+        alu.write_hooks[self.GIFR] = self.write_flags
+
+    def port(self, a):
+        return self.alu.data[self.alu.io + a]
+
+    state_format = '<BB'
+
+    def reset(self):
+        self.alu.data[self.alu.io + self.PINB] = self.levels()
+        if self.monitor is not None:
+            self.monitor(self.alu.cycles, self.port(self.PORTB), self.port(self.DDRB),
+                         self.port(self.PINB))
+
+    def get_state(self):
+        return (self.inputs, self.driven)
+
+    def set_state(self, inputs, driven):
+        (self.inputs, self.driven) = (inputs, driven)
+
+    def levels(self):
+        """ Returns the levels of the pins. """
+        (ddr, port) = (self.port(self.DDRB), self.port(self.PORTB))
+        return (port & ddr | self.inputs & self.driven & ~ddr | port & ~ddr & ~self.driven) & self.pins
+
+    def set_inputs(self, value, driven=0x3f):
+        """ Drives the pins from driven to the levels from value, the
+        other ones are left floating. """
+        self.inputs = value
+        self.driven = driven
+        self.update(self.alu.cycles)
+
+    def low_level(self, pins):
+        """ Returns INTF0 if the low level of INT0 raises the interrupt,
+        otherwise 0. """
+        if self.port(self.MCUCR) & 3 == 0 and not pins & self.INT0 and \
+               self.port(self.GIMSK) & self.INTF0:
+            return self.INTF0
+        return 0
+
+    def update(self, now):
+        """ Brings PINB up to date and sets the flags of the pin changes. """
+        data = self.alu.data
+        pins = self.levels()
+        changed = self.port(self.PINB) ^ pins
+        data[self.alu.io + self.PINB] = pins
+        if changed and self.trace is not None:
+            self.trace.append((now, pins))
+        if self.monitor is not None:
+            self.monitor(now, self.port(self.PORTB), self.port(self.DDRB), pins)
+        flags = 0
+        if changed & self.port(self.PCMSK):
+            flags |= self.PCIF
+        sense = self.port(self.MCUCR) & 3
+        if sense == 0:
+            # the low level raises the interrupt while it is enabled
+            flags |= self.low_level(pins)
+        elif changed & self.INT0:
+            if sense == 1 or (sense == 2) == (not pins & self.INT0):
+                flags |= self.INTF0
+        if flags:
+            data[self.alu.io + self.GIFR] |= flags
+            self.alu.limit = 0
+
+    def write(self, a, value, bits, now):
+        self.alu.data[self.alu.io + a] = value
+        self.update(now)
+
+    def write_pins(self, a, value, bits, now):
+        # writing one toggles the bit of PORTB
+        self.alu.data[self.alu.io + self.PORTB] ^= value & bits & self.pins
+        self.update(now)
+
+    def write_mask(self, a, value, bits, now):
+        data = self.alu.data
+        data[self.alu.io + a] = value
+        # enabling INT0 or its low level sense while the pin is low
+        # raises the interrupt at once
+        data[self.alu.io + self.GIFR] |= self.low_level(self.port(self.PINB))
+        self.alu.limit = 0
+
+    def write_flags(self, a, value, bits, now):
+        self.alu.data[self.alu.io + a] &= ~value & 255
+
+class Watchdog(object):
+    """ Watchdog timer clocked by its 128 kHz oscillator. The time-out
+    raises the WDT interrupt when WDTIE is set, otherwise it resets the
+    MCU when WDE is set. """
+
+    WDTCR = 0x21
+    MCUSR = 0x34
+
+    WDTIF = 0x80
+    WDTIE = 0x40
+    WDE = 0x08
+    WDRF = 0x08
+
+    frequency = 128000
+
+    def __init__(self, alu, scheduler, *args, **kwargs):
+        self.alu = alu
+        self.scheduler = scheduler
+        alu.write_hooks[self.WDTCR] = self.write
+        self.reset()
+
+    state_format = '<Q'
+
+    def reset(self):
+        self.start = self.alu.cycles
+        self.scheduler.cancel('watchdog')
+
+    def get_state(self):
+        return (self.start, )
+
+    def set_state(self, start):
+        self.start = start
+
+    def port(self, a):
+        return self.alu.data[self.alu.io + a]
+
+    def timeout(self):
+        """ Returns the time-out in the cycles of the MCU. """
+        value = self.port(self.WDTCR)
+        prescaler = min(9, value & 7 | value >> 2 & 8)
+        return (2048 << prescaler) * self.alu.frequency // self.frequency
+
+    def restart(self, now):
+        """ Starts the time-out again, as wdr does. """
+        self.start = now
+        self.reschedule()
+
+    def reschedule(self):
+        if self.port(self.WDTCR) & (self.WDTIE | self.WDE):
+            self.scheduler.schedule('watchdog', self.start + self.timeout(), self.event)
+        else:
+            self.scheduler.cancel('watchdog')
+
+    def event(self, cycle):
+        value = self.port(self.WDTCR)
+        if value & self.WDTIE:
+            value |= self.WDTIF
+            if value & self.WDE:
+                value &= ~self.WDTIE
+            self.alu.data[self.alu.io + self.WDTCR] = value
+        elif value & self.WDE:
+            self.alu.reset(self.WDRF)
+            # the reset flag keeps the watchdog on
+            self.alu.data[self.alu.io + self.WDTCR] = value
+        self.restart(cycle)
+
+    def write(self, a, value, bits, now):
+        # writing one clears the flag
+        flag = self.port(a) & self.WDTIF & ~value
+        self.alu.data[self.alu.io + a] = value & ~self.WDTIF | flag
+        self.reschedule()
+        self.alu.limit = 0
+
+class ADConverter(object):
+    """ 10-bit ADC. A conversion takes 13 ADC clocks, the first one
+    after the ADC is enabled takes 25. The result is the level of the
+    channel from samples. """
+
+    ADCSRB = 0x03
+    ADCL = 0x04
+    ADCH = 0x05
+    ADCSRA = 0x06
+    ADMUX = 0x07
+
+    ADEN = 0x80
+    ADSC = 0x40
+    ADATE = 0x20
+    ADIF = 0x10
+    ADLAR = 0x20
+
+    def __init__(self, alu, scheduler, *args, **kwargs):
+        self.alu = alu
+        self.scheduler = scheduler
+        self.samples = [0] * 4
+        alu.write_hooks[self.ADCSRA] = self.write
+        self.reset()
+
+    state_format = '<B4H'
+
+    def reset(self):
+        self.first = True
+        self.scheduler.cancel('adc')
+
+    def get_state(self):
+        return (self.first, ) + tuple(self.samples)
+
+    def set_state(self, first, *samples):
+        self.first = bool(first)
+        self.samples = list(samples)
+
+    def port(self, a):
+        return self.alu.data[self.alu.io + a]
+
+    def set_sample(self, channel, value):
+        self.samples[channel] = value & 0x3ff
+
+    def clock(self):
+        """ Returns the ADC clock in the cycles of the MCU. """
+        return max(2, 1 << (self.port(self.ADCSRA) & 7))
+
+    def write(self, a, value, bits, now):
+        status = self.port(a)
+        # writing one clears the flag, writing zero does not stop the conversion
+        value = value & ~self.ADIF | status & self.ADIF & ~value
+        if not value & self.ADEN:
+            value &= ~self.ADSC
+            self.first = True
+            self.scheduler.cancel('adc')
+        elif status & self.ADSC:
+            value |= self.ADSC
+        elif value & self.ADSC:
+            clocks = 13
+            if self.first:
+                clocks = 25
+            self.first = False
+            self.scheduler.schedule('adc', now + clocks * self.clock(), self.event)
+        self.alu.data[self.alu.io + a] = value
+        self.alu.limit = 0
+
+    def event(self, cycle):
+        data = self.alu.data
+        io = self.alu.io
+        mux = self.port(self.ADMUX)
+        value = self.samples[mux & 3]
+        if mux & self.ADLAR:
+            (data[io + self.ADCH], data[io + self.ADCL]) = (value >> 2, (value & 3) << 6)
+        else:
+            (data[io + self.ADCH], data[io + self.ADCL]) = (value >> 8, value & 255)
+        status = self.port(self.ADCSRA) | self.ADIF
+        if status & self.ADATE and not self.port(self.ADCSRB) & 7:
+            # free running mode
+            self.scheduler.schedule('adc', cycle + 13 * self.clock(), self.event)
+        else:
+            status &= ~self.ADSC
+        data[io + self.ADCSRA] = status
+
+class Eeprom(object):
+    """ 64 bytes of EEPROM behind EEARL, EEDR and EECR, kept in the
+    Image memory, so a persistent image keeps what the program wrote
+    over the runs. Reading sets EEDR at once, the halt of the MCU is
+    not modeled. Writing EEPE within four cycles after EEMPE programs
+    the byte as EEPM tells; the byte changes at once, EEPE stays set up
+    to the end of the programming time. EE_RDY is pending while EEPE is
+    clear and EERIE is set. """
+
+    EECR = 0x1c
+    EEDR = 0x1d
+    EEARL = 0x1e
+
+    EEPM = 0x30
+    EERIE = 0x08
+    EEMPE = 0x04
+    EEPE = 0x02
+    EERE = 0x01
+
+    # programming times in seconds of the modes from EEPM: erase and
+    # write, erase only, write only; the last one is reserved
+    times = (3.4e-3, 1.8e-3, 1.8e-3, None)
+
+    def __init__(self, alu, scheduler, image, *args, **kwargs):
+        self.alu = alu
+        self.scheduler = scheduler
+        self.image = image
+        self.memory = image.data
+        alu.read_hooks[self.EECR] = self.read
+        alu.write_hooks[self.EECR] = self.write
+        self.reset()
+
+    state_format = '<q'
+
+    def reset(self):
+        self.window = -1 # EEMPE is set up to this cycle
+        self.scheduler.cancel('eeprom')
+
+    def get_state(self):
+        return (self.window, )
+
+    def set_state(self, window):
+        self.window = window
+
+    def port(self, a):
+        return self.alu.data[self.alu.io + a]
+
+    def read(self, a, now):
+        if now > self.window:
+            self.alu.data[self.alu.io + a] &= ~self.EEMPE & 255
+
+    def write(self, a, value, bits, now):
+        data = self.alu.data
+        io = self.alu.io
+        status = self.port(a)
+        if now > self.window:
+            status &= ~self.EEMPE
+        if status & self.EEPE:
+            # the mode can not change while programming
+            value = value & ~self.EEPM | status & self.EEPM
+        elif value & bits & self.EERE:
+            data[io + self.EEDR] = self.memory[data[io + self.EEARL] & 63]
+        written = value & bits
+        if written & self.EEPE and status & (self.EEPE | self.EEMPE) == self.EEMPE:
+            status = self.program(value, now)
+        elif written & self.EEMPE and not written & self.EEPE:
+            status |= self.EEMPE
+            self.window = now + 4
+        data[io + a] = value & (self.EEPM | self.EERIE) | status & (self.EEMPE | self.EEPE)
+        self.alu.limit = 0
+
+    def program(self, value, now):
+        """ Programs the byte at EEARL, returns the new status bits. """
+        data = self.alu.data
+        io = self.alu.io
+        self.window = -1
+        mode = (value & self.EEPM) >> 4
+        if self.times[mode] is None:
+            return 0
+        addr = data[io + self.EEARL] & 63
+        if self.alu.journal is not None:
+            self.alu.journal.append(('eeprom', addr, self.memory[addr]))
+        if mode == 0:
+            self.memory[addr] = data[io + self.EEDR]
+        elif mode == 1:
+            self.memory[addr] = 0xff
+        else:
+            # writing only clears the bits
+            self.memory[addr] &= data[io + self.EEDR]
+        cycles = int(round(self.times[mode] * self.alu.frequency))
+        self.scheduler.schedule('eeprom', now + cycles, self.event)
+        return self.EEPE
+
+    def event(self, cycle):
+        self.alu.data[self.alu.io + self.EECR] &= ~self.EEPE & 255
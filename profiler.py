@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+# (c) 2009 Ruslan Popov <ruslan.popov@gmail.com>
+
+from array import array
+
+class Profiler(object):
+    """ Execution profile of the machine. The compiled code counts in
+    arrays indexed by word address: the executions of the threaded
+    code in hits, the passes of the blocks by their starts in passes,
+    and the jumps and skips the conditional instructions take in
+    taken. The counts of every instruction are put together only for
+    the report. """
+
+    def __init__(self, alu, *args, **kwargs):
+        self.alu = alu
+        size = alu.flash_size / 2
+        self.hits = array('L', [0] * size)
+        self.passes = array('L', [0] * size)
+        self.taken = array('L', [0] * size)
+        # the address after the block from the start
+        self.ends = [None] * size
+        self.start = alu.cycles
+
+    def block(self, start, following):
+        """ Takes the block compiled from start up to following. The
+        passes of another block from start go to its instructions. """
+        i = start >> 1
+        end = self.ends[i]
+        if end is not None and end != following:
+            self.spread(i, end)
+        self.ends[i] = following
+
+    def spread(self, i, end):
+        passes = self.passes[i]
+        for j in xrange(i, end >> 1):
+            self.hits[j] += passes
+        self.passes[i] = 0
+
+    def executions(self):
+        """ Returns the executions of the instructions by word address. """
+        counts = list(self.hits)
+        for i, end in enumerate(self.ends):
+            passes = self.passes[i]
+            if end is not None and passes:
+                for j in xrange(i, end >> 1):
+                    counts[j] += passes
+        return counts
+
+    def cycles(self, code_tree, counts):
+        """ Returns the cycles spent by the instructions by word address,
+        a taken jump or skip costs one more cycle. """
+        costs = self.alu.cycle_costs
+        spent = [0] * len(counts)
+        for key, (command, args) in code_tree.items():
+            i = int(key, 16) >> 1
+            spent[i] = counts[i] * costs.get(command, 1) + self.taken[i]
+        return spent
+
+    def target(self, addr, command, args):
+        """ Returns the address the instruction jumps to or None. """
+        if command in ('rcall', 'rjmp'):
+            (k, is_negative) = args
+            return addr + 2 * (k - 4096 * is_negative) + 2
+        if command in self.alu.branch_flags:
+            (k, is_negative) = args
+            return addr + 2 * (k - 128 * is_negative) + 2
+        return None
+
+    def functions(self, code_tree):
+        """ Returns the sorted starts of the functions: reset, the
+        handlers the interrupt vectors jump to if the program starts
+        with the table of the vectors and the targets of rcall. """
+        starts = set([0])
+        vectors = set()
+        if code_tree.get('0000', (None, None))[0] == 'rjmp':
+            vectors = set([entry[1] for entry in self.alu.interrupts])
+        for key, (command, args) in code_tree.items():
+            addr = int(key, 16)
+            if command == 'rcall' or (command == 'rjmp' and addr in vectors):
+                starts.add(self.target(addr, command, args))
+        return sorted(starts)
+
+    def function(self, starts, addr):
+        found = starts[0]
+        for start in starts:
+            if start > addr:
+                break
+            found = start
+        return found
+
+    def loops(self, code_tree, counts, spent):
+        """ Returns the loops made by the backward jumps as (cycles,
+        first address, last address, passes) from the hottest one. """
+        loops = []
+        for key, (command, args) in code_tree.items():
+            addr = int(key, 16)
+            if command == 'rcall':
+                continue
+            target = self.target(addr, command, args)
+            if target is None or target > addr:
+                continue
+            passes = self.taken[addr >> 1]
+            if command == 'rjmp':
+                passes = counts[addr >> 1]
+            cycles = sum(spent[target >> 1:(addr >> 1) + 1])
+            if cycles:
+                loops.append((cycles, target, addr, passes))
+        loops.sort(reverse=True)
+        return loops
+
+    def report(self, code_tree, top=None, hot=3):
+        """ Prints the instructions sorted by their cycles, the ones of
+        the hot hottest loops are marked with '*', then the loops, the
+        functions and the calls between them. """
+        counts = self.executions()
+        spent = self.cycles(code_tree, counts)
+        total = self.alu.cycles - self.start
+        executed = sum(spent)
+        percent = lambda cycles: 100.0 * cycles / max(1, total)
+
+        print 'profile of %i cycles, %i in the instructions, %i in sleep and interrupt entries' % \
+              (total, executed, total - executed)
+        print
+        loops = self.loops(code_tree, counts, spent)
+        marked = set()
+        for cycles, first, last, passes in loops[:hot]:
+            marked.update(xrange(first >> 1, (last >> 1) + 1))
+
+        print '    cycles       %      count      taken    addr : instruction'
+        order = sorted([i for i in xrange(len(spent)) if spent[i]], key=lambda i: -spent[i])
+        # the instructions are shown like ATtiny13.show() does at their
+        # addresses, see tracer.show_trace()
+        pointer = self.alu.pointer
+        try:
+            for i in order[:top]:
+                mark = ' '
+                if i in marked:
+                    mark = '*'
+                print '%10i %6.2f%% %10i %10i %s' % \
+                      (spent[i], percent(spent[i]), counts[i], self.taken[i], mark),
+                self.alu.pointer = i * 2
+                self.alu.show(*code_tree['%04x' % (i * 2)])
+        finally:
+            self.alu.pointer = pointer
+        print
+
+        print 'loops'
+        for cycles, first, last, passes in loops[:top]:
+            print '\t%04x - %04x : %10i cycles %6.2f%% %10i passes' % \
+                  (first, last, cycles, percent(cycles), passes)
+        print
+
+        starts = self.functions(code_tree)
+        own = dict([(start, 0) for start in starts])
+        for i, cycles in enumerate(spent):
+            if cycles:
+                own[self.function(starts, i * 2)] += cycles
+        print 'functions'
+        for start in sorted(starts, key=lambda start: -own[start]):
+            print '\t%04x : %10i cycles %6.2f%%' % (start, own[start], percent(own[start]))
+        print
+
+        calls = {}
+        for key, (command, args) in code_tree.items():
+            addr = int(key, 16)
+            if command == 'rcall' and counts[addr >> 1]:
+                edge = (self.function(starts, addr), self.target(addr, command, args))
+                calls[edge] = calls.get(edge, 0) + counts[addr >> 1]
+        print 'calls'
+        for (caller, callee), count in sorted(calls.items(), key=lambda item: -item[1]):
+            print '\t%04x -> %04x : %10i times' % (caller, callee, count)
+        print
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# (c) 2009 Ruslan Popov <ruslan.popov@gmail.com>
+
+import heapq
+
+class Scheduler(object):
+    """ Queue of peripheral events ordered by cycle. Every event has a
+    name, scheduling it again moves it to the new cycle. """
+
+    def __init__(self, *args, **kwargs):
+        self.queue = [] # heap of (cycle, sequence, name)
+        self.events = {} # name: (cycle, sequence, callback)
+        self.sequence = 0
+
+    def schedule(self, name, cycle, callback):
+        """ Calls callback(cycle) when the cycle comes. """
+        self.sequence += 1
+        self.events[name] = (cycle, self.sequence, callback)
+        heapq.heappush(self.queue, (cycle, self.sequence, name))
+
+    def cancel(self, name):
+        self.events.pop(name, None)
+
+    def clear(self):
+        self.queue = []
+        self.events = {}
+
+    def get_events(self):
+        """ Returns (name, cycle) of the scheduled events by cycle. """
+        events = sorted([(cycle, sequence, name) for name, (cycle, sequence, callback) in self.events.items()])
+        return [(name, cycle) for cycle, sequence, name in events]
+
+    def next_cycle(self):
+        """ Returns the cycle of the nearest event or None. """
+        queue = self.queue
+        while queue:
+            (cycle, sequence, name) = queue[0]
+            event = self.events.get(name)
+            if event is not None and event[1] == sequence:
+                return cycle
+            # moved or cancelled event
+            heapq.heappop(queue)
+        return None
+
+    def run(self, now):
+        """ Calls the callbacks of events due by now in their order. """
+        while True:
+            cycle = self.next_cycle()
+            if cycle is None or cycle > now:
+                break
+            (cycle, sequence, name) = heapq.heappop(self.queue)
+            (cycle, sequence, callback) = self.events.pop(name)
+            callback(cycle)
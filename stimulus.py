@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# (c) 2009 Ruslan Popov <ruslan.popov@gmail.com>
+
+import bisect, json
+
+class Stimulus(object):
+    """ Timeline of the inputs of the machine: (cycle, signal, value)
+    sorted by cycle. Only the nearest change is scheduled as the event
+    'stimulus', so the run loop stops exactly at it and at nothing
+    else. The event finds its place in the timeline by its cycle, so a
+    restored snapshot goes on from the right change.
+
+    Signals are pb0..pb5 with 0, 1 or 'z' to release the pin, pinb with
+    the levels of all the pins, adc0..adc3 with the 10-bit sample of the
+    channel, and the names of the interrupts with 1 to raise their flag.
+    INT0 and the pin change interrupt come from the pins as well. """
+
+    def __init__(self, alu, events, *args, **kwargs):
+        self.alu = alu
+        self.events = sorted(events, key=lambda event: event[0])
+        self.cycles = [event[0] for event in self.events]
+        # EE_RDY has no flag to raise
+        self.flags = dict([(entry[0], (entry[2], entry[3])) for entry in alu.interrupts
+                           if not entry[6]])
+        for cycle, signal, value in self.events:
+            self.check(signal, value)
+        alu.event_handlers['stimulus'] = self.event
+        self.schedule(bisect.bisect_left(self.cycles, alu.cycles))
+        alu.limit = 0
+
+    def check(self, signal, value):
+        """ Raises an exception for an unknown signal or a bad value. """
+        if signal[:2] == 'pb' and signal[2:] in ('0', '1', '2', '3', '4', '5'):
+            if value not in (0, 1, 'z'):
+                raise Exception('ERROR: Bad level %s of %s, it is 0, 1 or z' % (value, signal))
+        elif signal == 'pinb':
+            if value == 'z' or not 0 <= value < 64:
+                raise Exception('ERROR: Bad levels %s of pinb' % (value, ))
+        elif signal[:3] == 'adc' and signal[3:] in ('0', '1', '2', '3'):
+            if value == 'z' or not 0 <= value < 1024:
+                raise Exception('ERROR: Bad sample %s of %s' % (value, signal))
+        elif signal in self.flags:
+            if value != 1:
+                raise Exception('ERROR: Bad value %s of %s, it is 1' % (value, signal))
+        else:
+            raise Exception('ERROR: Unknown signal %s' % (signal, ))
+
+    def schedule(self, i):
+        if i < len(self.cycles):
+            self.alu.scheduler.schedule('stimulus', self.cycles[i], self.event)
+        else:
+            self.alu.scheduler.cancel('stimulus')
+
+    def event(self, cycle):
+        """ Applies the changes of the cycle, schedules the next ones. """
+        portb = self.alu.portb
+        (inputs, driven) = (portb.inputs, portb.driven)
+        i = bisect.bisect_left(self.cycles, cycle)
+        while i < len(self.cycles) and self.cycles[i] == cycle:
+            (cycle, signal, value) = self.events[i]
+            if signal[:2] == 'pb':
+                bit = 1 << int(signal[2:])
+                if value == 'z':
+                    driven &= ~bit
+                else:
+                    driven |= bit
+                    inputs = inputs & ~bit | bit * value
+            elif signal == 'pinb':
+                (inputs, driven) = (value, portb.pins)
+            elif signal[:3] == 'adc':
+                self.alu.adc.set_sample(int(signal[3:]), value)
+            else:
+                (flags, flag) = self.flags[signal]
+                self.alu.data[self.alu.io + flags] |= flag
+            i += 1
+        if (inputs, driven) != (portb.inputs, portb.driven):
+            (portb.inputs, portb.driven) = (inputs, driven)
+            portb.update(cycle)
+        self.schedule(i)
+
+def parse_value(text):
+    if text.strip().lower() == 'z':
+        return 'z'
+    return int(text, 0)
+
+def read_stimulus(filename):
+    """ Reads the timeline from the CSV file of cycle,signal,value lines
+    or, if its name ends with .jsonl, from JSON lines of objects with
+    these keys or of lists. Empty lines and the ones from # are skipped,
+    as is the CSV header. """
+    events = []
+    for number, line in enumerate(open(filename), 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            if filename.endswith('.jsonl'):
+                record = json.loads(line)
+                if isinstance(record, dict):
+                    record = (record['cycle'], record['signal'], record['value'])
+                (cycle, signal, value) = record
+                if not isinstance(value, int):
+                    value = parse_value(value)
+            else:
+                (cycle, signal, value) = [field.strip() for field in line.split(',')]
+                if number == 1 and cycle == 'cycle':
+                    continue
+                value = parse_value(value)
+            events.append((int(cycle), str(signal).lower(), value))
+        except (ValueError, KeyError, TypeError):
+            raise Exception('ERROR: Bad line %i of %s: %s' % (number, filename, line))
+    return events
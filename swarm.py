@@ -0,0 +1,550 @@
+# -*- coding: utf-8 -*-
+# (c) 2009 Ruslan Popov <ruslan.popov@gmail.com>
+
+from alu import ARITHMETIC, LOGIC, SHIFT, \
+     add_flags, flags_adiw, flags_sbiw, result_flags, sub_flags
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class Swarm(object):
+    """ Runs the same program on count instances at once. The data
+    spaces, pointers and cycles of the instances are NumPy arrays with
+    the instance as the first index. Every step groups the running
+    instances by their pointers and executes each instruction as array
+    operations over its group, so the instances may go their own ways.
+
+    The instances differ in their inputs: the levels of the pins of
+    port B, driven or floating like PortB does, and the samples of the
+    ADC. The flags are computed at once, the ADC converts at once,
+    timers, the watchdog, the EEPROM and the interrupts are left to
+    ATtiny13, sleep waits for the end of the run. The flags come from
+    the formulas, the tables of alu.py take no arrays. An instance
+    stops when it meets an address without code or spm, its stack
+    leaves SRAM or it accesses an address out of the data space. """
+
+    PINB = 0x16
+    DDRB = 0x17
+    PORTB = 0x18
+    ADCL = 0x04
+    ADCH = 0x05
+    ADCSRA = 0x06
+    ADMUX = 0x07
+    MCUCR = 0x35
+
+    def __init__(self, alu, count, *args, **kwargs):
+        if numpy is None:
+            raise Exception('ERROR: The swarm needs NumPy!')
+        self.alu = alu
+        self.count = count
+        self.io = alu.io
+        self.sreg = alu.sreg
+        self.spl = alu.spl
+        self.sram = alu.sram
+        self.ramend = alu.ramend
+
+        self.data = numpy.zeros((count, len(alu.data)), numpy.int32)
+        self.pointer = numpy.zeros(count, numpy.int32)
+        self.data[:, self.spl] = self.ramend
+        self.cycles = numpy.zeros(count, numpy.int64)
+        self.stopped = numpy.zeros(count, numpy.bool_)
+        self.inputs = numpy.zeros(count, numpy.int32)
+        self.driven = numpy.zeros(count, numpy.int32) + 0x3f
+        self.samples = numpy.zeros((count, 4), numpy.int32)
+        self.limit = 0
+
+        self.handlers = {'adc': self.adc, 'add': self.add, 'adiw': self.word,
+                         'and': self.and_op, 'andi': self.andi, 'asr': self.asr,
+                         'bclr': self.bclr, 'bld': self.bld, 'break': self.nop,
+                         'bset': self.bset, 'bst': self.bst, 'cbi': self.cbi,
+                         'cli': self.cli, 'clr': self.clr, 'com': self.com,
+                         'cp': self.subtract, 'cpc': self.subtract, 'cpi': self.subtract,
+                         'cpse': self.cpse, 'dec': self.dec, 'eor': self.eor,
+                         'icall': self.icall, 'ijmp': self.ijmp, 'in': self.in_op,
+                         'inc': self.inc, 'ld': self.ld, 'ldd': self.ld, 'ldi': self.ldi,
+                         'lds': self.lds, 'lpm': self.lpm, 'lsl': self.lsl,
+                         'lsr': self.lsr, 'mov': self.mov, 'movw': self.movw,
+                         'neg': self.neg, 'nop': self.nop, 'or': self.or_op,
+                         'ori': self.ori, 'out': self.out, 'pop': self.pop,
+                         'push': self.push, 'rcall': self.rcall, 'ret': self.ret,
+                         'reti': self.reti, 'rjmp': self.rjmp, 'rol': self.rol,
+                         'ror': self.ror, 'sbc': self.subtract, 'sbci': self.subtract,
+                         'sbi': self.sbi, 'sbic': self.sbic, 'sbis': self.sbis,
+                         'sbiw': self.word, 'sbrc': self.sbrc, 'sbrs': self.sbrs,
+                         'sei': self.sei, 'sleep': self.sleep, 'st': self.st,
+                         'std': self.st, 'sts': self.sts, 'sub': self.subtract,
+                         'subi': self.subtract, 'swap': self.swap, 'tst': self.tst,
+                         'wdr': self.nop}
+        for command in alu.branch_flags:
+            self.handlers[command] = self.branch
+        self.program = {}
+        self.code_tree = {}
+
+    def load(self, code_tree):
+        """ Sets the program, every instruction gets its handler. lpm
+        reads the flash of alu. """
+        self.program = {}
+        self.code_tree = code_tree
+        self.flash = numpy.frombuffer(self.alu.flash, numpy.uint8).astype(numpy.int32)
+        for key, (command, args) in code_tree.items():
+            if command in self.handlers:
+                addr = int(key, 16)
+                self.program[addr] = (self.handlers[command], command, args,
+                                      self.alu.cycle_costs.get(command, 1),
+                                      addr + self.alu.compiler.size(command))
+
+    def set_inputs(self, levels, driven=0x3f):
+        """ Drives the pins of port B of every instance from driven to
+        the levels, the other ones are left floating. """
+        self.inputs[:] = levels
+        self.driven[:] = driven
+        self.update_pins(numpy.arange(self.count))
+
+    def set_samples(self, channel, values):
+        """ Sets the ADC samples of the channel of every instance. """
+        self.samples[:, channel] = numpy.asarray(values) & 0x3ff
+
+    def run(self, max_cycles):
+        """ Runs every instance up to max_cycles cycles. """
+        self.limit = max_cycles
+        while True:
+            running = numpy.flatnonzero((self.cycles < max_cycles) & ~self.stopped)
+            if not len(running):
+                break
+            pointers = self.pointer[running]
+            if pointers.min() == pointers.max():
+                self.execute(int(pointers[0]), running)
+                continue
+            order = numpy.argsort(pointers, kind='mergesort')
+            (running, pointers) = (running[order], pointers[order])
+            starts = numpy.flatnonzero(numpy.diff(pointers)) + 1
+            for group in numpy.split(numpy.arange(len(running)), starts):
+                self.execute(int(pointers[group[0]]), running[group])
+
+    def execute(self, addr, i):
+        """ Executes the instruction at addr on the instances i. """
+        entry = self.program.get(addr)
+        if entry is None:
+            self.stopped[i] = True
+            return
+        (handler, command, args, cost, following) = entry
+        self.pointer[i] = following
+        self.cycles[i] += cost
+        handler(i, addr, command, args)
+
+    def get_regs(self, n):
+        return self.data[n, :32]
+
+    def get_ports(self, n):
+        return self.data[n, self.io:self.io + 64]
+
+    def update(self, i, mask, flags):
+        s = self.sreg
+        self.data[i, s] = self.data[i, s] & ~mask | flags
+
+    def update_pins(self, i):
+        d = self.data
+        (ddr, port) = (d[i, self.io + self.DDRB], d[i, self.io + self.PORTB])
+        driven = self.driven[i]
+        # a floating input reads its pull-up, see PortB.levels()
+        d[i, self.io + self.PINB] = (port & ddr | self.inputs[i] & driven & ~ddr |
+                                     port & ~ddr & ~driven) & 0x3f
+
+    def write_port(self, i, a, value, bits=255):
+        d = self.data
+        if a == self.PINB:
+            # writing one toggles the bit of PORTB
+            d[i, self.io + self.PORTB] ^= value & bits & 0x3f
+        else:
+            d[i, self.io + a] = value
+        if a in (self.PINB, self.DDRB, self.PORTB):
+            self.update_pins(i)
+        elif a == self.ADCSRA:
+            self.convert(i)
+
+    def convert(self, i):
+        """ Completes the conversions started on the instances i. """
+        d = self.data
+        status = d[i, self.io + self.ADCSRA]
+        i = i[(status & 0xc0) == 0xc0]
+        mux = d[i, self.io + self.ADMUX]
+        value = self.samples[i, mux & 3]
+        left = (mux & 0x20) != 0
+        d[i, self.io + self.ADCH] = numpy.where(left, value >> 2, value >> 8)
+        d[i, self.io + self.ADCL] = numpy.where(left, (value & 3) << 6, value & 255)
+        d[i, self.io + self.ADCSRA] = d[i, self.io + self.ADCSRA] & ~0x40 | 0x10
+
+    def put(self, i, values):
+        """ Puts the values, arrays over i or numbers, onto the stacks
+        in SRAM. The instances without room for them stop. """
+        d = self.data
+        sp = d[i, self.spl]
+        room = (sp - len(values) + 1 >= self.sram) & (sp <= self.ramend)
+        self.stopped[i[~room]] = True
+        (i, sp) = (i[room], sp[room])
+        for n, value in enumerate(values):
+            d[i, sp - n] = value if numpy.isscalar(value) else value[room]
+        d[i, self.spl] = sp - len(values)
+
+    def pull(self, i, count):
+        """ Returns the instances with count bytes on the stack and the
+        bytes taken there in the order they were put, the rest of the
+        instances stop. """
+        d = self.data
+        sp = d[i, self.spl] + count
+        inside = (sp - count + 1 >= self.sram) & (sp <= self.ramend)
+        self.stopped[i[~inside]] = True
+        (i, sp) = (i[inside], sp[inside])
+        d[i, self.spl] = sp
+        return (i, [d[i, sp - n] for n in xrange(count)])
+
+    def skip(self, i, addr, skip):
+        """ Moves the instances i where skip is set over the next
+        instruction. """
+        entry = self.code_tree.get('%04x' % (addr + 2))
+        size = 2
+        if entry is not None:
+            size = self.alu.compiler.size(entry[0])
+        self.pointer[i] += skip * size
+        self.cycles[i] += skip * (size >> 1)
+
+    def address(self, i, command, ptr, mode):
+        """ Returns the addresses of ld, ldd, st or std on the instances
+        i, see Compiler.address(). """
+        d = self.data
+        x = d[i, ptr] | d[i, ptr + 1] << 8
+        if command in ('ldd', 'std'):
+            return x + mode
+        if mode:
+            w = (x + mode) & 0xffff
+            d[i, ptr] = w & 255
+            d[i, ptr + 1] = w >> 8
+            if mode < 0:
+                x = w
+        return x
+
+    def inside(self, i, x):
+        """ Returns the instances i and their addresses x within the
+        data space, the rest of them stop. """
+        inside = x < self.data.shape[1]
+        self.stopped[i[~inside]] = True
+        return (i[inside], x[inside])
+
+    def target(self, addr, args, range):
+        (k, is_negative) = args
+        if is_negative:
+            k -= range
+        return addr + 2 * k + 2
+
+    def adc(self, i, addr, command, args):
+        (rd, rr) = args
+        d = self.data
+        (a, b) = (d[i, rd], d[i, rr])
+        r = a + b + (d[i, self.sreg] & 1)
+        d[i, rd] = r & 255
+        self.update(i, ARITHMETIC, add_flags(a, b, r))
+
+    def add(self, i, addr, command, args):
+        (rd, rr) = args
+        d = self.data
+        (a, b) = (d[i, rd], d[i, rr])
+        r = a + b
+        d[i, rd] = r & 255
+        self.update(i, ARITHMETIC, add_flags(a, b, r))
+
+    def and_op(self, i, addr, command, args):
+        (rd, rr) = args
+        r = self.data[i, rd] & self.data[i, rr]
+        self.data[i, rd] = r
+        self.update(i, LOGIC, result_flags(r, 0, 0))
+
+    def andi(self, i, addr, command, args):
+        (rd, k) = args
+        r = self.data[i, rd] & k
+        self.data[i, rd] = r
+        self.update(i, LOGIC, result_flags(r, 0, 0))
+
+    def asr(self, i, addr, command, rd):
+        a = self.data[i, rd]
+        r = a >> 1 | a & 128
+        self.data[i, rd] = r
+        self.update(i, SHIFT, result_flags(r, r >> 7 ^ a & 1, a & 1))
+
+    def bclr(self, i, addr, command, s):
+        self.data[i, self.sreg] &= ~(1 << s)
+
+    def bld(self, i, addr, command, args):
+        (rd, b) = args
+        d = self.data
+        t = d[i, self.sreg] & 0x40
+        d[i, rd] = numpy.where(t, d[i, rd] | 1 << b, d[i, rd] & ~(1 << b))
+
+    def branch(self, i, addr, command, args):
+        (flag, state) = self.alu.branch_flags[command]
+        bit = self.alu.flags[flag]
+        taken = (self.data[i, self.sreg] >> bit & 1) == int(state)
+        self.pointer[i] = numpy.where(taken, self.target(addr, args, 128), addr + 2)
+        self.cycles[i] += taken
+
+    def bset(self, i, addr, command, s):
+        self.data[i, self.sreg] |= 1 << s
+
+    def bst(self, i, addr, command, args):
+        (rd, b) = args
+        d = self.data
+        s = d[i, self.sreg]
+        d[i, self.sreg] = numpy.where(d[i, rd] & 1 << b, s | 0x40, s & ~0x40)
+
+    def cbi(self, i, addr, command, args):
+        (a, b) = args
+        self.write_port(i, a, self.data[i, self.io + a] & ~(1 << b), 1 << b)
+
+    def cli(self, i, addr, command, args):
+        self.data[i, self.sreg] &= ~0x80
+
+    def clr(self, i, addr, command, rd):
+        self.data[i, rd] = 0
+        self.update(i, LOGIC, result_flags(0, 0, 0))
+
+    def com(self, i, addr, command, rd):
+        r = self.data[i, rd] ^ 255
+        self.data[i, rd] = r
+        self.update(i, SHIFT, result_flags(r, 0, 1))
+
+    def cpse(self, i, addr, command, args):
+        (rd, rr) = args
+        self.skip(i, addr, self.data[i, rd] == self.data[i, rr])
+
+    def dec(self, i, addr, command, rd):
+        r = (self.data[i, rd] - 1) & 255
+        self.data[i, rd] = r
+        self.update(i, LOGIC, result_flags(r, r == 127, 0))
+
+    def eor(self, i, addr, command, args):
+        (rd, rr) = args
+        r = self.data[i, rd] ^ self.data[i, rr]
+        self.data[i, rd] = r
+        self.update(i, LOGIC, result_flags(r, 0, 0))
+
+    def icall(self, i, addr, command, args):
+        following = (addr + 2) >> 1
+        self.put(i, [following & 255, following >> 8])
+        self.ijmp(i, addr, command, args)
+
+    def ijmp(self, i, addr, command, args):
+        self.pointer[i] = (self.data[i, 31] << 8 | self.data[i, 30]) << 1
+
+    def in_op(self, i, addr, command, args):
+        (rd, a) = args
+        self.data[i, rd] = self.data[i, self.io + a]
+
+    def inc(self, i, addr, command, rd):
+        r = (self.data[i, rd] + 1) & 255
+        self.data[i, rd] = r
+        self.update(i, LOGIC, result_flags(r, r == 128, 0))
+
+    def ld(self, i, addr, command, args):
+        (rd, ptr, mode) = args
+        (i, x) = self.inside(i, self.address(i, command, ptr, mode))
+        self.data[i, rd] = self.data[i, x]
+
+    def ldi(self, i, addr, command, args):
+        (rd, k) = args
+        self.data[i, rd] = k
+
+    def lds(self, i, addr, command, args):
+        (rd, k) = args
+        if k >= self.data.shape[1]:
+            self.stopped[i] = True
+            return
+        self.data[i, rd] = self.data[i, k]
+
+    def lpm(self, i, addr, command, args):
+        (rd, increment) = args
+        d = self.data
+        z = d[i, 30] | d[i, 31] << 8
+        d[i, rd] = self.flash[z % len(self.flash)]
+        if increment:
+            z = (z + 1) & 0xffff
+            d[i, 30] = z & 255
+            d[i, 31] = z >> 8
+
+    def lsl(self, i, addr, command, rd):
+        a = self.data[i, rd]
+        r = a << 1
+        self.data[i, rd] = r & 255
+        self.update(i, ARITHMETIC, add_flags(a, a, r))
+
+    def lsr(self, i, addr, command, rd):
+        a = self.data[i, rd]
+        r = a >> 1
+        self.data[i, rd] = r
+        self.update(i, SHIFT, result_flags(r, a & 1, a & 1))
+
+    def mov(self, i, addr, command, args):
+        (rd, rr) = args
+        self.data[i, rd] = self.data[i, rr]
+
+    def movw(self, i, addr, command, args):
+        (rd, rr) = args
+        self.data[i, rd:rd + 2] = self.data[i, rr:rr + 2]
+
+    def neg(self, i, addr, command, rd):
+        a = self.data[i, rd]
+        r = -a
+        self.data[i, rd] = r & 255
+        self.update(i, ARITHMETIC, sub_flags(0, a, r))
+
+    def nop(self, i, addr, command, args):
+        pass
+
+    def or_op(self, i, addr, command, args):
+        (rd, rr) = args
+        r = self.data[i, rd] | self.data[i, rr]
+        self.data[i, rd] = r
+        self.update(i, LOGIC, result_flags(r, 0, 0))
+
+    def ori(self, i, addr, command, args):
+        (rd, k) = args
+        r = self.data[i, rd] | k
+        self.data[i, rd] = r
+        self.update(i, LOGIC, result_flags(r, 0, 0))
+
+    def out(self, i, addr, command, args):
+        (a, rr) = args
+        self.write_port(i, a, self.data[i, rr])
+
+    def pop(self, i, addr, command, rd):
+        (i, (value, )) = self.pull(i, 1)
+        self.data[i, rd] = value
+
+    def push(self, i, addr, command, rr):
+        self.put(i, [self.data[i, rr]])
+
+    def rcall(self, i, addr, command, args):
+        following = (addr + 2) >> 1
+        self.put(i, [following & 255, following >> 8])
+        self.pointer[i] = self.target(addr, args, 4096)
+
+    def ret(self, i, addr, command, args):
+        (i, (low, high)) = self.pull(i, 2)
+        self.pointer[i] = (high << 8 | low) << 1
+
+    def reti(self, i, addr, command, args):
+        self.data[i, self.sreg] |= 0x80
+        (i, (low, high)) = self.pull(i, 2)
+        self.pointer[i] = (high << 8 | low) << 1
+
+    def rjmp(self, i, addr, command, args):
+        self.pointer[i] = self.target(addr, args, 4096)
+
+    def rol(self, i, addr, command, rd):
+        d = self.data
+        a = d[i, rd]
+        r = a << 1 | d[i, self.sreg] & 1
+        d[i, rd] = r & 255
+        self.update(i, ARITHMETIC, add_flags(a, a, r))
+
+    def ror(self, i, addr, command, rd):
+        d = self.data
+        a = d[i, rd]
+        r = a >> 1 | (d[i, self.sreg] & 1) << 7
+        d[i, rd] = r
+        self.update(i, SHIFT, result_flags(r, r >> 7 ^ a & 1, a & 1))
+
+    def sbi(self, i, addr, command, args):
+        (a, b) = args
+        self.write_port(i, a, self.data[i, self.io + a] | 1 << b, 1 << b)
+
+    def sbic(self, i, addr, command, args):
+        (a, b) = args
+        self.skip(i, addr, (self.data[i, self.io + a] & 1 << b) == 0)
+
+    def sbis(self, i, addr, command, args):
+        (a, b) = args
+        self.skip(i, addr, (self.data[i, self.io + a] & 1 << b) != 0)
+
+    def sbrc(self, i, addr, command, args):
+        (rr, b) = args
+        self.skip(i, addr, (self.data[i, rr] & 1 << b) == 0)
+
+    def sbrs(self, i, addr, command, args):
+        (rr, b) = args
+        self.skip(i, addr, (self.data[i, rr] & 1 << b) != 0)
+
+    def sei(self, i, addr, command, args):
+        self.data[i, self.sreg] |= 0x80
+
+    def sleep(self, i, addr, command, args):
+        # nothing wakes the instances up, they sleep to the end of the run
+        asleep = (self.data[i, self.io + self.MCUCR] & 0x20) != 0
+        i = i[asleep]
+        self.pointer[i] = addr
+        self.cycles[i] = numpy.maximum(self.cycles[i], self.limit)
+
+    def st(self, i, addr, command, args):
+        (rr, ptr, mode) = args
+        x = self.address(i, command, ptr, mode)
+        value = self.data[i, rr]
+        inside = x < self.data.shape[1]
+        self.stopped[i[~inside]] = True
+        (i, x, value) = (i[inside], x[inside], value[inside])
+        # the ports go one by one through write_port()
+        port = (x >= self.io) & (x < self.io + 64)
+        self.data[i[~port], x[~port]] = value[~port]
+        for a in numpy.unique(x[port]):
+            chosen = port & (x == a)
+            self.write_port(i[chosen], a - self.io, value[chosen])
+
+    def sts(self, i, addr, command, args):
+        (rr, k) = args
+        if k >= self.data.shape[1]:
+            self.stopped[i] = True
+        elif self.io <= k < self.io + 64:
+            self.write_port(i, k - self.io, self.data[i, rr])
+        else:
+            self.data[i, k] = self.data[i, rr]
+
+    def subtract(self, i, addr, command, args):
+        """ Executes sub, sbc, cp, cpc and their immediate forms. """
+        (rd, rr) = args
+        d = self.data
+        a = d[i, rd]
+        b = rr
+        if command not in ('cpi', 'sbci', 'subi'):
+            b = d[i, rr]
+        r = a - b
+        if command in ('cpc', 'sbc', 'sbci'):
+            # Z stays set only if it was set
+            s = d[i, self.sreg]
+            r -= s & 1
+            flags = sub_flags(a, b, r) & (~2 | s)
+        else:
+            flags = sub_flags(a, b, r)
+        if command not in ('cp', 'cpc', 'cpi'):
+            d[i, rd] = r & 255
+        self.update(i, ARITHMETIC, flags)
+
+    def swap(self, i, addr, command, rd):
+        v = self.data[i, rd]
+        self.data[i, rd] = (v << 4 | v >> 4) & 255
+
+    def tst(self, i, addr, command, rd):
+        self.update(i, LOGIC, result_flags(self.data[i, rd], 0, 0))
+
+    def word(self, i, addr, command, args):
+        """ Executes adiw and sbiw. """
+        (rd, k) = args
+        d = self.data
+        a = d[i, rd] | d[i, rd + 1] << 8
+        if command == 'adiw':
+            r = a + k
+            flags = flags_adiw(a, k, r)
+        else:
+            r = a - k
+            flags = flags_sbiw(a, k, r)
+        d[i, rd] = r & 255
+        d[i, rd + 1] = r >> 8 & 255
+        self.update(i, SHIFT, flags)
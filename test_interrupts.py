@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# (c) 2009 Ruslan Popov <ruslan.popov@gmail.com>
+
+import unittest
+
+from attiny13 import ATtiny13
+
+def ldi(d, k): return 0xe000 | (k & 0xf0) << 4 | (d - 16) << 4 | k & 0x0f
+def out(a, r): return 0xb800 | (a & 0x30) << 5 | r << 4 | a & 0x0f
+def inc(d): return 0x9403 | d << 4
+def rjmp(k): return 0xc000 | k & 0xfff
+RETI, SEI = 0x9518, 0x9478
+
+class LowLevelTest(unittest.TestCase):
+    """ The low level of INT0 raises the interrupt as long as PB1 stays
+    low, so the handler runs again after every reti. """
+
+    def test_again(self):
+        # the handler of INT0 at 0002 counts in r20, the main program
+        # enables INT0 with the low level sense of MCUCR
+        words = [rjmp(2), inc(20), RETI, SEI, ldi(16, 0x40), out(0x3b, 16), rjmp(-1)]
+        for blocks in (False, True):
+            alu = ATtiny13(blocks=blocks)
+            code_tree = {}
+            for i, word in enumerate(words):
+                code_tree['%04x' % (i * 2)] = alu.parse(i * 2, word)
+            alu.load(code_tree)
+            alu.portb.set_inputs(0x00)
+            alu.run(200)
+            self.assertTrue(alu.data[20] > 1, 'blocks %s: %i calls' % (blocks, alu.data[20]))
+
+            # the handler stops with the pin high
+            alu.portb.set_inputs(0x02)
+            count = alu.data[20]
+            alu.run(alu.cycles + 200)
+            self.assertTrue(alu.data[20] - count <= 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# (c) 2009 Ruslan Popov <ruslan.popov@gmail.com>
+
+import unittest
+
+from attiny13 import ATtiny13
+
+def ldi(d, k): return 0xe000 | (k & 0xf0) << 4 | (d - 16) << 4 | k & 0x0f
+def out(a, r): return 0xb800 | (a & 0x30) << 5 | r << 4 | a & 0x0f
+def sbi(a, b): return 0x9a00 | a << 3 | b
+def mov(d, r): return 0x2c00 | (r & 0x10) << 5 | d << 4 | r & 0x0f
+def rjmp(k): return 0xc000 | k & 0xfff
+SPM = 0x95e8
+
+class SnapshotTest(unittest.TestCase):
+    """ A snapshot keeps the EEPROM and the page buffer of spm, which
+    are not in the data space. """
+
+    def machine(self):
+        # writes 0x5a into the EEPROM at 3, then 0x12 into the page
+        # buffer at 0x44
+        words = [ldi(16, 3), out(0x1e, 16), ldi(16, 0x5a), out(0x1d, 16),
+                 sbi(0x1c, 2), sbi(0x1c, 1),
+                 ldi(30, 0x44), ldi(31, 0), ldi(16, 0x12), mov(0, 16), ldi(16, 1),
+                 out(0x37, 16), SPM, rjmp(-1)]
+        alu = ATtiny13()
+        code_tree = {}
+        for i, word in enumerate(words):
+            code_tree['%04x' % (i * 2)] = alu.parse(i * 2, word)
+        alu.load(code_tree)
+        return alu
+
+    def test_restore(self):
+        alu = self.machine()
+        alu.run(100)
+        self.assertEqual(alu.eeprom.memory[3], 0x5a)
+        self.assertEqual(alu.page_buffer[4], 0x12)
+        blob = alu.snapshot()
+
+        alu.eeprom.image.erase()
+        alu.clear_page_buffer()
+        alu.restore(blob)
+        self.assertEqual(alu.eeprom.memory[3], 0x5a)
+        self.assertEqual(alu.page_buffer[4], 0x12)
+
+        other = self.machine()
+        other.restore(blob)
+        self.assertEqual(str(buffer(other.eeprom.memory)), str(buffer(alu.eeprom.memory)))
+        self.assertEqual(other.page_buffer, alu.page_buffer)
+        self.assertEqual(other.snapshot(), blob)
+
+if __name__ == '__main__':
+    unittest.main()
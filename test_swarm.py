@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+# (c) 2009 Ruslan Popov <ruslan.popov@gmail.com>
+
+import unittest
+
+from attiny13 import ATtiny13
+from swarm import numpy, Swarm
+
+def ldi(d, k): return 0xe000 | (k & 0xf0) << 4 | (d - 16) << 4 | k & 0x0f
+def out(a, r): return 0xb800 | (a & 0x30) << 5 | r << 4 | a & 0x0f
+def in_(d, a): return 0xb000 | (a & 0x30) << 5 | d << 4 | a & 0x0f
+def rjmp(k): return 0xc000 | k & 0xfff
+
+@unittest.skipIf(numpy is None, 'the swarm needs NumPy')
+class SwarmPinsTest(unittest.TestCase):
+    """ PINB of the swarm follows PortB: the pins driven from outside
+    read their levels, the floating inputs read their pull-ups. """
+
+    def test_pull_ups(self):
+        # DDRB = 0x0f, PORTB = 0x35 turns the pull-ups of pins 4 and 5
+        # on, then PINB goes to r16
+        words = [ldi(16, 0x0f), out(0x17, 16), ldi(16, 0x35), out(0x18, 16),
+                 in_(17, 0x16), rjmp(-1)]
+        alu = ATtiny13(lazy_flags=False)
+        code_tree = {}
+        for i, word in enumerate(words):
+            code_tree['%04x' % (i * 2)] = alu.parse(i * 2, word)
+        cases = [(inputs, driven) for inputs in (0x00, 0x3f, 0x2a)
+                 for driven in (0x3f, 0x00, 0x0f, 0x10, 0x20)]
+
+        swarm = Swarm(alu, len(cases))
+        swarm.load(code_tree)
+        swarm.set_inputs([inputs for inputs, driven in cases],
+                         [driven for inputs, driven in cases])
+        swarm.run(20)
+        for n, (inputs, driven) in enumerate(cases):
+            reference = ATtiny13(lazy_flags=False)
+            reference.load(code_tree)
+            reference.portb.set_inputs(inputs, driven)
+            reference.run(20)
+            self.assertEqual(swarm.data[n, 17], reference.data[17],
+                             'inputs %02x, driven %02x' % (inputs, driven))
+            self.assertEqual(swarm.data[n, alu.io + 0x16], reference.data[alu.io + 0x16])
+
+if __name__ == '__main__':
+    unittest.main()
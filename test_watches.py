@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# (c) 2009 Ruslan Popov <ruslan.popov@gmail.com>
+
+import unittest
+
+from attiny13 import ATtiny13
+from watches import Watches, Watchpoint
+
+def ldi(d, k): return 0xe000 | (k & 0xf0) << 4 | (d - 16) << 4 | k & 0x0f
+def push(r): return 0x920f | r << 4
+def pop(d): return 0x900f | d << 4
+def rcall(k): return 0xd000 | k & 0xfff
+def rjmp(k): return 0xc000 | k & 0xfff
+def adiw(d, k): return 0x9600 | (k & 0x30) << 2 | (d - 24) << 3 | k & 0x0f
+def movw(d, r): return 0x0100 | d << 3 | r >> 1
+def ld_x_inc(d): return 0x900d | d << 4
+def lpm_z_inc(d): return 0x9005 | d << 4
+RET, RETI, SEI, NOP = 0x9508, 0x9518, 0x9478, 0x0000
+
+class StackWatchTest(unittest.TestCase):
+    """ Watchpoints at RAMEND catch the bytes the stack instructions
+    and the interrupt entry write and read there. """
+
+    def machine(self, blocks, words, access='w'):
+        alu = ATtiny13(blocks=blocks)
+        code_tree = {}
+        for i, word in enumerate(words):
+            code_tree['%04x' % (i * 2)] = alu.parse(i * 2, word)
+        alu.load(code_tree)
+        watches = Watches(alu)
+        watches.add(Watchpoint(alu.ramend, access))
+        return (alu, watches)
+
+    def check(self, words, pointer, value, access='w', prepare=None):
+        for blocks in (False, True):
+            (alu, watches) = self.machine(blocks, words, access)
+            if prepare is not None:
+                prepare(alu)
+            self.assertEqual(alu.run(1000), 'watch')
+            self.assertEqual(alu.pointer, pointer)
+            self.assertEqual(alu.data[alu.ramend], value)
+            self.assertTrue(watches.hit is watches.points[0])
+
+    def test_push(self):
+        self.check([ldi(16, 5), push(16), rjmp(-1)], 4, 5)
+
+    def test_pop(self):
+        self.check([ldi(16, 5), push(16), pop(17), rjmp(-1)], 6, 5, 'r')
+
+    def test_rcall(self):
+        # the low byte of the word address of the return goes to RAMEND
+        self.check([NOP, rcall(1), rjmp(-1), RET], 6, 2)
+
+    def test_ret(self):
+        self.check([rcall(1), rjmp(-1), RET], 2, 1, 'r')
+
+    def test_interrupt(self):
+        def prepare(alu):
+            # INT0 is enabled and pending
+            alu.data[alu.io + 0x3b] = 0x40
+            alu.data[alu.io + 0x3a] = 0x40
+        # the vector of INT0 is at 0002, the interrupted sei returns to 0008
+        self.check([rjmp(2), RETI, NOP, SEI, rjmp(-1)], 2, 4, prepare=prepare)
+
+class WriteWatchTest(unittest.TestCase):
+    """ Watchpoints catch every location an instruction writes, not
+    only its first one. """
+
+    def check(self, words, location, value, prepare=None):
+        for blocks in (False, True):
+            alu = ATtiny13(blocks=blocks)
+            code_tree = {}
+            for i, word in enumerate(words):
+                code_tree['%04x' % (i * 2)] = alu.parse(i * 2, word)
+            alu.load(code_tree)
+            if prepare is not None:
+                prepare(alu)
+            watches = Watches(alu)
+            watches.add(Watchpoint(location, 'w', 'value == %i' % (value, )))
+            self.assertEqual(alu.run(100), 'watch')
+            self.assertEqual(alu.data[location], value)
+
+    def test_adiw(self):
+        # the carry of the low byte goes to r25
+        self.check([ldi(24, 0xff), adiw(24, 49), rjmp(-2)], 25, 1)
+
+    def test_movw(self):
+        self.check([ldi(17, 0x42), movw(2, 16), rjmp(-1)], 3, 0x42)
+
+    def test_ld_increment(self):
+        def prepare(alu):
+            alu.data[26] = alu.sram
+        self.check([ld_x_inc(0), rjmp(-1)], 26, 0x61, prepare)
+
+    def test_lpm_increment(self):
+        self.check([ldi(30, 0xff), ldi(31, 0), lpm_z_inc(0), rjmp(-1)], 31, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# (c) 2009 Ruslan Popov <ruslan.popov@gmail.com>
+
+import itertools, mmap, struct, sys, threading, Queue
+from optparse import OptionParser
+
+# the file starts with magic, version and the number of the records
+HEADER = struct.Struct('<7sBQ')
+# cycle, pointer, opcode, written location of the data space or
+# NOWHERE, its new value
+RECORD = struct.Struct('<QHHHBx')
+NOWHERE = 0xffff
+# the most records written at once: the longest block of the compiler,
+# an instruction writes up to three locations
+BATCH = 3 * 64
+
+class Tracer(object):
+    """ Execution trace recorder. The records go into a ring buffer of
+    chunk_count chunks, a full chunk is handed to the writer thread
+    which copies it into the memory-mapped file while the machine runs
+    on in the next one. The machine waits only when all the chunks are
+    full. The image is the flash the opcodes are taken from.
+
+    The compiled code writes the records of its instructions at once
+    with packs[count], up to BATCH records. position keeps the offset
+    of the next record and the end of its chunk. """
+
+    def __init__(self, filename, image, chunk_size=4096, chunk_count=8, *args, **kwargs):
+        if chunk_size < BATCH:
+            raise Exception('ERROR: The chunks are less than %i records!' % (BATCH, ))
+        self.image = image
+        self.chunk_bytes = chunk_size * RECORD.size
+        self.buffer = bytearray(self.chunk_bytes * chunk_count)
+        self.packs = [struct.Struct('<' + RECORD.format[1:] * count).pack_into
+                      for count in xrange(BATCH + 1)]
+        self.free = Queue.Queue()
+        self.full = Queue.Queue()
+        for chunk in xrange(1, chunk_count):
+            self.free.put(chunk)
+        self.position = [0, self.chunk_bytes]
+
+        self.file = open(filename, 'w+b')
+        self.file.truncate(HEADER.size + 4 * self.chunk_bytes)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self.map.seek(HEADER.size)
+        self.thread = threading.Thread(target=self.writer)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def opcode(self, addr):
+        image = self.image
+        if addr + 1 < len(image):
+            return image[addr] | image[addr + 1] << 8
+        return 0xffff
+
+    def write(self, cycle, pointer, opcode, location, value):
+        """ Appends one record of an instruction. """
+        position = self.position
+        offset = position[0]
+        if offset + RECORD.size > position[1]:
+            offset = self.hand_over()
+        RECORD.pack_into(self.buffer, offset, cycle, pointer, opcode, location, value)
+        position[0] = offset + RECORD.size
+
+    def hand_over(self):
+        """ Gives the current chunk to the writer and takes a free one.
+        Returns the offset of the free chunk. """
+        position = self.position
+        (offset, end) = position
+        self.full.put((end - self.chunk_bytes, offset))
+        offset = self.free.get() * self.chunk_bytes
+        position[:] = [offset, offset + self.chunk_bytes]
+        return offset
+
+    def writer(self):
+        while True:
+            item = self.full.get()
+            if item is None:
+                break
+            (start, end) = item
+            if self.map.tell() + end - start > len(self.map):
+                self.map.resize(2 * len(self.map))
+            self.map.write(buffer(self.buffer, start, end - start))
+            self.free.put(start // self.chunk_bytes)
+
+    def flush(self):
+        """ Hands over the records of the current chunk. """
+        (offset, end) = self.position
+        if offset != end - self.chunk_bytes:
+            self.hand_over()
+
+    def close(self):
+        """ Writes the rest of the records and closes the file. """
+        self.flush()
+        self.full.put(None)
+        self.thread.join()
+        size = self.map.tell()
+        self.map.seek(0)
+        self.map.write(HEADER.pack('AT13TRC', 1, (size - HEADER.size) // RECORD.size))
+        self.map.close()
+        self.file.truncate(size)
+        self.file.close()
+
+def read_trace(filename):
+    """ Yields the records of the trace file as tuples. """
+    data = open(filename, 'rb').read()
+    (magic, version, count) = HEADER.unpack_from(data)
+    if magic != 'AT13TRC' or version != 1:
+        raise Exception('ERROR: This is not a trace!')
+    for offset in xrange(HEADER.size, HEADER.size + count * RECORD.size, RECORD.size):
+        yield RECORD.unpack_from(data, offset)
+
+def show_trace(alu, records):
+    """ Prints the records like ATtiny13.show() does with the cycle
+    and the written value in front of them. The next records of the
+    same instruction show only their values. """
+    previous = None
+    for cycle, pointer, opcode, location, value in records:
+        written = ''
+        if location < alu.io:
+            written = 'r%i = %02x' % (location, value)
+        elif location != NOWHERE:
+            a = location - alu.io
+            written = '%s = %02x' % (alu.port_names.get(a, '%02x' % a), value)
+        if (cycle, pointer) == previous:
+            print '%10s %s' % ('', written)
+            continue
+        previous = (cycle, pointer)
+        print '%10i %-14s' % (cycle, written),
+        mnemo = alu.parse(pointer, opcode)
+        if mnemo is None:
+            print '%04x : .dw\t%04x' % (pointer, opcode)
+            continue
+        alu.pointer = pointer
+        alu.show(*mnemo)
+
+if __name__ == '__main__':
+    from attiny13 import ATtiny13
+
+    parser = OptionParser(usage='%prog [options] trace')
+    parser.add_option("-s", "--skip", action="store", type="int", dest="skip",
+                      help="skip this number of records", default=0)
+    parser.add_option("-n", "--count", action="store", type="int", dest="count",
+                      help="show at most this number of records", default=None)
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1:
+        print 'ERROR: The trace file is required!'
+        parser.print_help()
+        sys.exit(1)
+
+    records = read_trace(args[0])
+    stop = None
+    if options.count is not None:
+        stop = options.skip + options.count
+    show_trace(ATtiny13(), itertools.islice(records, options.skip, stop))
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# (c) 2009 Ruslan Popov <ruslan.popov@gmail.com>
+
+import time
+
+class VCDWriter(object):
+    """ Writes the changes of PORTB, DDRB and PINB of the machine as a
+    Value Change Dump for GTKWave and the like. Only the transitions
+    are written, the time is the cycle of the change in nanoseconds.
+    The lines are kept and written batch at a time. """
+
+    # name, identifier
+    registers = (('PORTB', '!'), ('DDRB', '"'), ('PINB', '#'))
+    # the pins from PINB: bit, identifier
+    pins = ((0, '0'), (1, '1'), (2, '2'), (3, '3'), (4, '4'), (5, '5'))
+
+    def __init__(self, filename, alu, batch=4096, *args, **kwargs):
+        self.alu = alu
+        self.batch = batch
+        self.lines = []
+        self.values = None
+        self.time = None
+
+        self.file = open(filename, 'w')
+        header = ['$date %s $end' % time.ctime(),
+                  '$version emuattiny $end',
+                  '$comment %i Hz $end' % alu.frequency,
+                  '$timescale 1 ns $end',
+                  '$scope module portb $end']
+        header += ['$var reg 6 %s %s [5:0] $end' % (ident, name) for name, ident in self.registers]
+        header += ['$var wire 1 %s PB%i $end' % (ident, bit) for bit, ident in self.pins]
+        header += ['$upscope $end',
+                   '$enddefinitions $end']
+        self.file.write('\n'.join(header) + '\n')
+
+        portb = alu.portb
+        self.change(alu.cycles, portb.port(portb.PORTB), portb.port(portb.DDRB),
+                    portb.port(portb.PINB))
+        portb.monitor = self.change
+
+    def timestamp(self, cycle):
+        return cycle * 1000000000 // self.alu.frequency
+
+    def change(self, now, port, ddr, pins):
+        """ Takes the values of the ports at the cycle now. """
+        values = (port & 0x3f, ddr & 0x3f, pins & 0x3f)
+        previous = self.values
+        if values == previous:
+            return
+        lines = self.lines
+        stamp = self.timestamp(now)
+        if stamp != self.time:
+            lines.append('#%i' % stamp)
+            self.time = stamp
+        if previous is None:
+            lines.append('$dumpvars')
+            previous = (-1, -1, -1)
+            pins_before = -1
+        else:
+            pins_before = previous[2]
+        for (name, ident), value, before in zip(self.registers, values, previous):
+            if value != before:
+                lines.append('b%s %s' % (bin(value)[2:], ident))
+        for bit, ident in self.pins:
+            level = pins >> bit & 1
+            if pins_before < 0 or level != pins_before >> bit & 1:
+                lines.append('%i%s' % (level, ident))
+        if self.values is None:
+            lines.append('$end')
+        self.values = values
+        if len(lines) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        """ Writes the kept lines. """
+        if self.lines:
+            self.file.write('\n'.join(self.lines) + '\n')
+            self.lines = []
+
+    def close(self):
+        """ Marks the current cycle as the end of the dump, stops taking
+        the changes and closes the file. """
+        stamp = self.timestamp(self.alu.cycles)
+        if stamp != self.time:
+            self.lines.append('#%i' % stamp)
+        self.flush()
+        self.file.close()
+        if self.alu.portb.monitor == self.change:
+            self.alu.portb.monitor = None
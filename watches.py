@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# (c) 2009 Ruslan Popov <ruslan.popov@gmail.com>
+
+class Scope(object):
+    """ Names of a condition: r0..r31, the ports by their lower case
+    names, pc, cycles and the value of the watched location. """
+
+    def __init__(self, alu, value=None):
+        self.alu = alu
+        self.value = value
+
+    def __getitem__(self, name):
+        alu = self.alu
+        if name == 'value':
+            return self.value
+        if name == 'pc':
+            return alu.pointer
+        if name == 'cycles':
+            return alu.cycles
+        if name[0] == 'r' and name[1:].isdigit() and int(name[1:]) < 32:
+            return alu.data[int(name[1:])]
+        port = alu.get_port_by_name(name.upper())
+        if port is not None:
+            return alu.io_read(port)
+        raise KeyError(name)
+
+class Point(object):
+
+    def __init__(self, condition=None, *args, **kwargs):
+        self.condition = condition
+        self.code = None
+        if condition:
+            self.code = compile(condition, '<condition>', 'eval')
+        self.hits = 0
+
+    def check(self, alu, value=None):
+        """ Returns True and counts the hit if the condition holds. """
+        if self.code is not None and not eval(self.code, {}, Scope(alu, value)):
+            return False
+        self.hits += 1
+        return True
+
+    def describe(self):
+        if self.condition:
+            return ' if %s' % (self.condition, )
+        return ''
+
+class Breakpoint(Point):
+
+    def __init__(self, addr, condition=None, *args, **kwargs):
+        super(Breakpoint, self).__init__(condition)
+        self.addr = addr
+
+    def __str__(self):
+        return 'break at %04x%s, %i hits' % (self.addr, self.describe(), self.hits)
+
+class Watchpoint(Point):
+
+    def __init__(self, location, access='w', condition=None, *args, **kwargs):
+        super(Watchpoint, self).__init__(condition)
+        if access not in ('r', 'w', 'rw'):
+            raise Exception('ERROR: Bad access %s, it is r, w or rw' % (access, ))
+        self.location = location
+        self.access = access
+
+    def __str__(self):
+        return 'watch %s of %02x%s, %i hits' % (self.access, self.location, self.describe(), self.hits)
+
+class Watches(object):
+    """ Breakpoints and watchpoints of the machine. The breakpoints
+    join the stops of the run loop, so the blocks end at them and only
+    the pointers there are checked. The instructions which read or
+    write a watched location are compiled with a check of it and end
+    their blocks; the other instructions do not change at all. A hit
+    lowers s.limit, the run loop stops with 'watch' after the
+    instruction and hit tells the point. """
+
+    def __init__(self, alu, *args, **kwargs):
+        self.alu = alu
+        self.points = []
+        self.hit = None
+
+    def add(self, point):
+        """ Adds the point, returns its number. """
+        if isinstance(point, Watchpoint) and point.location == self.alu.sreg:
+            raise Exception('ERROR: SREG can not be watched')
+        self.points.append(point)
+        self.update()
+        return len(self.points) - 1
+
+    def remove(self, number):
+        if not 0 <= number < len(self.points) or self.points[number] is None:
+            raise Exception('ERROR: There is no point %s' % (number, ))
+        self.points[number] = None
+        self.update()
+
+    def update(self):
+        """ Compiles the code of the machine for the current points. """
+        self.alu.watch(self)
+
+    def addresses(self):
+        """ Returns the addresses of the breakpoints. """
+        return set([point.addr for point in self.points if isinstance(point, Breakpoint)])
+
+    def checks(self, reads, writes):
+        """ Returns (location, access) of the watched locations from the
+        locations the instruction reads and writes. """
+        checks = []
+        for point in self.points:
+            if not isinstance(point, Watchpoint):
+                continue
+            if 'r' in point.access and point.location in reads:
+                checks.append((point.location, 'r'))
+            if 'w' in point.access and point.location in writes:
+                checks.append((point.location, 'w'))
+        return sorted(set(checks))
+
+    def watched(self, access):
+        """ Returns True if a watchpoint catches the access 'r' or 'w'
+        of some location. """
+        return [point for point in self.points
+                if isinstance(point, Watchpoint) and access in point.access] != []
+
+    def reached(self, pc):
+        """ Returns True if a breakpoint at pc stops the run. """
+        for point in self.points:
+            if isinstance(point, Breakpoint) and point.addr == pc and point.check(self.alu):
+                self.hit = point
+                return True
+        return False
+
+    def access(self, s, addr, location, access):
+        """ Called by the compiled code after the instruction at addr
+        accessed the location. Returns True if it stops the run. """
+        value = s.data[location]
+        stop = False
+        for point in self.points:
+            if isinstance(point, Watchpoint) and point.location == location and \
+                   access in point.access:
+                # the condition sees the machine at the instruction
+                s.pointer = addr
+                if point.check(s, value):
+                    self.hit = point
+                    stop = True
+        return stop